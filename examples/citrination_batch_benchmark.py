@@ -0,0 +1,48 @@
+# Benchmark of per-spectrum, batched, and concurrent requests
+# to the Citrination SAXS models, served offline by a
+# local_citrination.LocalCitrinationServer with an artificial latency
+# standing in for the network round trip.
+
+from __future__ import print_function
+import glob
+import os
+import time
+
+import numpy as np
+
+from saxskit.saxs_math import profile_spectrum
+from saxskit.saxs_citrination import CitrinationSaxsModels
+from saxskit import local_citrination
+
+latency = 0.05
+n_spectra = 40
+
+p = os.path.abspath(__file__)
+d = os.path.dirname(os.path.dirname(p))
+paths = sorted(glob.glob(os.path.join(d,'tests','test_data','solution_saxs','*','*.csv')))
+q_I_list = [np.loadtxt(paths[i%len(paths)],delimiter=',') for i in range(n_spectra)]
+features = [profile_spectrum(q_I) for q_I in q_I_list]
+
+with local_citrination.LocalCitrinationServer(latency=latency) as server:
+    client = local_citrination.LocalCitrinationClient(server.address)
+
+    def run(label,sxm,batch):
+        n_req = server.n_requests
+        t0 = time.time()
+        if batch:
+            pops, uncs = sxm.classify_batch(features)
+            sxm.predict_params_batch(pops,features,q_I_list)
+        else:
+            for f,q_I in zip(features,q_I_list):
+                pops, uncs = sxm.classify(f)
+                sxm.predict_params(pops,f,q_I)
+        t = time.time()-t0
+        print('{:36s} {:8.3f} seconds, {:4d} requests, {:8.1f} spectra/second'
+            .format(label,t,server.n_requests-n_req,n_spectra/t))
+        sxm.close()
+
+    print('{} spectra, {} seconds of latency per request'.format(n_spectra,latency))
+    run('per spectrum, sequential',CitrinationSaxsModels(client=client),False)
+    run('per spectrum, concurrent dataviews',CitrinationSaxsModels(client=client,n_threads=3),False)
+    run('batched, sequential',CitrinationSaxsModels(client=client,batch_size=10),True)
+    run('batched, concurrent',CitrinationSaxsModels(client=client,batch_size=10,n_threads=8),True)
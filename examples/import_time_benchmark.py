@@ -0,0 +1,28 @@
+# Benchmark of the time it takes to import each saxskit module
+# in a fresh python process, compared to importing numpy alone.
+# The heavy dependencies (scipy submodules, lmfit, sklearn, pandas,
+# citrination_client, pypif) are only imported when they are used,
+# so importing saxskit.saxs_math should cost about as much as numpy.
+
+from __future__ import print_function
+import subprocess
+import sys
+
+modules = ['numpy','saxskit','saxskit.saxs_math','saxskit.saxs_fit',
+    'saxskit.saxs_classify','saxskit.saxs_regression','saxskit.saxs_citrination',
+    'saxskit.saxs_piftools','saxskit.saxs_models']
+heavy = ['scipy.special','scipy.optimize','scipy.ndimage','scipy.linalg',
+    'lmfit','sklearn','pandas','citrination_client','pypif']
+n_repeat = 5
+
+code = 'import sys, time; t0 = time.time(); import {}; t = time.time()-t0; '\
+    'print(t); print(",".join([m for m in {} if m in sys.modules]))'
+
+for mod in modules:
+    times = []
+    for i in range(n_repeat):
+        out = subprocess.check_output([sys.executable,'-c',code.format(mod,heavy)])
+        t, loaded = out.decode().split('\n')[:2]
+        times.append(float(t))
+    print('{:28s} {:.4f} seconds (best of {}), heavy modules loaded: {}'
+        .format(mod,min(times),n_repeat,loaded or 'none'))
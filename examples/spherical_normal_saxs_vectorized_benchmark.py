@@ -0,0 +1,61 @@
+# Benchmark of saxskit.saxs_math.spherical_normal_saxs():
+# broadcast (radius x q) evaluation vs. the original loop over radii.
+# Uses the same q-array and size distributions as
+# spherical_normal_saxs_benchmark.ipynb.
+
+from __future__ import print_function
+from time import time
+
+import numpy as np
+
+from saxskit.saxs_math import spherical_normal_saxs
+
+def spherical_normal_saxs_loop(q,r0,sigma,sampling_width=3.5,sampling_step=0.1):
+    # the original implementation: one pass over q for each sampled radius
+    q_zero = (q == 0)
+    q_nz = np.invert(q_zero)
+    I = np.zeros(q.shape)
+    sigma_r = sigma*r0
+    dr = sigma_r*sampling_step
+    rmin = np.max([r0-sampling_width*sigma_r,dr])
+    rmax = r0+sampling_width*sigma_r
+    I_zero = 0
+    for ri in np.arange(rmin,rmax,dr):
+        xi = q*ri
+        V_ri = float(4)/3*np.pi*ri**3
+        rhoi = 1./(np.sqrt(2*np.pi)*sigma_r)*np.exp(-1*(r0-ri)**2/(2*sigma_r**2))
+        I_zero += V_ri**2 * rhoi*dr
+        I[q_nz] += V_ri**2 * rhoi*dr*(3.*(np.sin(xi[q_nz])-xi[q_nz]*np.cos(xi[q_nz]))*xi[q_nz]**-3)**2
+    if any(q_zero):
+        I[q_zero] = I_zero
+    return I/I_zero
+
+q = np.arange(0, 0.5, 0.001)
+r0 = [1,5,20,25,30,50,100,200,1000]
+sigma = [0.01, 0.05, 0.1,0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.5]
+n_repeat = 10
+
+t0 = time()
+for i in range(n_repeat):
+    I_loop = [spherical_normal_saxs_loop(q,r,s) for r in r0 for s in sigma]
+t_loop = (time()-t0)/n_repeat
+
+t0 = time()
+for i in range(n_repeat):
+    I_vec = [spherical_normal_saxs(q,r,s) for r in r0 for s in sigma]
+t_vec = (time()-t0)/n_repeat
+
+max_rel_err = max([np.max(np.abs(Iv-Il)/Il) for Iv,Il in zip(I_vec,I_loop)])
+
+print('loop over radii:     {:.4f} seconds for {} distributions'.format(t_loop,len(I_loop)))
+print('broadcast (r x q):   {:.4f} seconds for {} distributions'.format(t_vec,len(I_vec)))
+print('speedup:             {:.1f}x'.format(t_loop/t_vec))
+print('max relative error:  {:.3e}'.format(max_rel_err))
+
+# effect of the chunk_size knob on a long q-grid
+q_long = np.arange(0, 2., 1.E-5)
+for chunk_size in [256, 4096, 65536]:
+    t0 = time()
+    spherical_normal_saxs(q_long,20.,0.2,chunk_size=chunk_size)
+    print('q-grid of {} points, chunk_size {}: {:.4f} seconds'
+        .format(len(q_long),chunk_size,time()-t0))
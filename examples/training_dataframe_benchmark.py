@@ -0,0 +1,70 @@
+# Benchmark of the training dataframe built by saxs_models.training_dataframe(),
+# with typed float64/int64 columns and NaN for missing values,
+# against the former construction from a list of rows,
+# with all NaN replaced by None (object columns).
+# Synthetic records stand in for unpacked PIF records.
+
+from __future__ import print_function
+from collections import OrderedDict
+import time
+import warnings
+warnings.filterwarnings("ignore")
+
+import numpy as np
+import pandas as pd
+from sklearn import preprocessing
+
+from saxskit import all_profile_keys, population_keys, all_parameter_keys
+from saxskit.saxs_models import training_dataframe
+
+n_rows = 100000
+
+rng = np.random.RandomState(0)
+records = []
+features_list = []
+for i in range(n_rows):
+    pops = OrderedDict([(k,int(rng.rand() < 0.3)) for k in population_keys])
+    params = OrderedDict()
+    if pops['spherical_normal']:
+        params['r0_sphere'] = [float(rng.rand()*50.)]
+        params['sigma_sphere'] = [float(rng.rand()*0.2)]
+    feats = OrderedDict([(k,float(v)) for k,v in zip(all_profile_keys,rng.randn(len(all_profile_keys)))])
+    if pops['unidentified']:
+        for k in all_profile_keys[13:]:
+            feats[k] = None
+    records.append(('expt_{}'.format(i%20),None,None,None,None,pops,params,None))
+    features_list.append(feats)
+
+def rows_dataframe(records,features_list):
+    # former construction: a list of rows, with NaN replaced by None
+    data = []
+    for rec,feats in zip(records,features_list):
+        par = OrderedDict.fromkeys(all_parameter_keys)
+        par.update(rec[6])
+        param_list = [par[k][0] if par[k] is not None else None for k in par.keys()]
+        data.append([rec[0]]+list(feats.values())+list(rec[5].values())+param_list)
+    colnames = ['experiment_id']+all_profile_keys+population_keys+all_parameter_keys
+    d = pd.DataFrame(data=data, columns=colnames)
+    return d.where((pd.notnull(d)), None)
+
+def train_steps(df):
+    # the dataframe operations of saxs_models.train_regressors()
+    t0 = time.time()
+    d = df[df['unidentified']==False]
+    d = d[d['r0_sphere'].isnull() == False]
+    data = d.dropna(subset=all_profile_keys)
+    scaler = preprocessing.StandardScaler()
+    scaler.fit(data[all_profile_keys])
+    scaler.transform(data[all_profile_keys])
+    return time.time()-t0
+
+for label,build in [('rows, object columns',rows_dataframe),
+    ('columnar, typed',training_dataframe)]:
+    t0 = time.time()
+    df = build(records,features_list)
+    t_build = time.time()-t0
+    mem = df.memory_usage(deep=True).sum()/1.E6
+    n_object = len([c for c in df.columns if df[c].dtype == object])
+    t_train = train_steps(df)
+    print('{:24s} build {:6.2f} s, memory {:7.1f} MB, {:3d} object columns, '
+        'filter/dropna/scale {:6.3f} s'.format(label,t_build,mem,n_object,t_train))
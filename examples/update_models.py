@@ -4,6 +4,8 @@ warnings.filterwarnings("ignore")
 
 from citrination_client import CitrinationClient
 from saxskit.saxs_models import get_data_from_Citrination
+from saxskit.pif_mirror import PifMirror
+from saxskit.feature_store import FeatureStore
 from saxskit.saxs_models import train_classifiers_partial, train_regressors_partial, save_models
 
 p = os.path.abspath(__file__)
@@ -19,9 +21,16 @@ with open(api_key_file, "r") as g:
     a_key = g.readline().strip()
 cl = CitrinationClient(site='https://slac.citrination.com',api_key=a_key)
 
-new_data = get_data_from_Citrination(client = cl, dataset_id_list= [16]) # [16] is a list of datasets ids
+# local mirror of the Citrination datasets:
+# only new or changed records are written to disk
+mirror = PifMirror(os.path.join(d,'pif_mirror.db'))
+mirror.sync(cl, [1,15,16])
+# features of spectra that were profiled by earlier runs are reused
+features = FeatureStore(os.path.join(d,'feature_store.db'))
 
-all_data = get_data_from_Citrination(client = cl, dataset_id_list= [1,15,16])
+new_data = get_data_from_Citrination(client = cl, dataset_id_list= [16], mirror=mirror, sync=False, feature_store=features) # [16] is a list of datasets ids
+
+all_data = get_data_from_Citrination(client = cl, dataset_id_list= [1,15,16], mirror=mirror, sync=False, feature_store=features)
 
 scalers, models, accuracy = train_classifiers_partial(
         new_data, classifiers_path, all_training_data=all_data, model='all')
@@ -1,4 +1,34 @@
 from collections import OrderedDict
+import importlib
+
+class _LazyModule(object):
+    """Stand-in for a module that is imported at first attribute access."""
+
+    def __init__(self,name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self,attr):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return getattr(self._module,attr)
+
+def lazy_import(name):
+    """Defer the import of a module until it is used.
+
+    Parameters
+    ----------
+    name : str
+        Full name of the module, e.g. 'sklearn.linear_model'
+
+    Returns
+    -------
+    module : object
+        Object that imports the module named `name`
+        at the first access of any of its attributes,
+        and gives access to the attributes of the module.
+    """
+    return _LazyModule(name)
 
 population_keys = [\
     'unidentified',\
@@ -0,0 +1,167 @@
+"""Modules for storing spectrum features on disk.
+
+A FeatureStore keeps the profile features of spectra
+(saxs_math.profile_spectrum() and saxs_math.detailed_profile(),
+in the order of all_profile_keys)
+in an sqlite database, keyed on the content of the spectrum
+(saxs_math.spectrum_hash()) and on saxs_math.feature_version.
+Features computed by an older version of the profiling code
+are never used, and are removed when the store is opened.
+The database can be shared by concurrent processes.
+"""
+from collections import OrderedDict
+import sqlite3
+
+import numpy as np
+
+from . import saxs_math
+from . import all_profile_keys
+from .sqlite_store import SqliteStore
+
+def compute_features(q_I,populations):
+    """Compute all profile features of a spectrum.
+
+    Parameters
+    ----------
+    q_I : array
+        n-by-2 array of scattering vector (1/Angstrom) and intensities.
+    populations : dict
+        dictionary counting scatterer populations
+        (only 'unidentified' is used, see saxs_math.detailed_profile())
+
+    Returns
+    -------
+    features : dict
+        Dict of features for all of `all_profile_keys`,
+        with None for the features that are not computed.
+    """
+    feats = OrderedDict.fromkeys(all_profile_keys)
+    feats.update(saxs_math.profile_spectrum(q_I))
+    feats.update(saxs_math.detailed_profile(q_I,populations))
+    return feats
+
+class FeatureStore(SqliteStore):
+    """Disk-backed store of spectrum features."""
+
+    def __init__(self,db_file,timeout=30.):
+        """Initialize a FeatureStore.
+
+        Parameters
+        ----------
+        db_file : str
+            Path to the sqlite database file.
+            It is created if it does not exist.
+        timeout : float
+            Time in seconds to wait for a lock held by
+            another process before raising an error.
+        """
+        super(FeatureStore,self).__init__(db_file,timeout)
+        self.hits = 0
+        self.misses = 0
+
+    def features(self,q_I,populations):
+        """Get the features of a spectrum, computing them if they are not stored.
+
+        See compute_features() for the parameters and return value.
+        """
+        return self.features_batch([q_I],[populations])[0]
+
+    def features_batch(self,q_I_list,populations_list):
+        """Get the features of many spectra.
+
+        Only the spectra whose features are not stored are profiled,
+        and their features are added to the store.
+
+        Parameters
+        ----------
+        q_I_list : list
+            list of n-by-2 arrays of scattering vector (1/Angstrom)
+            and intensities
+        populations_list : list
+            list of populations dicts, one for each spectrum
+
+        Returns
+        -------
+        features : list
+            list of features dicts (see compute_features()),
+            one for each spectrum
+        """
+        keys = [feature_key(q_I,pops) for q_I,pops in zip(q_I_list,populations_list)]
+        vectors = self._get(keys)
+        new_rows = OrderedDict()
+        for i,(key,q_I,pops) in enumerate(zip(keys,q_I_list,populations_list)):
+            if vectors[i] is None:
+                if not key in new_rows:
+                    new_rows[key] = _features_to_vector(compute_features(q_I,pops))
+                vectors[i] = new_rows[key]
+        with self._lock:
+            self.hits += len(keys)-len([k for k in keys if k in new_rows])
+            self.misses += len([k for k in keys if k in new_rows])
+        if new_rows:
+            self._put(new_rows)
+        return [_vector_to_features(v) for v in vectors]
+
+    def stats(self):
+        """Get the store counters.
+
+        Returns
+        -------
+        stats : dict
+            Dict of the numbers of hits and misses
+            counted by this FeatureStore,
+            and of the entries currently in the database.
+        """
+        with self._lock:
+            conn = self._connect()
+            st = OrderedDict()
+            st['hits'] = self.hits
+            st['misses'] = self.misses
+            st['entries'] = conn.execute('SELECT COUNT(*) FROM features').fetchone()[0]
+        return st
+
+    def _get(self,keys):
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            for i0 in range(0,len(keys),500):
+                kk = list(set(keys[i0:i0+500]))
+                rows = conn.execute('SELECT key, vector FROM features '
+                    'WHERE key IN ({})'.format(','.join('?'*len(kk))),kk).fetchall()
+                for key,vec in rows:
+                    found[key] = np.frombuffer(vec,dtype=np.float64)
+        return [found.get(key) for key in keys]
+
+    def _put(self,rows):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO features '
+                    '(key, version, vector) VALUES (?,?,?)',
+                    [(key,saxs_math.feature_version,sqlite3.Binary(vec.tobytes()))
+                    for key,vec in rows.items()])
+
+    def _create_tables(self,conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS features ('
+            'key TEXT PRIMARY KEY, version INTEGER, vector BLOB)')
+        # features of other versions can not be hit: drop them
+        conn.execute('DELETE FROM features WHERE NOT version = ?',
+            (saxs_math.feature_version,))
+
+def feature_key(q_I,populations):
+    """Get the store key of the features of a spectrum.
+
+    The key depends on the content of `q_I`,
+    on whether or not `populations` is unidentified
+    (see saxs_math.detailed_profile()),
+    and on saxs_math.feature_version.
+    """
+    return '{}-{}-{}'.format(saxs_math.spectrum_hash(q_I),
+        int(bool(populations['unidentified'])),saxs_math.feature_version)
+
+def _features_to_vector(feats):
+    return np.array([np.nan if feats[k] is None else feats[k]
+        for k in all_profile_keys],dtype=np.float64)
+
+def _vector_to_features(vec):
+    return OrderedDict([(k,None if np.isnan(v) else float(v))
+        for k,v in zip(all_profile_keys,vec)])
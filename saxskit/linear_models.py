@@ -0,0 +1,71 @@
+"""Modules for evaluating the saxskit linear models with numpy only.
+
+These classes reproduce the inference methods of the scikit-learn
+estimators used by saxskit
+(StandardScaler, SGDClassifier, and SGDRegressor),
+from the same fitted attributes (mean_, scale_, coef_, intercept_, ...),
+so that the models can be evaluated without importing scikit-learn.
+Inputs are 2-d arrays with one row for each sample.
+"""
+import numpy as np
+
+class LinearScaler(object):
+    """Standard scaler: (x-mean_)/scale_, like sklearn StandardScaler."""
+
+    def __init__(self):
+        self.with_mean = True
+        self.with_std = True
+        self.mean_ = None
+        self.scale_ = None
+
+    def transform(self,X):
+        X = np.array(X,dtype=float)
+        if self.with_mean:
+            X -= self.mean_
+        if self.with_std:
+            X /= self.scale_
+        return X
+
+class LogisticClassifier(object):
+    """Linear classifier with logistic probabilities, like sklearn SGDClassifier."""
+
+    def __init__(self):
+        self.loss = 'log'
+        self.coef_ = None
+        self.intercept_ = None
+        self.classes_ = None
+
+    def decision_function(self,X):
+        scores = np.dot(X,np.asarray(self.coef_).T) + self.intercept_
+        if scores.shape[1] == 1:
+            return scores[:,0]
+        return scores
+
+    def predict(self,X):
+        scores = self.decision_function(X)
+        if scores.ndim == 1:
+            idx = (scores > 0).astype(int)
+        else:
+            idx = np.argmax(scores,axis=1)
+        return np.asarray(self.classes_)[idx]
+
+    def predict_proba(self,X):
+        if not self.loss in ['log','log_loss']:
+            msg = 'Probabilities are not available for loss {}'.format(self.loss)
+            raise RuntimeError(msg)
+        with np.errstate(over='ignore'):
+            prob = 1./(1.+np.exp(-1*self.decision_function(X)))
+        if prob.ndim == 1:
+            return np.vstack([1.-prob,prob]).T
+        # one-vs-rest: normalize over the classes
+        return prob/np.sum(prob,axis=1)[:,np.newaxis]
+
+class LinearRegressor(object):
+    """Linear regression model, like sklearn SGDRegressor."""
+
+    def __init__(self):
+        self.coef_ = None
+        self.intercept_ = None
+
+    def predict(self,X):
+        return np.dot(X,self.coef_) + self.intercept_
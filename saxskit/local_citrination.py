@@ -0,0 +1,337 @@
+"""Modules for serving Citrination-like predictions and searches locally.
+
+LocalCitrinationServer is an HTTP stand-in for the Citrination
+predict endpoint used by saxs_citrination.CitrinationSaxsModels,
+and for the PIF search endpoint used by 
+saxs_models.get_pifs_from_Citrination().
+LocalCitrinationClient is a minimal client for it,
+with the same predict(dataview_id, candidates) 
+and search(query) calls as the Citrination client.
+They are meant for testing and benchmarking offline:
+the predictions are computed by python functions,
+the searches are served from in-memory datasets
+(see LocalCitrinationServer),
+and an artificial latency can be added to each request
+to emulate network round trips.
+"""
+from collections import OrderedDict
+import json
+import re
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import Request, urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import Request, urlopen
+
+from . import population_keys
+from . import lazy_import
+from .prediction_cache import to_builtin
+
+pif = lazy_import('pypif.pif')
+
+_predict_path = re.compile(r'^/api/csv_to_models/(?P<dataview_id>[^/]+)/predict/?$')
+_search_path = re.compile(r'^/api/search/pif_search/?$')
+
+def default_models():
+    """Get placeholder prediction functions for the SAXS dataviews.
+
+    Returns
+    -------
+    models : dict
+        Dict of functions that map a candidate (dict of input properties)
+        to a dict of predicted properties,
+        for the dataview IDs used by saxs_citrination.CitrinationSaxsModels.
+        The predictions are constant:
+        one spherical_normal population, with r0_sphere=20.,
+        sigma_sphere=0.1, and rg_gp=10.
+    """
+    pops = OrderedDict.fromkeys(population_keys,0)
+    pops['spherical_normal'] = 1
+    models = OrderedDict()
+    models['33'] = lambda cand: OrderedDict(
+        [('Property '+k,[v,0.1]) for k,v in pops.items()])
+    models['34'] = lambda cand: {'Property r0_sphere':[20.,1.]}
+    models['31'] = lambda cand: {'Property sigma_sphere':[0.1,0.01]}
+    models['35'] = lambda cand: {'Property rg_gp':[10.,1.]}
+    return models
+
+class _ThreadingHTTPServer(ThreadingMixIn,HTTPServer):
+    daemon_threads = True
+
+class LocalCitrinationServer(object):
+    """Local HTTP stand-in for the Citrination predict and search endpoints.
+
+    The server accepts POST requests at
+    /api/csv_to_models/<dataview_id>/predict,
+    with a JSON body {"predictionRequest": {"candidates": [...]}},
+    and responds with {"candidates": [...]},
+    with one dict of predicted properties for each candidate.
+    It also accepts POST requests at /api/search/pif_search,
+    with a JSON body of a dataset query
+    (as built by saxs_models.get_pifs_from_Citrination()),
+    and responds with {"hits": [{"system": ...}, ...], "total_num_hits": ...},
+    where "hits" is null when the requested page is empty.
+    Requests are served concurrently, each in its own thread.
+    """
+
+    def __init__(self,models=None,latency=0.,host='127.0.0.1',port=0,datasets=None):
+        """Initialize a LocalCitrinationServer.
+
+        Parameters
+        ----------
+        models : dict, optional
+            Dict of prediction functions, keyed by dataview ID.
+            Each function maps a candidate (dict of input properties)
+            to a dict of predicted properties,
+            with a [value, uncertainty] list for each property.
+            Default is default_models().
+        latency : float
+            Time in seconds added to the handling of each request.
+        host : str
+            Host name to bind the server to.
+        port : int
+            Port to bind the server to.
+            The default (0) uses any free port.
+        datasets : dict, optional
+            Dict of lists of PIF records (as JSON-compatible dicts),
+            keyed by dataset ID, to be served by searches.
+        """
+        if models is None:
+            models = default_models()
+        self.models = models
+        self.latency = latency
+        self.datasets = OrderedDict([(str(k),v) for k,v in (datasets or {}).items()])
+        self.n_requests = 0
+        self.n_candidates = 0
+        self.n_searches = 0
+        # number of upcoming searches that will fail (status 503),
+        # for testing retries
+        self.n_failures = 0
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host,port),self._handler_class())
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host,port)
+
+    def start(self):
+        """Start serving in a background thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._server.serve_forever)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the server socket."""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,*args):
+        self.stop()
+
+    def predict(self,dataview_id,candidates):
+        """Compute the predictions for a list of candidates.
+
+        Parameters
+        ----------
+        dataview_id : str
+            ID of the dataview (key of self.models).
+        candidates : list
+            List of dicts of input properties.
+
+        Returns
+        -------
+        predictions : list
+            List of dicts of predicted properties,
+            one for each candidate.
+        """
+        if not dataview_id in self.models:
+            raise KeyError('Unknown dataview: {}'.format(dataview_id))
+        with self._lock:
+            self.n_requests += 1
+            self.n_candidates += len(candidates)
+        if self.latency:
+            time.sleep(self.latency)
+        return [self.models[dataview_id](cand) for cand in candidates]
+
+    def search(self,dataset_id,from_index,size):
+        """Get a page of records of a dataset.
+
+        Parameters
+        ----------
+        dataset_id : str
+            ID of the dataset (key of self.datasets).
+        from_index : int
+            Index of the first record of the page.
+        size : int
+            Maximum number of records in the page.
+
+        Returns
+        -------
+        records : list
+            List of PIF records, or None if the page is empty.
+        n_total : int
+            Number of records in the dataset.
+        """
+        with self._lock:
+            self.n_searches += 1
+        if self.latency:
+            time.sleep(self.latency)
+        records = self.datasets.get(str(dataset_id),[])
+        page = records[from_index:from_index+size]
+        return (page or None), len(records)
+
+    def _fail_search(self):
+        with self._lock:
+            if self.n_failures > 0:
+                self.n_failures -= 1
+                return True
+        return False
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                if _search_path.match(self.path):
+                    self._search()
+                    return
+                m = _predict_path.match(self.path)
+                if m is None:
+                    self._respond(404,{'error':'Not found: {}'.format(self.path)})
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length',0))
+                    body = json.loads(self.rfile.read(length).decode('utf-8'))
+                    candidates = body['predictionRequest']['candidates']
+                    if isinstance(candidates,dict):
+                        candidates = [candidates]
+                    preds = server.predict(m.group('dataview_id'),candidates)
+                except KeyError as ex:
+                    self._respond(400,{'error':str(ex)})
+                    return
+                self._respond(200,{'candidates':preds})
+
+            def _search(self):
+                if server._fail_search():
+                    self._respond(503,{'error':'Service unavailable'})
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length',0))
+                    body = json.loads(self.rfile.read(length).decode('utf-8'))
+                    dataset_id = body['query']['dataset']['id']['equal']
+                    records, n_total = server.search(dataset_id,
+                        int(body.get('from',0)),int(body.get('size',10)))
+                except KeyError as ex:
+                    self._respond(400,{'error':str(ex)})
+                    return
+                hits = None
+                if records is not None:
+                    hits = [{'system':rec} for rec in records]
+                self._respond(200,{'hits':hits,'total_num_hits':n_total})
+
+            def _respond(self,status,content):
+                data = json.dumps(content,default=to_builtin).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type','application/json')
+                self.send_header('Content-Length',str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self,*args):
+                pass
+
+        return Handler
+
+class LocalCitrinationClient(object):
+    """Minimal client for a LocalCitrinationServer."""
+
+    def __init__(self,address,api_key=None,timeout=60.):
+        self.address = address.rstrip('/')
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def predict(self,dataview_id,candidates):
+        """Request predictions from a dataview.
+
+        Parameters
+        ----------
+        dataview_id : str
+            ID of the dataview.
+        candidates : dict or list
+            Dict of input properties, or a list of such dicts.
+
+        Returns
+        -------
+        response : dict
+            Dict with a 'candidates' entry,
+            holding a list of dicts of predicted properties,
+            one for each candidate.
+        """
+        if isinstance(candidates,dict):
+            candidates = [candidates]
+        body = json.dumps({'predictionRequest':{'predictionSource':'scalar',
+            'usePrior':True,'candidates':candidates}},default=to_builtin)
+        return self._post('/api/csv_to_models/{}/predict'.format(dataview_id),body)
+
+    def search(self,query):
+        """Search for PIF records.
+
+        Parameters
+        ----------
+        query : citrination_client.PifSystemReturningQuery
+            Query for the records of one dataset,
+            as built by saxs_models.get_pifs_from_Citrination().
+
+        Returns
+        -------
+        result : object
+            Search result, with a `hits` attribute 
+            holding a list of hits (or None if there are no hits),
+            where each hit has a `system` attribute (a pypif.obj.System),
+            and a `total_num_hits` attribute.
+        """
+        if hasattr(query,'as_dictionary'):
+            query = query.as_dictionary()
+        resp = self._post('/api/search/pif_search',json.dumps(query,default=to_builtin))
+        hits = resp['hits']
+        if hits is not None:
+            hits = [_SearchHit(pif.loado(hit['system'])) for hit in hits]
+        return _SearchResult(hits,resp['total_num_hits'])
+
+    def _post(self,path,body):
+        headers = {'Content-Type':'application/json'}
+        if self.api_key is not None:
+            headers['X-API-Key'] = self.api_key
+        req = Request(self.address+path,body.encode('utf-8'),headers)
+        resp = urlopen(req,timeout=self.timeout)
+        try:
+            return json.loads(resp.read().decode('utf-8'))
+        finally:
+            resp.close()
+
+class _SearchResult(object):
+
+    def __init__(self,hits,total_num_hits):
+        self.hits = hits
+        self.total_num_hits = total_num_hits
+
+class _SearchHit(object):
+
+    def __init__(self,system):
+        self.system = system
@@ -0,0 +1,190 @@
+"""Modules for compiling model YAML files into fast-loading bundles.
+
+A bundle is a numpy .npz file that holds
+the arrays of the scalers and models of a YAML file
+(as written by saxs_models.save_models()),
+along with a JSON record of the other (scalar) attributes
+and a hash of the YAML file content.
+The bundles of the models in the modeling_data directory are shipped
+with the package. A bundle is rebuilt at load time
+only when its hash does not match the YAML file
+(e.g. for newly trained models).
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import os
+
+import numpy as np
+import yaml
+
+bundle_format = 1
+
+_skip = object()
+
+class _ModelLoader(yaml.Loader):
+    # sklearn objects in the YAML (e.g. the loss functions of SGD models)
+    # are not needed to evaluate the models: they are loaded as None,
+    # so that loading the models never imports sklearn
+    pass
+
+def _ignore_sklearn_object(loader,tag_suffix,node):
+    return None
+
+# tag prefixes are tried in order: the sklearn ones must come first
+_ModelLoader.yaml_multi_constructors = OrderedDict(
+    [('tag:yaml.org,2002:'+tag+'sklearn.',_ignore_sklearn_object) for tag in
+    ['python/object/apply:','python/object/new:','python/object:','python/name:']]
+    +list(yaml.Loader.yaml_multi_constructors.items()))
+
+def load_models(yml_file,bundle_file=None,write_bundle=True):
+    """Load scalers and models, using a compiled bundle when it is current.
+
+    Parameters
+    ----------
+    yml_file : str
+        Path to a YAML file of scalers and models.
+    bundle_file : str
+        Path to the compiled bundle for `yml_file`.
+        Default is the path of `yml_file` with an .npz extension.
+    write_bundle : bool
+        If True, the bundle is (re)built from `yml_file`
+        when it is missing or out of date.
+
+    Returns
+    -------
+    s_and_m : dict
+        Dict of scaler and model attributes,
+        with the same structure as the content of `yml_file`.
+        Attributes that cannot be stored in a bundle
+        (e.g. python objects other than arrays and scalars)
+        are not included when the bundle is used.
+    """
+    if bundle_file is None:
+        bundle_file = default_bundle_file(yml_file)
+    yml_hash = file_hash(yml_file)
+    if os.path.exists(bundle_file):
+        try:
+            s_and_m, bundle_hash = read_model_bundle(bundle_file)
+            if bundle_hash == yml_hash:
+                return s_and_m
+        except (IOError,OSError,ValueError,KeyError):
+            # unreadable bundle: rebuild it
+            pass
+    s_and_m_file = open(yml_file,'rb')
+    s_and_m = load_yaml(s_and_m_file)
+    s_and_m_file.close()
+    if write_bundle:
+        try:
+            write_model_bundle(s_and_m,bundle_file,yml_hash)
+        except (IOError,OSError):
+            # e.g. a read-only installation: use the YAML every time
+            pass
+    return s_and_m
+
+def load_yaml(yml_stream):
+    """Load scalers and models from a YAML file, without importing sklearn.
+
+    Python objects of sklearn classes in the YAML are loaded as None.
+    Other tags are constructed as by yaml.Loader.
+
+    Parameters
+    ----------
+    yml_stream : file
+        Open YAML file (or YAML string) of scalers and models.
+
+    Returns
+    -------
+    s_and_m : dict
+        Dict of scaler and model attributes.
+    """
+    return yaml.load(yml_stream,Loader=_ModelLoader)
+
+def default_bundle_file(yml_file):
+    return os.path.splitext(yml_file)[0]+'.npz'
+
+def file_hash(file_path):
+    """Get the sha1 hex digest of the content of a file."""
+    with open(file_path,'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def write_model_bundle(s_and_m,bundle_file,yml_hash):
+    """Write a compiled bundle of scalers and models.
+
+    Parameters
+    ----------
+    s_and_m : dict
+        Dict of scaler and model attributes (see load_models()).
+    bundle_file : str
+        Path of the bundle file to write.
+    yml_hash : str
+        Hash of the YAML file from which `s_and_m` was loaded
+        (see file_hash()).
+    """
+    arrays = OrderedDict()
+    meta = OrderedDict()
+    meta['format'] = bundle_format
+    meta['yml_hash'] = yml_hash
+    meta['content'] = _pack(s_and_m,'',arrays)
+    arrays['__meta__'] = np.array(json.dumps(meta))
+    # write to a temporary file first,
+    # so that concurrent readers never see a partial bundle
+    tmp_file = '{}.{}.tmp'.format(bundle_file,os.getpid())
+    with open(tmp_file,'wb') as f:
+        np.savez(f,**arrays)
+    getattr(os,'replace',os.rename)(tmp_file,bundle_file)
+
+def read_model_bundle(bundle_file):
+    """Read a compiled bundle of scalers and models.
+
+    Parameters
+    ----------
+    bundle_file : str
+        Path of the bundle file.
+
+    Returns
+    -------
+    s_and_m : dict
+        Dict of scaler and model attributes (see load_models()).
+    yml_hash : str
+        Hash of the YAML file from which the bundle was built.
+    """
+    with np.load(bundle_file,allow_pickle=False) as f:
+        meta = json.loads(str(f['__meta__'][()]),object_pairs_hook=OrderedDict)
+        if not meta['format'] == bundle_format:
+            raise ValueError('Unsupported bundle format: {}'.format(meta['format']))
+        s_and_m = _unpack(meta['content'],f)
+    return s_and_m, meta['yml_hash']
+
+def _pack(obj,path,arrays):
+    if isinstance(obj,dict):
+        d = OrderedDict()
+        for k,v in obj.items():
+            v = _pack(v,path+'/'+str(k),arrays)
+            if v is not _skip:
+                d[str(k)] = v
+        return d
+    elif isinstance(obj,np.ndarray):
+        if obj.dtype == object:
+            return _skip
+        arrays[path] = obj
+        return {'__array__':path}
+    elif isinstance(obj,np.generic):
+        return obj.item()
+    elif isinstance(obj,(list,tuple)):
+        vals = [_pack(v,path+'/'+str(i),arrays) for i,v in enumerate(obj)]
+        if any([v is _skip for v in vals]):
+            return _skip
+        return vals
+    elif obj is None or isinstance(obj,(bool,int,float,str)):
+        return obj
+    return _skip
+
+def _unpack(obj,arrays):
+    if isinstance(obj,dict):
+        if list(obj.keys()) == ['__array__']:
+            return arrays[obj['__array__']]
+        return OrderedDict([(k,_unpack(v,arrays)) for k,v in obj.items()])
+    elif isinstance(obj,list):
+        return [_unpack(v,arrays) for v in obj]
+    return obj
@@ -1,5 +1,9 @@
 import numpy as np
 
+from . import lazy_import
+
+ndimage = lazy_import('scipy.ndimage')
+
 def peaks_by_window(x,y,w=10,thr=0.):
     """Find peaks in x,y data by a window-scanning.
 
@@ -23,19 +27,14 @@ def peaks_by_window(x,y,w=10,thr=0.):
     pk_idx : list of int
         list of indices where peaks were found
     pk_confidence : list of float
-        confidence in peak labeling for each peak found 
+        confidence in peak labeling for each peak found
     """
-    pk_idx = []
-    pk_confidence = []
-    for idx in range(w,len(y)-w-1):
-        pkflag = False
-        ywin = y[idx-w:idx+w+1]
-        if np.argmax(ywin) == w:
-            conf = ywin[w]/np.mean(ywin)-1.
-            pkflag = conf > thr
-        if pkflag:
-            pk_idx.append(idx)
-            pk_confidence.append(conf)
+    y = np.asarray(y,dtype=float)
+    idx = np.nonzero(window_max_flags(y,w))[0]
+    conf = _window_confidence(y,idx,w)
+    pkflag = conf > thr
+    pk_idx = idx[pkflag].tolist()
+    pk_confidence = conf[pkflag].tolist()
 
     #from matplotlib import pyplot as plt
     #plt.figure(2)
@@ -48,5 +47,142 @@ def peaks_by_window(x,y,w=10,thr=0.):
     #plt.show()
 
     return pk_idx,pk_confidence
-    
 
+def peaks_by_window_batch(x,y,w=10,thr=0.):
+    """Find peaks in many spectra by window-scanning.
+
+    Applies peaks_by_window() to each row of `y`,
+    with array operations over the whole stack.
+
+    Parameters
+    ----------
+    x : array
+        array of x-axis values, shared by all spectra
+    y : array
+        N-by-len(x) array of y-axis values, one row for each spectrum
+    w : int
+        half-width of window (see peaks_by_window())
+    thr : float
+        peak confidence threshold (see peaks_by_window())
+
+    Returns
+    -------
+    pk_idx : list
+        list of N lists of indices where peaks were found
+    pk_confidence : list
+        list of N lists of confidence in peak labeling
+        for each peak found
+    """
+    y = np.atleast_2d(np.asarray(y,dtype=float))
+    rows, idx = np.nonzero(window_max_flags(y,w))
+    conf = _window_confidence(y,idx,w,rows)
+    pkflag = conf > thr
+    rows = rows[pkflag]
+    idx = idx[pkflag]
+    conf = conf[pkflag]
+    # rows are sorted: split the peaks by row
+    row_bounds = np.searchsorted(rows,np.arange(y.shape[0]+1))
+    pk_idx = [idx[i0:i1].tolist() for i0,i1 in zip(row_bounds[:-1],row_bounds[1:])]
+    pk_confidence = [conf[i0:i1].tolist() for i0,i1 in zip(row_bounds[:-1],row_bounds[1:])]
+    return pk_idx,pk_confidence
+
+def window_max_flags(y,w):
+    """Flag the points that are the maximum of their window.
+
+    Point idx is flagged if np.argmax(y[idx-w:idx+w+1]) == w,
+    i.e. if y[idx] is greater than the `w` points before it,
+    and not less than the `w` points after it,
+    for all idx from w to len(y)-w-2.
+    The window maxima are found by a running-max filter.
+
+    Parameters
+    ----------
+    y : array
+        array of y-axis values,
+        or 2-d array with one set of y-values in each row
+    w : int
+        half-width of window
+
+    Returns
+    -------
+    flags : array
+        boolean array with the same shape as `y`
+    """
+    y = np.asarray(y,dtype=float)
+    n = y.shape[-1]
+    flags = np.zeros(y.shape,dtype=bool)
+    if n-w-1 <= w:
+        return flags
+    if w == 0:
+        flags[...,:n-1] = True
+        return flags
+    # maximum of y[j:j+w], for each window start j
+    wmax = ndimage.maximum_filter1d(y,w,axis=-1)[...,w//2:w//2+n-w+1]
+    y_ctr = y[...,w:n-w-1]
+    flags[...,w:n-w-1] = (y_ctr > wmax[...,:n-2*w-1]) & (y_ctr >= wmax[...,w+1:n-w])
+    return flags
+
+def window_min_flags(y,w):
+    """Flag the points that are the minimum of their window.
+
+    Point idx is flagged if np.argmin(y[idx-w:idx+w+1]) == w
+    (see window_max_flags()).
+
+    Parameters
+    ----------
+    y : array
+        array of y-axis values,
+        or 2-d array with one set of y-values in each row
+    w : int
+        half-width of window
+
+    Returns
+    -------
+    flags : array
+        boolean array with the same shape as `y`
+    """
+    return window_max_flags(-1*np.asarray(y,dtype=float),w)
+
+def first_window_max_min(y,w):
+    """Find the first window maximum and the window minimum that follows it.
+
+    Parameters
+    ----------
+    y : array
+        array of y-axis values,
+        or 2-d array with one set of y-values in each row
+    w : int
+        half-width of window
+        (see window_max_flags() and window_min_flags())
+
+    Returns
+    -------
+    idxmax : int or array
+        index of the first window maximum,
+        or 0 if there is none
+    idxmin : int or array
+        index of the first window minimum after `idxmax`,
+        or 0 if there is none, or if `idxmax` is 0.
+        For 2-d `y`, `idxmax` and `idxmin` are arrays
+        with one entry for each row.
+    """
+    y = np.asarray(y,dtype=float)
+    max_flags = window_max_flags(y,w)
+    idxmax = np.where(np.any(max_flags,axis=-1),np.argmax(max_flags,axis=-1),0)
+    min_flags = window_min_flags(y,w)
+    min_flags &= (np.arange(y.shape[-1]) > idxmax[...,np.newaxis])
+    min_flags &= (idxmax > 0)[...,np.newaxis]
+    idxmin = np.where(np.any(min_flags,axis=-1),np.argmax(min_flags,axis=-1),0)
+    if y.ndim == 1:
+        return int(idxmax), int(idxmin)
+    return idxmax, idxmin
+
+def _window_confidence(y,idx,w,rows=None):
+    # ywin[w]/np.mean(ywin)-1. for the windows centered at idx
+    # (in the given rows, if y is 2-d)
+    win = idx[:,np.newaxis]+np.arange(-w,w+1)
+    if rows is None:
+        ywin = y[win]
+    else:
+        ywin = y[rows[:,np.newaxis],win]
+    return ywin[:,w]/np.mean(ywin,axis=1)-1.
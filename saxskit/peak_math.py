@@ -1,8 +1,10 @@
 import numpy as np
 from collections import OrderedDict
 
-from scipy.special import wofz
-from scipy.optimize import minimize as scimin
+from . import lazy_import
+
+special = lazy_import('scipy.special')
+optimize = lazy_import('scipy.optimize')
 
 # get y value nearest xpk guess, use it to guess a scaling factor
 #ypk = y[np.argmin((x-xpk)**2)]
@@ -12,7 +14,7 @@ from scipy.optimize import minimize as scimin
 
 def solve_voigt(x, y, xc, hwhm_g, hwhm_l, scl):
     """iteratively minimize an objective to fit x, y curve to a voigt profile"""
-    res = scimin(partial(self.hann_voigt_fit,x,y),(xc,hwhm_g,hwhm_l,scl))
+    res = optimize.minimize(partial(self.hann_voigt_fit,x,y),(xc,hwhm_g,hwhm_l,scl))
 
 def hann_voigt_fit(x, y, xc, hwhm_g, hwhm_l, scl):
     # estimate hwhm of voigt
@@ -52,7 +54,27 @@ def voigt(x, hwhm_g, hwhm_l):
     and a lorentzian with hwhm hwhm_l
     """
     sigma = hwhm_g / np.sqrt(2 * np.log(2))
-    v0 = np.real(wofz((1j*hwhm_l)/sigma/np.sqrt(2))) / sigma / np.sqrt(2*np.pi)
-    return np.real(wofz((x+1j*hwhm_l)/sigma/np.sqrt(2))) / sigma / np.sqrt(2*np.pi) / v0
+    v0 = np.real(special.wofz((1j*hwhm_l)/sigma/np.sqrt(2))) / sigma / np.sqrt(2*np.pi)
+    return np.real(special.wofz((x+1j*hwhm_l)/sigma/np.sqrt(2))) / sigma / np.sqrt(2*np.pi) / v0
 
 
+def voigt_derivatives(x, hwhm_g, hwhm_l):
+    """
+    voigt distribution (see voigt()) and its derivatives
+    with respect to x, hwhm_g and hwhm_l.
+    Returns v, dv/dx, dv/dhwhm_g, dv/dhwhm_l.
+    Uses dw/dz = -2*z*w(z) + 2i/sqrt(pi) for the Faddeeva function w.
+    """
+    a = np.sqrt(np.log(2)) / hwhm_g
+    z = a * (x + 1j*hwhm_l)
+    z0 = 1j * a * hwhm_l
+    w = special.wofz(z)
+    w0 = special.wofz(z0)
+    dw = -2*z*w + 2j/np.sqrt(np.pi)
+    dw0 = -2*z0*w0 + 2j/np.sqrt(np.pi)
+    v = np.real(w) / np.real(w0)
+    dv_dx = np.real(dw * a) / np.real(w0)
+    # z and z0 are both proportional to 1/hwhm_g
+    dv_dg = (np.real(dw * -z/hwhm_g) - v*np.real(dw0 * -z0/hwhm_g)) / np.real(w0)
+    dv_dl = (np.real(dw * 1j*a) - v*np.real(dw0 * 1j*a)) / np.real(w0)
+    return v, dv_dx, dv_dg, dv_dl
@@ -0,0 +1,165 @@
+"""Modules for mirroring Citrination datasets on local disk.
+
+A PifMirror stores the PIF records of Citrination datasets
+in an sqlite database, keyed by dataset ID and record uid,
+along with a hash of the content of each record.
+PifMirror.sync() fetches the records of the datasets,
+and only writes the records that are new or changed,
+and removes the records that are no longer in the datasets.
+The mirrored records can then be loaded without network access,
+e.g. by saxs_models.get_data_from_Citrination().
+The database can be shared by concurrent processes.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import time
+
+from . import lazy_import
+from .sqlite_store import SqliteStore
+
+pif = lazy_import('pypif.pif')
+
+class PifMirror(SqliteStore):
+    """Local mirror of the PIF records of Citrination datasets."""
+
+    def __init__(self,db_file,timeout=30.):
+        """Initialize a PifMirror.
+
+        Parameters
+        ----------
+        db_file : str
+            Path to the sqlite database file.
+            It is created if it does not exist.
+        timeout : float
+            Time in seconds to wait for a lock held by
+            another process before raising an error.
+        """
+        super(PifMirror,self).__init__(db_file,timeout)
+
+    def sync(self,client,dataset_id_list,**kwargs):
+        """Update the mirror from Citrination.
+
+        Parameters
+        ----------
+        client : citrination_client.CitrinationClient
+            A python Citrination client for fetching data
+        dataset_id_list : list of int
+            List of dataset ids to mirror
+        kwargs : dict
+            Keyword arguments for saxs_models.iter_pif_pages()
+            (n_threads, page_size, max_retries, backoff).
+
+        Returns
+        -------
+        counts : dict
+            Dict of the numbers of 'added', 'updated', 'removed',
+            and 'unchanged' records, summed over the datasets.
+        """
+        from .saxs_models import iter_pif_pages
+        counts = OrderedDict.fromkeys(['added','updated','removed','unchanged'],0)
+        dataset_id_list = list(OrderedDict.fromkeys([str(ds) for ds in dataset_id_list]))
+        hashes = [self._hashes(ds) for ds in dataset_id_list]
+        seen = [set() for ds in dataset_id_list]
+        for idataset,dataset,from_index,pifs in iter_pif_pages(
+            client,dataset_id_list,**kwargs):
+            rows = []
+            for pp in pifs:
+                content = pif.dumps(pp)
+                h = content_hash(content)
+                uid = getattr(pp,'uid',None) or h
+                seen[idataset].add(uid)
+                old_hash = hashes[idataset].get(uid)
+                if old_hash == h:
+                    counts['unchanged'] += 1
+                    continue
+                counts['added' if old_hash is None else 'updated'] += 1
+                rows.append((dataset,uid,h,content,time.time()))
+            if rows:
+                with self._lock:
+                    conn = self._connect()
+                    with conn:
+                        conn.executemany('INSERT OR REPLACE INTO records '
+                            '(dataset, uid, hash, pif, updated) VALUES (?,?,?,?,?)',rows)
+        # the datasets were fetched completely: drop the records that are gone
+        for dataset,old_hashes,uids in zip(dataset_id_list,hashes,seen):
+            gone = [(dataset,uid) for uid in old_hashes.keys() if not uid in uids]
+            if gone:
+                with self._lock:
+                    conn = self._connect()
+                    with conn:
+                        conn.executemany('DELETE FROM records '
+                            'WHERE dataset = ? AND uid = ?',gone)
+                counts['removed'] += len(gone)
+        return counts
+
+    def get_pifs(self,dataset_id_list):
+        """Load the mirrored records of a list of datasets.
+
+        Parameters
+        ----------
+        dataset_id_list : list of int
+            List of dataset ids
+
+        Returns
+        -------
+        pifs : list
+            List of pypif.obj.System objects,
+            in the order of `dataset_id_list`,
+            and in order of uid within each dataset.
+            Each record is included once,
+            even if its dataset is listed more than once.
+        """
+        pifs = []
+        done = set()
+        with self._lock:
+            conn = self._connect()
+            for ds in dataset_id_list:
+                ds = str(ds)
+                if ds in done:
+                    continue
+                done.add(ds)
+                for (content,) in conn.execute('SELECT pif FROM records '
+                    'WHERE dataset = ? ORDER BY uid',(ds,)):
+                    pifs.append(pif.loads(content))
+        return pifs
+
+    def datasets(self):
+        """Get the numbers of mirrored records of each dataset.
+
+        Returns
+        -------
+        n_records : dict
+            Dict of the numbers of records, keyed by dataset ID.
+        """
+        with self._lock:
+            conn = self._connect()
+            return OrderedDict(conn.execute('SELECT dataset, COUNT(*) FROM records '
+                'GROUP BY dataset ORDER BY dataset').fetchall())
+
+    def _hashes(self,dataset):
+        with self._lock:
+            conn = self._connect()
+            return dict(conn.execute('SELECT uid, hash FROM records '
+                'WHERE dataset = ?',(dataset,)).fetchall())
+
+    def _create_tables(self,conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS records ('
+            'dataset TEXT, uid TEXT, hash TEXT, pif TEXT, updated REAL, '
+            'PRIMARY KEY (dataset, uid))')
+
+def content_hash(content):
+    """Get the sha1 hex digest of a PIF record, independent of key order.
+
+    Parameters
+    ----------
+    content : str
+        JSON encoding of the record.
+
+    Returns
+    -------
+    h : str
+        sha1 hex digest of the canonical JSON encoding of the record.
+    """
+    canonical = json.dumps(json.loads(content),sort_keys=True,separators=(',',':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
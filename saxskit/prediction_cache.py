@@ -0,0 +1,188 @@
+"""Modules for caching remote model predictions on disk.
+
+A PredictionCache stores the predictions of a dataview
+for individual candidates (dicts of input properties)
+in an sqlite database, keyed on the dataview ID
+and a hash of the canonical JSON encoding of the candidate.
+Entries expire after a time-to-live,
+and the least recently used entries are evicted
+when the cache holds more than a maximum number of entries.
+The database can be shared by concurrent processes.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import time
+
+import numpy as np
+
+from .sqlite_store import SqliteStore
+
+class PredictionCache(SqliteStore):
+    """Disk-backed cache of predictions, keyed on dataview and inputs."""
+
+    def __init__(self,db_file,ttl=None,max_entries=100000,timeout=30.):
+        """Initialize a PredictionCache.
+
+        Parameters
+        ----------
+        db_file : str
+            Path to the sqlite database file.
+            It is created if it does not exist.
+        ttl : float, optional
+            Time-to-live of the entries, in seconds.
+            By default, entries do not expire.
+        max_entries : int, optional
+            Maximum number of entries.
+            When it is exceeded,
+            the least recently used entries are evicted.
+            If None, the size of the cache is not limited.
+        timeout : float
+            Time in seconds to wait for a lock held by
+            another process before raising an error.
+        """
+        super(PredictionCache,self).__init__(db_file,timeout)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self,dataview_id,candidates):
+        """Look up the cached predictions for a list of candidates.
+
+        Parameters
+        ----------
+        dataview_id : str
+            ID of the dataview.
+        candidates : list
+            List of dicts of input properties.
+
+        Returns
+        -------
+        predictions : list
+            List of cached predictions, one for each candidate,
+            with None for the candidates that are not cached (misses).
+        """
+        keys = [candidate_key(dataview_id,cand) for cand in candidates]
+        now = time.time()
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                for i0 in range(0,len(keys),500):
+                    kk = list(set(keys[i0:i0+500]))
+                    rows = conn.execute('SELECT key, value, created FROM predictions '
+                        'WHERE key IN ({})'.format(','.join('?'*len(kk))),kk).fetchall()
+                    for key,value,created in rows:
+                        if self.ttl is None or now-created <= self.ttl:
+                            found[key] = value
+                if found:
+                    conn.executemany('UPDATE predictions SET accessed = ? WHERE key = ?',
+                        [(now,key) for key in found.keys()])
+            predictions = [json.loads(found[key]) if key in found else None for key in keys]
+            n_hits = len([p for p in predictions if p is not None])
+            self.hits += n_hits
+            self.misses += len(keys)-n_hits
+        return predictions
+
+    def put_many(self,dataview_id,candidates,predictions):
+        """Store predictions for a list of candidates.
+
+        Parameters
+        ----------
+        dataview_id : str
+            ID of the dataview.
+        candidates : list
+            List of dicts of input properties.
+        predictions : list
+            List of predictions (JSON-serializable),
+            one for each candidate.
+        """
+        now = time.time()
+        rows = [(candidate_key(dataview_id,cand),str(dataview_id),
+            canonical_json(pred),now,now) for cand,pred in zip(candidates,predictions)]
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO predictions '
+                    '(key, dataview, value, created, accessed) VALUES (?,?,?,?,?)',rows)
+                self._evict(conn,now)
+
+    def stats(self):
+        """Get the cache counters.
+
+        Returns
+        -------
+        stats : dict
+            Dict of the numbers of hits, misses, and evictions
+            counted by this PredictionCache,
+            and of the entries currently in the database.
+        """
+        with self._lock:
+            conn = self._connect()
+            n_entries = conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+            st = OrderedDict()
+            st['hits'] = self.hits
+            st['misses'] = self.misses
+            st['evictions'] = self.evictions
+            st['entries'] = n_entries
+        return st
+
+    def clear(self):
+        """Remove all entries from the database."""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('DELETE FROM predictions')
+
+    def _create_tables(self,conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS predictions ('
+            'key TEXT PRIMARY KEY, dataview TEXT, value TEXT, '
+            'created REAL, accessed REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS predictions_accessed '
+            'ON predictions (accessed)')
+
+    def _evict(self,conn,now):
+        n_evicted = 0
+        if self.ttl is not None:
+            n_evicted += conn.execute('DELETE FROM predictions WHERE created < ?',
+                (now-self.ttl,)).rowcount
+        if self.max_entries is not None:
+            n_entries = conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+            if n_entries > self.max_entries:
+                n_evicted += conn.execute('DELETE FROM predictions WHERE key IN '
+                    '(SELECT key FROM predictions ORDER BY accessed ASC LIMIT ?)',
+                    (n_entries-self.max_entries,)).rowcount
+        self.evictions += n_evicted
+
+def canonical_json(obj):
+    """Encode an object as JSON, with sorted keys and no whitespace."""
+    return json.dumps(obj,sort_keys=True,separators=(',',':'),default=to_builtin)
+
+def candidate_key(dataview_id,candidate):
+    """Get the cache key of a candidate for a dataview.
+
+    Parameters
+    ----------
+    dataview_id : str
+        ID of the dataview.
+    candidate : dict
+        Dict of input properties.
+
+    Returns
+    -------
+    key : str
+        sha1 hex digest of the dataview ID
+        and the canonical JSON encoding of `candidate`.
+    """
+    content = '{}\n{}'.format(dataview_id,canonical_json(candidate))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def to_builtin(obj):
+    """Convert numpy scalars and arrays for JSON encoding (json.dumps(default=...))."""
+    if isinstance(obj,np.generic):
+        return obj.item()
+    if isinstance(obj,np.ndarray):
+        return obj.tolist()
+    raise TypeError('{} is not JSON serializable'.format(type(obj).__name__))
@@ -1,9 +1,15 @@
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from . import saxs_math
 from . import population_keys
+from . import lazy_import
 
-from citrination_client import CitrinationClient
+citrination_client = lazy_import('citrination_client')
+
+# IDs of the dataviews on Citrination
+dataview_ids = OrderedDict([('populations','33'),
+    ('r0_sphere','34'),('sigma_sphere','31'),('rg_gp','35')])
 
 class CitrinationSaxsModels(object):
     """A set of models that uses Citrination to evaluate SAXS spectra.
@@ -15,13 +21,43 @@ class CitrinationSaxsModels(object):
     as an instantiation argument.
     """
 
-    def __init__(self, api_key_file, address='https://slac.citrination.com'):
-        with open(api_key_file, "r") as g:
-            api_key = g.readline()
-        a_key = api_key.strip()
-
-        self.client = CitrinationClient(site = address, api_key=a_key)
+    def __init__(self, api_key_file=None, address='https://slac.citrination.com',
+        client=None, batch_size=100, n_threads=1, cache=None):
+        """Initialize the Citrination client.
 
+        Parameters
+        ----------
+        api_key_file : str
+            Path to a file containing a Citrination api key.
+            Not used if `client` is provided.
+        address : str
+            Address of the Citrination site.
+        client : object, optional
+            Client to use instead of a citrination_client.CitrinationClient,
+            e.g. a local_citrination.LocalCitrinationClient.
+            It must provide predict(dataview_id, candidates).
+        batch_size : int
+            Maximum number of candidates sent in one prediction request.
+        n_threads : int
+            Number of prediction requests that may be in flight at once.
+            If greater than 1, the requests to different dataviews
+            (and the batches of a large request) are sent concurrently.
+        cache : prediction_cache.PredictionCache, optional
+            Cache of predictions.
+            If provided, candidates that are found in the cache
+            are not sent to Citrination,
+            and new predictions are added to the cache.
+        """
+        if client is None:
+            with open(api_key_file, "r") as g:
+                api_key = g.readline()
+            a_key = api_key.strip()
+            client = citrination_client.CitrinationClient(site = address, api_key=a_key)
+        self.client = client
+        self.batch_size = batch_size
+        self.n_threads = n_threads
+        self.cache = cache
+        self._thread_pool = None
 
     def classify(self,sample_params):
         """
@@ -30,8 +66,6 @@ class CitrinationSaxsModels(object):
         sample_params : ordered dictionary
             ordered dictionary of floats representing features of test sample
 
-        Returns
-        -------
         Returns
         -------
         populations : dict
@@ -42,19 +76,41 @@ class CitrinationSaxsModels(object):
             dictionary, similar to `populations`,
             but containing the uncertainty of the prediction
         """
+        populations, uncertainties = self.classify_batch([sample_params])
+        return populations[0], uncertainties[0]
 
-        inputs = self.append_str_property(sample_params)
+    def classify_batch(self,sample_params_list):
+        """Classify many samples, with one request per batch of samples.
 
-        populations = OrderedDict()
-        uncertainties = OrderedDict()
-        resp = self.client.predict("33", inputs) # "33" is ID of dataview on Citrination
-        for popname in population_keys:
-            populations[popname] = int(resp['candidates'][0]['Property '+popname][0])
-            uncertainties[popname] = float(resp['candidates'][0]['Property '+popname][1])
+        Parameters
+        ----------
+        sample_params_list : list
+            list of ordered dictionaries of sample features
+            (see self.classify())
 
+        Returns
+        -------
+        populations : list
+            list of populations dicts (see self.classify()),
+            one for each sample
+        uncertainties : list
+            list of uncertainties dicts (see self.classify()),
+            one for each sample
+        """
+        inputs = [self.append_str_property(sp) for sp in sample_params_list]
+        resp = self._predict_many([(dataview_ids['populations'],inputs)])[0]
+        populations = []
+        uncertainties = []
+        for cand in resp:
+            pops = OrderedDict()
+            uncs = OrderedDict()
+            for popname in population_keys:
+                pops[popname] = int(cand['Property '+popname][0])
+                uncs[popname] = float(cand['Property '+popname][1])
+            populations.append(pops)
+            uncertainties.append(uncs)
         return populations, uncertainties
 
-
     # helper function
     def append_str_property(self, sample_params):
         inputs = {}
@@ -83,37 +139,131 @@ class CitrinationSaxsModels(object):
             dictionary of predicted and calculated scattering parameters:
             r0_sphere, sigma_sphere, and rg_gp 
             are predicted using Citrination models.
+        uncertainties : dict
+            dictionary, similar to `params`,
+            but containing the uncertainty of each prediction
+        """
+        params, uncertainties = self.predict_params_batch([populations],[features],[q_I])
+        return params[0], uncertainties[0]
+
+    def predict_params_batch(self,populations_list,features_list,q_I_list):
+        """Use Citrination to predict the scattering parameters of many samples.
+
+        Each sample is evaluated as in self.predict_params(),
+        but the samples are sent to each dataview in batches.
+
+        Parameters
+        ----------
+        populations_list : list
+            list of populations dicts (see self.predict_params())
+        features_list : list
+            list of features dicts (see self.predict_params())
+        q_I_list : list
+            list of n-by-2 arrays of scattering vector (1/Angstrom) 
+            and intensities
+
+        Returns
+        -------
+        params : list
+            list of parameters dicts (see self.predict_params()),
+            one for each sample
+        uncertainties : list
+            list of uncertainties dicts (see self.predict_params()),
+            one for each sample
         """
         # TODO: The predictions need to handle 
         # multiple populations of the same type:
         # include this once we have training data
 
-        features = self.append_str_property(features)
-
-        params = OrderedDict()
-        uncertainties = OrderedDict()
-        if bool(populations['unidentified']):
-            return params, uncertainties
-
-        if bool(populations['spherical_normal']):
-            resp = self.client.predict("34", features) # "34" is ID of dataview on Citrination
-            params['r0_sphere'] = [float(resp['candidates'][0]['Property r0_sphere'][0])]
-            uncertainties['r0_sphere'] = float(resp['candidates'][0]['Property r0_sphere'][1])
-            additional_features = saxs_math.spherical_normal_profile(q_I)
-            additional_features = self.append_str_property(additional_features)
-            ss_features = OrderedDict(features)
-            ss_features.update(additional_features)
-            resp = self.client.predict("31", ss_features)
-            params['sigma_sphere'] = [float(resp['candidates'][0]['Property sigma_sphere'][0])]
-            uncertainties['sigma_sphere'] = float(resp['candidates'][0]['Property sigma_sphere'][1])
-
-        if bool(populations['guinier_porod']):
-            additional_features = saxs_math.guinier_porod_profile(q_I)
-            additional_features = self.append_str_property(additional_features)
-            rg_features = dict(features)
-            rg_features.update(additional_features)
-            resp =self.client.predict("35", rg_features)
-            params['rg_gp'] = [float(resp['candidates'][0]['Property rg_gp'][0])]
-            uncertainties['rg_gp'] = float(resp['candidates'][0]['Property rg_gp'][1])
-
-        return params,uncertainties
+        requests = OrderedDict([(k,[]) for k in ['r0_sphere','sigma_sphere','rg_gp']])
+        rows = OrderedDict([(k,[]) for k in requests.keys()])
+        for i,(populations,features,q_I) in enumerate(
+            zip(populations_list,features_list,q_I_list)):
+            if bool(populations['unidentified']):
+                continue
+            features = self.append_str_property(features)
+
+            if bool(populations['spherical_normal']):
+                requests['r0_sphere'].append(features)
+                rows['r0_sphere'].append(i)
+                additional_features = saxs_math.spherical_normal_profile(q_I)
+                additional_features = self.append_str_property(additional_features)
+                ss_features = OrderedDict(features)
+                ss_features.update(additional_features)
+                requests['sigma_sphere'].append(ss_features)
+                rows['sigma_sphere'].append(i)
+
+            if bool(populations['guinier_porod']):
+                additional_features = saxs_math.guinier_porod_profile(q_I)
+                additional_features = self.append_str_property(additional_features)
+                rg_features = dict(features)
+                rg_features.update(additional_features)
+                requests['rg_gp'].append(rg_features)
+                rows['rg_gp'].append(i)
+
+        resps = self._predict_many([(dataview_ids[k],cands) for k,cands in requests.items()])
+
+        params = [OrderedDict() for i in range(len(populations_list))]
+        uncertainties = [OrderedDict() for i in range(len(populations_list))]
+        # fill in row by row, to keep the parameter order of predict_params()
+        preds = OrderedDict([(k,OrderedDict(zip(rows[k],resp))) 
+            for k,resp in zip(requests.keys(),resps)])
+        for i in range(len(populations_list)):
+            for k,pred in preds.items():
+                if i in pred:
+                    params[i][k] = [float(pred[i]['Property '+k][0])]
+                    uncertainties[i][k] = float(pred[i]['Property '+k][1])
+        return params, uncertainties
+
+    def close(self):
+        """Close the threads used for concurrent requests, if any."""
+        if self._thread_pool is not None:
+            self._thread_pool.close()
+            self._thread_pool.join()
+            self._thread_pool = None
+
+    def _predict_many(self,requests):
+        # requests: list of (dataview_id, candidates) pairs.
+        # Candidates found in self.cache are not sent.
+        # The other candidates of each request are split into 
+        # batches of self.batch_size, and the batches of all requests 
+        # are sent together.
+        results = []
+        pending = []
+        for dataview_id,cands in requests:
+            if self.cache is not None:
+                preds = self.cache.get_many(dataview_id,cands)
+            else:
+                preds = [None]*len(cands)
+            results.append(preds)
+            pending.append([i for i,p in enumerate(preds) if p is None])
+        calls = []
+        for ireq,(dataview_id,cands) in enumerate(requests):
+            for i0 in range(0,len(pending[ireq]),self.batch_size):
+                idx = pending[ireq][i0:i0+self.batch_size]
+                calls.append((ireq,dataview_id,[cands[i] for i in idx]))
+        if self.n_threads > 1 and len(calls) > 1:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPool(self.n_threads)
+            resps = self._thread_pool.map(self._predict_call,calls)
+        else:
+            resps = [self._predict_call(c) for c in calls]
+        sent = [[] for req in requests]
+        for (ireq,dataview_id,cands),resp in zip(calls,resps):
+            sent[ireq].extend(resp)
+        for ireq,(dataview_id,cands) in enumerate(requests):
+            for i,pred in zip(pending[ireq],sent[ireq]):
+                results[ireq][i] = pred
+            if self.cache is not None and pending[ireq]:
+                self.cache.put_many(dataview_id,
+                    [cands[i] for i in pending[ireq]],sent[ireq])
+        return results
+
+    def _predict_call(self,call):
+        ireq, dataview_id, cands = call
+        resp = self.client.predict(dataview_id,cands)
+        if not len(resp['candidates']) == len(cands):
+            msg = 'Dataview {} returned {} predictions for {} candidates'.format(
+                dataview_id,len(resp['candidates']),len(cands))
+            raise RuntimeError(msg)
+        return resp['candidates']
@@ -2,23 +2,39 @@ from collections import OrderedDict
 import os
 
 import numpy as np
-import sklearn
-from sklearn import preprocessing,linear_model
-import yaml
 
-from . import saxs_fit
+from . import saxs_fit, model_bundle, linear_models
+from . import profile_keys
+from . import lazy_import
+
+sklearn = lazy_import('sklearn')
+preprocessing = lazy_import('sklearn.preprocessing')
+linear_model = lazy_import('sklearn.linear_model')
 
 class SaxsClassifier(object):
     """A classifier to determine scatterer populations from SAXS spectra"""
 
-    def __init__(self,yml_file=None):
+    def __init__(self,yml_file=None,engine='numpy'):
+        """Load the scalers and classification models.
+
+        Parameters
+        ----------
+        yml_file : str
+            Path to a YAML file of scalers and models
+            (see saxs_models.save_models()).
+            Default is the scalers_and_models.yml file 
+            in the modeling_data directory.
+        engine : str
+            'numpy' (default) evaluates the models 
+            with the classes of the linear_models module,
+            and 'sklearn' evaluates them with scikit-learn estimators.
+        """
         if yml_file is None:
             p = os.path.abspath(__file__)
             d = os.path.dirname(p)
             yml_file = os.path.join(d,'modeling_data','scalers_and_models.yml')
 
-        s_and_m_file = open(yml_file,'rb')
-        s_and_m = yaml.load(s_and_m_file)
+        s_and_m = model_bundle.load_models(yml_file)
 
         # dict of classification model parameters
         classifier_dict = s_and_m['models']
@@ -35,9 +51,15 @@ class SaxsClassifier(object):
             scaler_params = scalers_dict[model_name]
             acc = acc_dict[model_name]
             if scaler_params is not None:
-                s = preprocessing.StandardScaler()
+                if engine == 'sklearn':
+                    s = preprocessing.StandardScaler()
+                    m = linear_model.SGDClassifier()
+                elif engine == 'numpy':
+                    s = linear_models.LinearScaler()
+                    m = linear_models.LogisticClassifier()
+                else:
+                    raise RuntimeError('Unsupported engine: {}'.format(engine))
                 self.set_param(s,scaler_params)
-                m = linear_model.SGDClassifier()
                 self.set_param(m,model_params)
             self.models[model_name] = m
             self.scalers[model_name] = s
@@ -92,6 +114,58 @@ class SaxsClassifier(object):
 
         return populations, certainties
 
+    def classify_batch(self, sample_features):
+        """Classify many samples from a matrix of their features.
+
+        Each row is classified as in self.classify():
+        the populations other than 'unidentified'
+        are only evaluated for the rows that are not unidentified.
+
+        Parameters
+        ----------
+        sample_features : array or pandas.DataFrame
+            N-by-13 array of features, one row for each sample,
+            with columns in the order of profile_keys['unidentified'],
+            or a DataFrame with (at least) these columns
+
+        Returns
+        -------
+        populations : array
+            N-by-4 array of integers counting predicted scatterer populations,
+            with columns in the order of saxs_fit.population_keys.
+            For unidentified samples, the other populations are 0.
+        certainties : array
+            N-by-4 array, similar to `populations`,
+            but containing the certainty of each prediction.
+            For unidentified samples, the other certainties are NaN.
+        """
+        if hasattr(sample_features,'columns'):
+            sample_features = sample_features[profile_keys['unidentified']].values
+        feature_array = np.atleast_2d(np.asarray(sample_features,dtype=float))
+        nspec = feature_array.shape[0]
+        populations = np.zeros((nspec,len(saxs_fit.population_keys)),dtype=int)
+        certainties = np.full((nspec,len(saxs_fit.population_keys)),np.nan)
+
+        pop, cert = self._predict_batch('unidentified',feature_array)
+        populations[:,0] = pop
+        certainties[:,0] = cert
+
+        idx = np.nonzero(pop == 0)[0]
+        if len(idx) > 0:
+            for ik,k in enumerate(saxs_fit.population_keys):
+                if not k == 'unidentified':
+                    pop, cert = self._predict_batch(k,feature_array[idx])
+                    populations[idx,ik] = pop
+                    certainties[idx,ik] = cert
+
+        return populations, certainties
+
+    def _predict_batch(self, model_name, feature_array):
+        x = self.scalers[model_name].transform(feature_array)
+        pop = self.models[model_name].predict(x).astype(int)
+        cert = self.models[model_name].predict_proba(x)[np.arange(len(pop)),pop]
+        return pop, cert
+
     def get_accuracy(self):
         """Get accuracy for all classification models.
 
@@ -3,13 +3,18 @@ from __future__ import print_function
 import warnings
 from collections import OrderedDict
 from functools import partial
+import multiprocessing
 import copy
+import time
 
 import numpy as np
-import lmfit
 
-from . import saxs_math, peak_finder
+from . import saxs_math, peak_finder, peak_math
 from . import population_keys, parameter_keys
+from . import lazy_import
+
+lmfit = lazy_import('lmfit')
+optimize = lazy_import('scipy.optimize')
 
 param_defaults = OrderedDict(
     I0_floor = 0.,
@@ -35,6 +40,9 @@ param_limits = OrderedDict(
     I_pkcenter = (0.,None),
     pk_hwhm = (1.E-6,1.E-1))
 
+# parameters that enter saxs_math.compute_saxs() linearly
+intensity_param_keys = ['I0_floor','G_gp','I0_sphere','I_pkcenter']
+
 def update_params(p_old,p_new):
     for k,vals in p_new.items():
         npar = len(p_old[k])
@@ -46,7 +54,7 @@ def update_params(p_old,p_new):
 class SaxsFitter(object):
     """Container for handling SAXS spectrum parameter fitting."""
 
-    def __init__(self,q_I,populations,dI=None):
+    def __init__(self,q_I,populations,dI=None,ff_cache=False):
         """Initialize a SaxsFitter.
 
         Parameters
@@ -65,9 +73,20 @@ class SaxsFitter(object):
             If not provided, error-weighted fitting
             is performed using the square root of the intensity
             as the error estimate. 
+        ff_cache : bool or saxs_math.SphereFormFactorCache
+            If True, a saxs_math.SphereFormFactorCache is built 
+            for the q values of `q_I`, and used to evaluate 
+            spherical_normal populations during fitting.
+            A SphereFormFactorCache for the same q values
+            may also be provided, e.g. to share it among fitters.
         """
         self.populations = populations
         self.q = q_I[:,0]
+        if ff_cache is True:
+            ff_cache = saxs_math.SphereFormFactorCache(self.q)
+        elif ff_cache is False:
+            ff_cache = None
+        self.ff_cache = ff_cache
         self.I = q_I[:,1]
         self.idx_fit = (self.I>0)
         self.logI = np.empty(self.I.shape)
@@ -79,8 +98,154 @@ class SaxsFitter(object):
             self.dI = np.empty(self.I.shape)
             self.dI.fill(np.nan)
             self.dI[self.idx_fit] = np.sqrt(self.I[self.idx_fit])
+        self._compile_layout()
+
+    def _compile_layout(self):
+        """Compile self.populations into a flat parameter vector layout.
+
+        The parameter vector holds one float
+        for each parameter value in self.default_params(),
+        in the same order as self.lmfit_params().
+        """
+        self.param_slots = []
+        for pkey,pvals in self.default_params().items():
+            for i in range(len(pvals)):
+                self.param_slots.append((pkey,i))
+        self.param_names = [pkey+str(i) for pkey,i in self.param_slots]
+        self._slot_index = dict([(s,j) for j,s in enumerate(self.param_slots)])
+        # vector indices of the parameters of each population,
+        # in the order given by parameter_keys
+        self._term_slots = OrderedDict()
+        for p in population_keys:
+            self._term_slots[p] = []
+            if p == 'unidentified' or not bool(self.populations[p]):
+                continue
+            for i in range(self.populations[p]):
+                self._term_slots[p].append(tuple(
+                    [self._slot_index[(pk,i)] for pk in parameter_keys[p]]))
+        self._intensity_slots = [j for j,(pkey,i) in enumerate(self.param_slots)
+            if pkey in intensity_param_keys]
+
+    def params_to_vector(self,params):
+        """Pack a dict of params into a flat parameter vector.
+
+        Parameters
+        ----------
+        params : dict
+            Dict of scattering equation parameters,
+            with all of the entries of self.default_params().
+
+        Returns
+        -------
+        x : array
+            Array of parameter values,
+            in the order of self.param_slots.
+        """
+        saxs_math._check_params(self.populations,params)
+        return np.array([params[pkey][i] for pkey,i in self.param_slots],dtype=float)
+
+    def vector_to_params(self,x):
+        """Unpack a flat parameter vector into a dict of params.
+
+        Parameters
+        ----------
+        x : array
+            Array of parameter values,
+            in the order of self.param_slots.
+
+        Returns
+        -------
+        params : dict
+            Dict of scattering equation parameters.
+        """
+        p = self.default_params()
+        for (pkey,i),val in zip(self.param_slots,x):
+            p[pkey][i] = float(val)
+        return p
 
-    def fit(self,params=None,fixed_params=None,param_limits=None,error_weighted=True,objective='chi2log'):
+    def compute_intensity(self,x):
+        """Compute the intensity for a flat parameter vector.
+
+        This is the same computation as saxs_math.compute_saxs(),
+        without building or checking a dict of params.
+
+        Parameters
+        ----------
+        x : array
+            Array of parameter values,
+            in the order of self.param_slots.
+
+        Returns
+        -------
+        I : array
+            Array of computed intensities at self.q
+        """
+        I = np.zeros(len(self.q))
+        if len(self.param_slots) == 0:
+            return I
+        I += x[0]
+        for i_G,i_rg,i_D in self._term_slots['guinier_porod']:
+            I += saxs_math.guinier_porod(self.q,x[i_rg],x[i_D],x[i_G])
+        for i_I0,i_r0,i_sigma in self._term_slots['spherical_normal']:
+            I += x[i_I0]*saxs_math.spherical_normal_saxs(
+                self.q,x[i_r0],x[i_sigma],ff_cache=self.ff_cache)
+        for i_I,i_q,i_hwhm in self._term_slots['diffraction_peaks']:
+            I += x[i_I]*peak_math.voigt(self.q-x[i_q],x[i_hwhm],x[i_hwhm])
+        return I
+
+    def compute_intensity_jacobian(self,x):
+        """Compute the intensity and its derivatives for a flat parameter vector.
+
+        This is the same computation as saxs_math.compute_saxs_jacobian(),
+        without building a dict of params.
+
+        Parameters
+        ----------
+        x : array
+            Array of parameter values,
+            in the order of self.param_slots.
+
+        Returns
+        -------
+        I : array
+            Array of computed intensities at self.q
+        jac : array
+            Array of derivatives of `I`, with one row for each q value,
+            and one column for each entry of `x`
+        """
+        nq = len(self.q)
+        I = np.zeros(nq)
+        jac = np.zeros((nq,len(self.param_slots)))
+        if len(self.param_slots) == 0:
+            return I, jac
+        I += x[0]
+        jac[:,0] = 1.
+        for i_G,i_rg,i_D in self._term_slots['guinier_porod']:
+            I_gp, dI_drg, dI_dD, dI_dG = saxs_math.guinier_porod_derivatives(
+                self.q,x[i_rg],x[i_D],x[i_G])
+            I += I_gp
+            jac[:,i_G] = dI_dG
+            jac[:,i_rg] = dI_drg
+            jac[:,i_D] = dI_dD
+        for i_I0,i_r0,i_sigma in self._term_slots['spherical_normal']:
+            I_sph, dI_dr0, dI_dsigma = saxs_math.spherical_normal_saxs_derivatives(
+                self.q,x[i_r0],x[i_sigma])
+            I += x[i_I0]*I_sph
+            jac[:,i_I0] = I_sph
+            jac[:,i_r0] = x[i_I0]*dI_dr0
+            jac[:,i_sigma] = x[i_I0]*dI_dsigma
+        for i_I,i_q,i_hwhm in self._term_slots['diffraction_peaks']:
+            v, dv_dx, dv_dg, dv_dl = peak_math.voigt_derivatives(
+                self.q-x[i_q],x[i_hwhm],x[i_hwhm])
+            I += x[i_I]*v
+            jac[:,i_I] = v
+            jac[:,i_q] = -1*x[i_I]*dv_dx
+            jac[:,i_hwhm] = x[i_I]*(dv_dg+dv_dl)
+        return I, jac
+
+    def fit(self,params=None,fixed_params=None,param_limits=None,
+        error_weighted=True,objective='chi2log',method='nelder-mead',
+        separable=False):
         """Fit the SAXS spectrum, optionally holding some parameters fixed.
     
         Parameters
@@ -107,6 +272,20 @@ class SaxsFitter(object):
         objective : string
             Choice of objective function 
             (currently the only option is 'chi2log').
+        method : string
+            Choice of optimization method:
+            'nelder-mead' (default) minimizes the objective 
+            with lmfit's Nelder-Mead simplex,
+            'least_squares' minimizes the same objective
+            as a sum of squared residuals, by a bounded trust-region
+            method driven by the analytic Jacobian 
+            (see saxs_math.compute_saxs_jacobian()).
+        separable : bool
+            If True, the intensity parameters 
+            (see `intensity_param_keys`) that are not fixed
+            are solved in closed form at every step
+            (see self.solve_intensity_params()),
+            and the optimizer only moves the other parameters.
 
         Returns
         -------
@@ -131,21 +310,39 @@ class SaxsFitter(object):
         #print('obj_init: {}'.format(obj_init))
 
         lmf_params = self.lmfit_params(params,fixed_params,param_limits) 
-        lmf_res = lmfit.minimize(self.lmf_evaluate,
-            lmf_params,method='nelder-mead',
-            kws={'error_weighted':error_weighted})
-        p_opt = self.saxskit_params(lmf_res.params) 
+        linear_params = None
+        if separable:
+            linear_params = self.linear_params(lmf_params)
+            # the optimizer does not move the linear parameters
+            for pkey,i in linear_params.keys():
+                lmf_params[pkey+str(i)].vary = False
+        if method == 'nelder-mead':
+            linear_slots = None
+            if linear_params:
+                linear_slots = self._linear_slots(linear_params)
+            if any([p.vary for p in lmf_params.values()]):
+                lmf_res = lmfit.minimize(self.lmf_evaluate,
+                    lmf_params,method='nelder-mead',
+                    kws={'error_weighted':error_weighted,
+                    'linear_slots':linear_slots})
+                success = lmf_res.success
+                x_opt = self.lmfit_vector(lmf_res.params)
+            else:
+                # nothing for the simplex to move
+                success = True
+                x_opt = self.lmfit_vector(lmf_params)
+            if linear_slots is not None:
+                x_opt = self.solve_intensity_vector(
+                    x_opt,linear_slots,error_weighted)
+            p_opt = self.vector_to_params(x_opt)
+        elif method == 'least_squares':
+            success, p_opt = self.least_squares_fit(
+                lmf_params,error_weighted,linear_params)
+        else:
+            msg = 'Unsupported fitting method: {}'.format(method)
+            raise RuntimeError(msg)
 
-        rpt = OrderedDict()
-        rpt['success'] = lmf_res.success
-        rpt['initial_objective'] = obj_init 
-        fit_obj = self.lmf_evaluate(lmf_res.params,error_weighted)
-        rpt['final_objective'] = fit_obj 
-        I_opt = saxs_math.compute_saxs(self.q,self.populations,
-            self.saxskit_params(lmf_res.params)) 
-        I_bg = self.I - I_opt
-        snr = np.mean(I_opt)/np.std(I_bg) 
-        rpt['fit_snr'] = snr
+        rpt = self._fit_report(p_opt,success,obj_init,error_weighted)
 
         #print(p_opt)
         #print('obj_opt: {}'.format(obj_opt))
@@ -162,6 +359,17 @@ class SaxsFitter(object):
 
         return p_opt,rpt
 
+    def _fit_report(self,p_opt,success,obj_init,error_weighted=True):
+        rpt = OrderedDict()
+        rpt['success'] = success 
+        rpt['initial_objective'] = obj_init 
+        I_opt = self.compute_intensity(self.params_to_vector(p_opt))
+        rpt['final_objective'] = self._objective(I_opt,error_weighted)
+        I_bg = self.I - I_opt
+        snr = np.mean(I_opt)/np.std(I_bg) 
+        rpt['fit_snr'] = snr
+        return rpt
+
     def default_params(self):
         pkeys = []
         pd = OrderedDict()
@@ -175,8 +383,11 @@ class SaxsFitter(object):
                     pd[pk] = [float(param_defaults[pk]) for i in range(v)]
         return pd
 
-    def lmf_evaluate(self,lmf_params,error_weighted=True):
-        return self.evaluate(self.saxskit_params(lmf_params),error_weighted)
+    def lmf_evaluate(self,lmf_params,error_weighted=True,linear_slots=None):
+        x = self.lmfit_vector(lmf_params)
+        if linear_slots is not None:
+            x = self.solve_intensity_vector(x,linear_slots,error_weighted)
+        return self.evaluate_vector(x,error_weighted)
 
     def evaluate(self,params,error_weighted=True):
         """Evaluate the objective for a given dict of params.
@@ -194,8 +405,28 @@ class SaxsFitter(object):
         objective : float
             Value of the fitting objective for `param_dict`.
         """
-        I_comp = saxs_math.compute_saxs(
-            self.q,self.populations,params)
+        return self.evaluate_vector(self.params_to_vector(params),error_weighted)
+
+    def evaluate_vector(self,x,error_weighted=True):
+        """Evaluate the objective for a flat parameter vector.
+
+        Parameters
+        ----------
+        x : array
+            Array of parameter values,
+            in the order of self.param_slots.
+        error_weighted : bool
+            Flag for whether or not to weight the fit
+            by the intensity error estimate.
+
+        Returns
+        -------
+        objective : float
+            Value of the fitting objective for `x`.
+        """
+        return self._objective(self.compute_intensity(x),error_weighted)
+
+    def _objective(self,I_comp,error_weighted=True):
         #I_comp[I_comp<0.] = 1.E-12
         if error_weighted:
             obj = saxs_math.compute_chi2(
@@ -215,6 +446,334 @@ class SaxsFitter(object):
         #plt.show()
         return obj 
 
+    def residuals(self,params,error_weighted=True):
+        """Compute the residual vector for a given dict of params.
+
+        The sum of the squared residuals is the objective
+        computed by self.evaluate().
+
+        Parameters
+        ----------
+        params : dict
+            Dict of scattering equation parameters.
+        error_weighted : bool
+            Flag for whether or not to weight the residuals
+            by the intensity error estimate.
+
+        Returns
+        -------
+        res : array
+            Array of (weighted) differences in log(I) 
+            for all fitted q values.
+        """
+        return self.residual_vector(self.params_to_vector(params),error_weighted)
+
+    def residual_vector(self,x,error_weighted=True):
+        """Compute the residual vector for a flat parameter vector.
+
+        See self.residuals().
+        """
+        I_comp = self.compute_intensity(x)
+        res = np.log(I_comp[self.idx_fit]) - self.logI[self.idx_fit]
+        if error_weighted:
+            res = res*self._residual_weights()
+        return res
+
+    def residual_jacobian(self,params,error_weighted=True):
+        """Compute the Jacobian of self.residuals() for a given dict of params.
+
+        Parameters
+        ----------
+        params : dict
+            Dict of scattering equation parameters.
+        error_weighted : bool
+            Flag for whether or not to weight the residuals
+            by the intensity error estimate.
+
+        Returns
+        -------
+        jac : array
+            Array of derivatives of the residuals,
+            with one row for each fitted q value,
+            and one column for each parameter value in `params`,
+            in the same order as self.lmfit_params().
+        """
+        return self.residual_jacobian_vector(
+            self.params_to_vector(params),error_weighted)
+
+    def residual_jacobian_vector(self,x,error_weighted=True):
+        """Compute the Jacobian of self.residual_vector().
+
+        See self.residual_jacobian().
+        """
+        I_comp, jac = self.compute_intensity_jacobian(x)
+        jac = jac[self.idx_fit] / I_comp[self.idx_fit][:,np.newaxis]
+        if error_weighted:
+            jac = jac*self._residual_weights()[:,np.newaxis]
+        return jac
+
+    def _residual_weights(self):
+        w = self.dI[self.idx_fit]
+        return np.sqrt(w/np.sum(w))
+
+    def linear_params(self,lmf_params):
+        """Get the bounds of all varied intensity parameters.
+
+        Parameters
+        ----------
+        lmf_params : lmfit.Parameters
+            Parameters (initial values, bounds, and fixed flags), 
+            as built by self.lmfit_params().
+
+        Returns
+        -------
+        linear_params : dict
+            Dict of (lower,upper) bounds,
+            keyed by (parameter name, population index), 
+            for each intensity parameter that is varied in `lmf_params`.
+        """
+        linear_params = OrderedDict()
+        for pkey,pvals in self.default_params().items():
+            if pkey in intensity_param_keys:
+                for i in range(len(pvals)):
+                    par = lmf_params[pkey+str(i)]
+                    if par.vary:
+                        linear_params[(pkey,i)] = (par.min,par.max)
+        return linear_params
+
+    def _linear_slots(self,linear_params):
+        # vector indices and bounds of the solved intensity parameters,
+        # sorted by vector index
+        slots = sorted([(self._slot_index[k],bd) for k,bd in linear_params.items()],
+            key=lambda s: s[0])
+        idx = np.array([j for j,bd in slots],dtype=int)
+        lb = np.array([-np.inf if bd[0] is None else bd[0] for j,bd in slots],dtype=float)
+        ub = np.array([np.inf if bd[1] is None else bd[1] for j,bd in slots],dtype=float)
+        return idx, lb, ub
+
+    def intensity_basis(self,params,pkey,idx):
+        """Compute the intensity curve that is scaled by one intensity parameter.
+
+        Parameters
+        ----------
+        params : dict
+            Dict of scattering equation parameters.
+        pkey : str
+            Name of the intensity parameter (see `intensity_param_keys`).
+        idx : int
+            Index of the population for this parameter.
+
+        Returns
+        -------
+        I_basis : array
+            Intensity computed for a value of 1 
+            for the intensity parameter.
+        """
+        return self.intensity_basis_vector(
+            self.params_to_vector(params),self._slot_index[(pkey,idx)])
+
+    def intensity_basis_vector(self,x,islot):
+        """Compute the intensity curve that is scaled by one entry of a parameter vector.
+
+        Parameters
+        ----------
+        x : array
+            Array of parameter values,
+            in the order of self.param_slots.
+        islot : int
+            Index in `x` of an intensity parameter.
+
+        Returns
+        -------
+        I_basis : array
+            Intensity computed for a value of 1 
+            for the intensity parameter.
+        """
+        pkey,i = self.param_slots[islot]
+        if pkey == 'I0_floor':
+            return np.ones(self.q.shape)
+        elif pkey == 'G_gp':
+            i_G,i_rg,i_D = self._term_slots['guinier_porod'][i]
+            return saxs_math.guinier_porod(self.q,x[i_rg],x[i_D],1.)
+        elif pkey == 'I0_sphere':
+            i_I0,i_r0,i_sigma = self._term_slots['spherical_normal'][i]
+            return saxs_math.spherical_normal_saxs(
+                self.q,x[i_r0],x[i_sigma],ff_cache=self.ff_cache)
+        elif pkey == 'I_pkcenter':
+            i_I,i_q,i_hwhm = self._term_slots['diffraction_peaks'][i]
+            return peak_math.voigt(self.q-x[i_q],x[i_hwhm],x[i_hwhm])
+
+    def solve_intensity_params(self,params,linear_params=None,error_weighted=True,
+        max_iter=10,tol=1.E-6):
+        """Solve for intensity parameters by bounded linear least squares.
+
+        The intensity parameters (see `intensity_param_keys`)
+        scale fixed basis curves (see self.intensity_basis()).
+        The chi2log objective is first linearized as 
+        log(I_comp)-log(I) ~ (I_comp-I)/I,
+        so that the intensity parameters can be found 
+        by a bounded linear least squares solve
+        (scipy.optimize.lsq_linear).
+        This solution is refined by Gauss-Newton steps
+        on the chi2log objective, each of which is also 
+        a bounded linear least squares solve 
+        on the same basis curves.
+
+        Parameters
+        ----------
+        params : dict
+            Dict of scattering equation parameters.
+            The entries that are not solved for are held constant.
+        linear_params : dict
+            Dict of (lower,upper) bounds, keyed by 
+            (parameter name, population index),
+            for the intensity parameters to solve for
+            (see self.linear_params()).
+            If not provided, all intensity parameters are solved for,
+            within the bounds given by `param_limits`.
+        error_weighted : bool
+            Flag for whether or not to weight the fit
+            by the intensity error estimate.
+        max_iter : int
+            Maximum number of Gauss-Newton refinement steps.
+        tol : float
+            The refinement stops when no intensity parameter
+            changes by more than this fraction of its value.
+
+        Returns
+        -------
+        p_opt : dict
+            Copy of `params` with the solved intensity parameters.
+        """
+        if linear_params is None:
+            linear_params = OrderedDict()
+            for pkey,pvals in params.items():
+                if pkey in intensity_param_keys:
+                    for i in range(len(pvals)):
+                        linear_params[(pkey,i)] = param_limits[pkey]
+        if len(linear_params) == 0:
+            return copy.deepcopy(params)
+        x = self.solve_intensity_vector(self.params_to_vector(params),
+            self._linear_slots(linear_params),error_weighted,max_iter,tol)
+        return self.vector_to_params(x)
+
+    def solve_intensity_vector(self,x,linear_slots,error_weighted=True,
+        max_iter=10,tol=1.E-6):
+        """Solve for intensity parameters in a flat parameter vector.
+
+        See self.solve_intensity_params().
+
+        Parameters
+        ----------
+        x : array
+            Array of parameter values,
+            in the order of self.param_slots.
+        linear_slots : tuple
+            Tuple of (indices, lower bounds, upper bounds) 
+            of the entries of `x` to solve for.
+        error_weighted : bool
+            Flag for whether or not to weight the fit
+            by the intensity error estimate.
+        max_iter : int
+            Maximum number of Gauss-Newton refinement steps.
+        tol : float
+            The refinement stops when no intensity parameter
+            changes by more than this fraction of its value.
+
+        Returns
+        -------
+        x_opt : array
+            Copy of `x` with the solved intensity parameters.
+        """
+        idx, lb, ub = linear_slots
+        x_opt = np.array(x,dtype=float)
+        if len(idx) == 0:
+            return x_opt
+        # the intensity is linear in all intensity parameters:
+        # I_comp = sum_j x_j*basis_j
+        x_opt[idx] = 0.
+        A_all = np.array([self.intensity_basis_vector(x_opt,j)[self.idx_fit]
+            for j in self._intensity_slots]).T
+        I_const = np.dot(A_all,x_opt[self._intensity_slots])
+        A = A_all[:,[self._intensity_slots.index(j) for j in idx]]
+        I_fit = self.I[self.idx_fit]
+        w = 1.
+        if error_weighted:
+            w = self._residual_weights()
+        row_scl = w/I_fit
+        xl = optimize.lsq_linear(A*row_scl[:,np.newaxis],(I_fit-I_const)*row_scl,bounds=(lb,ub)).x
+        for it in range(max_iter):
+            # log(I_comp(x_new)) ~ log(I_comp(x)) + A*(x_new-x)/I_comp(x)
+            I_comp = np.maximum(I_const+np.dot(A,xl),1.E-300)
+            row_scl = w/I_comp
+            b = self.logI[self.idx_fit]-np.log(I_comp)+np.dot(A,xl)/I_comp
+            xl_new = optimize.lsq_linear(A*row_scl[:,np.newaxis],b*w,bounds=(lb,ub)).x
+            converged = np.all(np.abs(xl_new-xl) <= tol*np.abs(xl))
+            xl = xl_new
+            if converged:
+                break
+        x_opt[idx] = xl
+        return x_opt
+
+    def least_squares_fit(self,lmf_params,error_weighted=True,linear_params=None):
+        """Minimize the sum of squared residuals with an analytic Jacobian.
+
+        Only the parameters that are varied in `lmf_params`
+        are optimized, within the bounds given in `lmf_params`,
+        by scipy.optimize.least_squares (trust-region reflective).
+
+        Parameters
+        ----------
+        lmf_params : lmfit.Parameters
+            Parameters (initial values, bounds, and fixed flags), 
+            as built by self.lmfit_params().
+        error_weighted : bool
+            Flag for whether or not to weight the residuals
+            by the intensity error estimate.
+        linear_params : dict
+            Dict of bounds for intensity parameters 
+            that are solved in closed form at every step
+            (see self.solve_intensity_params()).
+            These should not be varied in `lmf_params`.
+
+        Returns
+        -------
+        success : bool
+            Flag indicating whether the optimizer converged.
+        p_opt : dict
+            Dict of optimized scattering equation parameters.
+        """
+        x = self.lmfit_vector(lmf_params)
+        linear_slots = None
+        if linear_params:
+            linear_slots = self._linear_slots(linear_params)
+        idx_vary = np.array([i for i,nm in enumerate(self.param_names) 
+            if lmf_params[nm].vary],dtype=int)
+        if len(idx_vary) == 0:
+            if linear_slots is not None:
+                x = self.solve_intensity_vector(x,linear_slots,error_weighted)
+            return True, self.vector_to_params(x)
+        lb = np.array([lmf_params[self.param_names[i]].min for i in idx_vary],dtype=float)
+        ub = np.array([lmf_params[self.param_names[i]].max for i in idx_vary],dtype=float)
+        lb[np.isnan(lb)] = -np.inf
+        ub[np.isnan(ub)] = np.inf
+        x0 = np.clip(x[idx_vary],lb,ub)
+
+        def full_vector(xv):
+            x[idx_vary] = xv
+            if linear_slots is not None:
+                # the solved intensity parameters are treated as constants
+                # in the Jacobian: at the solution of the linear subproblem,
+                # this gives the gradient of the reduced objective
+                return self.solve_intensity_vector(x,linear_slots,error_weighted)
+            return x
+
+        res = optimize.least_squares(
+            lambda xv: self.residual_vector(full_vector(xv),error_weighted),x0,
+            jac=lambda xv: self.residual_jacobian_vector(full_vector(xv),error_weighted)[:,idx_vary],
+            bounds=(lb,ub),method='trf',x_scale='jac')
+        return bool(res.success), self.vector_to_params(full_vector(res.x))
+
     def lmfit_params(self,params=None,fixed_params=None,param_bounds=None):
         # params
         p = self.default_params()
@@ -243,23 +802,47 @@ class SaxsFitter(object):
         return lmfp
 
     def saxskit_params(self,lmfit_params):
-        p = self.default_params()
-        for pkey,pvals in p.items():
-            for validx,val in enumerate(pvals):
-                p[pkey][validx] = float(lmfit_params[pkey+str(validx)].value)
-        return p
+        return self.vector_to_params(self.lmfit_vector(lmfit_params))
 
-    def fit_intensity_params(self,params):
-        """Fit the spectrum wrt only the intensity parameters."""
-        fp = self.default_params()
-        for k,v in fp.items():
-            if k in ['I0_floor','I0_sphere','G_gp','I_pkcenter']:
-                for idx in range(len(v)):
-                    v[idx] = False
-            else:
-                for idx in range(len(v)):
-                    v[idx] = True
-        return self.fit(params,fp)
+    def lmfit_vector(self,lmfit_params):
+        return np.array([lmfit_params[nm].value for nm in self.param_names],dtype=float)
+
+    def fit_intensity_params(self,params,error_weighted=True):
+        """Fit the spectrum wrt only the intensity parameters.
+
+        The intensity parameters are found by 
+        a bounded linear least squares solve,
+        refined by up to 10 Gauss-Newton steps
+        (see self.solve_intensity_params()).
+        The first solve minimizes a linearization of the 
+        chi2log objective, which is only accurate 
+        where the computed intensity is close to the data:
+        the refinement steps minimize chi2log itself,
+        and usually converge in a few steps.
+
+        Parameters
+        ----------
+        params : dict
+            Dict of scattering equation parameters (initial guess).
+        error_weighted : bool
+            Flag for whether or not the fit 
+            should be weighted by the intensity error estimates.
+
+        Returns
+        -------
+        p_opt : dict
+            Dict of SAXS equation parameters,
+            with optimized intensity parameters.
+        rpt : dict
+            Dict reporting quantities of interest
+            about the fit result.
+        """
+        if bool(self.populations['unidentified']):
+            return OrderedDict(),OrderedDict()
+        params = update_params(self.default_params(),params)
+        obj_init = self.evaluate(params,error_weighted)
+        p_opt = self.solve_intensity_params(params,None,error_weighted)
+        return p_opt, self._fit_report(p_opt,True,obj_init,error_weighted)
 
     def estimate_peak_params(self,params=None):
         if params is None:
@@ -296,6 +879,130 @@ class SaxsFitter(object):
                     npk += 1    
         return params
 
+def fit_batch(q_I_list,populations,params=None,fixed_params=None,param_limits=None,
+    dI=None,error_weighted=True,method='nelder-mead',separable=False,
+    n_processes=None,chunk_size=4,callback=None,pool=None):
+    """Fit many SAXS spectra, distributed over a process pool.
+
+    Each spectrum is fit by SaxsFitter.fit() in a worker process.
+    The spectra are submitted to the pool in chunks of `chunk_size`.
+    An exception raised while fitting one spectrum 
+    is recorded in the results for that spectrum,
+    and does not stop the rest of the batch.
+
+    Parameters
+    ----------
+    q_I_list : list
+        List of n-by-2 arrays of scattering vectors q (1/Angstrom)
+        and corresponding intensities (arbitrary units).
+    populations : dict or list
+        Populations dict (see SaxsFitter), 
+        either shared by all spectra,
+        or a list with one dict for each spectrum.
+    params : dict or list, optional
+        Initial parameters (see SaxsFitter.fit()),
+        either shared by all spectra, 
+        or a list with one dict (or None) for each spectrum.
+    fixed_params : dict or list, optional
+        Fixed parameters (see SaxsFitter.fit()),
+        shared or given for each spectrum, like `params`.
+    param_limits : dict or list, optional
+        Parameter limits (see SaxsFitter.fit()),
+        shared or given for each spectrum, like `params`.
+    dI : list, optional
+        List of intensity error estimates (see SaxsFitter),
+        with one array (or None) for each spectrum.
+    error_weighted : bool
+        Flag for whether or not the fits
+        should be weighted by the intensity error estimates.
+    method : string
+        Optimization method (see SaxsFitter.fit()).
+    separable : bool
+        Flag for solving the intensity parameters 
+        in closed form (see SaxsFitter.fit()).
+    n_processes : int, optional
+        Number of worker processes.
+        Default is the number of CPUs.
+        If 1, and `pool` is not provided, 
+        the fits are run in the calling process.
+    chunk_size : int
+        Number of spectra submitted to a worker at a time.
+    callback : callable, optional
+        Function that is called as callback(n_done,n_total,t_elapsed)
+        each time a chunk of fits is finished,
+        where `t_elapsed` is the time in seconds
+        since the batch was started.
+    pool : multiprocessing.Pool, optional
+        Pool of worker processes to use, 
+        e.g. to share one pool among many batches.
+        If not provided, a pool of `n_processes` 
+        workers is created and closed for this batch.
+
+    Returns
+    -------
+    results : list
+        List of (p_opt, rpt) tuples (see SaxsFitter.fit()),
+        in the same order as `q_I_list`.
+        If fitting a spectrum raised an exception,
+        its `p_opt` is an empty dict, 
+        and its `rpt` contains 'success' (False)
+        and 'error' (the exception type and message).
+    """
+    n_total = len(q_I_list)
+    items = []
+    for i,q_I in enumerate(q_I_list):
+        items.append((q_I,
+            _batch_item(populations,i),
+            _batch_item(params,i),
+            _batch_item(fixed_params,i),
+            _batch_item(param_limits,i),
+            _batch_item(dI,i,False)))
+    fit_kwargs = dict(error_weighted=error_weighted,
+        method=method,separable=separable)
+    chunks = [(items[i:i+chunk_size],fit_kwargs) 
+        for i in range(0,n_total,chunk_size)]
+
+    results = []
+    t0 = time.time()
+    if pool is None and n_processes == 1:
+        chunk_results = (_fit_chunk(ch) for ch in chunks)
+        own_pool = False
+    else:
+        own_pool = pool is None
+        if own_pool:
+            pool = multiprocessing.Pool(n_processes)
+        chunk_results = pool.imap(_fit_chunk,chunks)
+    try:
+        for res in chunk_results:
+            results.extend(res)
+            if callback is not None:
+                callback(len(results),n_total,time.time()-t0)
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+    return results
+
+def _batch_item(vals,idx,shared_dict=True):
+    # entries given as a single dict are shared by all spectra
+    if vals is None or (shared_dict and isinstance(vals,dict)):
+        return vals
+    return vals[idx]
+
+def _fit_chunk(chunk):
+    items, fit_kwargs = chunk
+    results = []
+    for q_I,pops,params,fixed_params,plims,dI in items:
+        try:
+            sxf = SaxsFitter(q_I,pops,dI)
+            results.append(sxf.fit(params,fixed_params,plims,**fit_kwargs))
+        except Exception as ex:
+            rpt = OrderedDict()
+            rpt['success'] = False
+            rpt['error'] = '{}: {}'.format(type(ex).__name__,ex)
+            results.append((OrderedDict(),rpt))
+    return results
+
 
 ## TODO: refactor this to new api.
 #    def MC_anneal_fit(self,params,stepsize,nsteps,T,fixed_params=None):
@@ -37,13 +37,23 @@ The supported populations and associated parameters are:
 
 """
 from collections import OrderedDict
+import hashlib
 
 import numpy as np
 
-from . import peak_math
+from . import peak_math, peak_finder
 from . import profile_keys, parameter_keys
+from . import lazy_import
 
-def compute_saxs(q,populations,params,check_params=True):
+linalg = lazy_import('scipy.linalg')
+
+# version of the profiling code 
+# (profile_spectrum(), detailed_profile(), and the functions they use):
+# increment it whenever a change affects the computed features,
+# so that stored features (see feature_store) are recomputed.
+feature_version = 1
+
+def compute_saxs(q,populations,params,check_params=True,ff_cache=None):
     """Compute a SAXS intensity spectrum.
 
     TODO: Document the equation.
@@ -62,6 +72,9 @@ def compute_saxs(q,populations,params,check_params=True):
     check_params : bool
         Whether or not to check `params` for consistency with `populations`.
         Default is True. Turn this to False when speed is needed. 
+    ff_cache : SphereFormFactorCache
+        optional cache of sphere form factor kernels for `q`,
+        used for evaluating spherical_normal populations
 
     Returns
     ------- 
@@ -86,7 +99,8 @@ def compute_saxs(q,populations,params,check_params=True):
             r0_sph = params['r0_sphere']
             sigma_sph = params['sigma_sphere']
             for isph in range(populations['spherical_normal']):
-                I_sph = spherical_normal_saxs(q,r0_sph[isph],sigma_sph[isph])
+                I_sph = spherical_normal_saxs(q,r0_sph[isph],sigma_sph[isph],
+                    ff_cache=ff_cache)
                 I += I0_sph[isph]*I_sph
         if bool(populations['diffraction_peaks']):
             I_pk = params['I_pkcenter']
@@ -97,6 +111,153 @@ def compute_saxs(q,populations,params,check_params=True):
                 I += I_pk[ipk]*I_voigt
     return I
 
+def compute_saxs_jacobian(q,populations,params):
+    """Compute a SAXS intensity spectrum and its parameter derivatives.
+
+    The derivatives are analytic, for all parameters 
+    of all populations (see saxs_fit.param_defaults).
+    For spherical_normal populations, the derivatives 
+    with respect to r0_sphere and sigma_sphere are derivatives 
+    of the size distribution integral, evaluated with 
+    the same sampling as spherical_normal_saxs().
+
+    Parameters
+    ----------
+    q : array
+        Array of q values at which saxs intensity should be computed.
+    populations : dict
+        Each entry is an integer representing the number 
+        of distinct populations of various types of scatterer. 
+    params : dict
+        Scattering equation parameters. 
+        Each entry is a list with one item for each 
+        of the corresponding populations.
+
+    Returns
+    ------- 
+    I : array
+        Array of scattering intensities for each of the input q values
+    dI : dict
+        Dict with the same structure as `params`,
+        where each entry is a list of arrays 
+        containing the derivative of `I` with respect to
+        the corresponding parameter
+    """
+    I = np.zeros(len(q))
+    dI = OrderedDict()
+    if bool(populations['unidentified']):
+        return I, dI
+    I = params['I0_floor'][0]*np.ones(len(q))
+    dI['I0_floor'] = [np.ones(len(q))]
+    if bool(populations['guinier_porod']):
+        for pk in parameter_keys['guinier_porod']:
+            dI[pk] = []
+        for igp in range(populations['guinier_porod']):
+            I_gp, dI_drg, dI_dD, dI_dG = guinier_porod_derivatives(
+                q,params['rg_gp'][igp],params['D_gp'][igp],params['G_gp'][igp])
+            I += I_gp
+            dI['G_gp'].append(dI_dG)
+            dI['rg_gp'].append(dI_drg)
+            dI['D_gp'].append(dI_dD)
+    if bool(populations['spherical_normal']):
+        for pk in parameter_keys['spherical_normal']:
+            dI[pk] = []
+        for isph in range(populations['spherical_normal']):
+            I0_sph = params['I0_sphere'][isph]
+            I_sph, dI_dr0, dI_dsigma = spherical_normal_saxs_derivatives(
+                q,params['r0_sphere'][isph],params['sigma_sphere'][isph])
+            I += I0_sph*I_sph
+            dI['I0_sphere'].append(I_sph)
+            dI['r0_sphere'].append(I0_sph*dI_dr0)
+            dI['sigma_sphere'].append(I0_sph*dI_dsigma)
+    if bool(populations['diffraction_peaks']):
+        for pk in parameter_keys['diffraction_peaks']:
+            dI[pk] = []
+        for ipk in range(populations['diffraction_peaks']):
+            I_pk = params['I_pkcenter'][ipk]
+            hwhm = params['pk_hwhm'][ipk]
+            v, dv_dx, dv_dg, dv_dl = peak_math.voigt_derivatives(
+                q-params['q_pkcenter'][ipk],hwhm,hwhm)
+            I += I_pk*v
+            dI['I_pkcenter'].append(v)
+            dI['q_pkcenter'].append(-1*I_pk*dv_dx)
+            dI['pk_hwhm'].append(I_pk*(dv_dg+dv_dl))
+    return I, dI
+
+def compute_saxs_batch(q,populations,params,chunk_size=8):
+    """Compute SAXS intensity spectra for many parameter sets at once.
+
+    Each of the N parameter sets is evaluated 
+    for the same `populations` and the same `q`.
+    All scattering terms are evaluated with array operations
+    across the whole batch.
+
+    Parameters
+    ----------
+    q : array
+        Array of q values at which saxs intensity should be computed.
+    populations : dict
+        Each entry is an integer representing the number 
+        of distinct populations of various types of scatterer. 
+    params : dict
+        Scattering equation parameters. 
+        Each entry is an array of shape (N, npop),
+        where npop is the number of corresponding populations.
+        If npop is 1, an array of shape (N,) is also accepted.
+    chunk_size : int
+        maximum number of parameter sets for which 
+        the spherical_normal terms are evaluated in one block
+
+    Returns
+    ------- 
+    I : array
+        N-by-len(q) array of scattering intensities,
+        one row for each parameter set
+    """
+    q = np.asarray(q,dtype=float)
+    I0_floor = _batch_param(params['I0_floor'],1)
+    I = np.zeros((I0_floor.shape[0],len(q)))
+    if bool(populations['unidentified']):
+        return I
+    I += I0_floor
+    if bool(populations['guinier_porod']):
+        npop = populations['guinier_porod']
+        rg_gp = _batch_param(params['rg_gp'],npop)
+        G_gp = _batch_param(params['G_gp'],npop)
+        D_gp = _batch_param(params['D_gp'],npop)
+        for igp in range(npop):
+            I += guinier_porod_batch(q,rg_gp[:,igp],D_gp[:,igp],G_gp[:,igp])
+    if bool(populations['spherical_normal']):
+        npop = populations['spherical_normal']
+        I0_sph = _batch_param(params['I0_sphere'],npop)
+        r0_sph = _batch_param(params['r0_sphere'],npop)
+        sigma_sph = _batch_param(params['sigma_sphere'],npop)
+        for isph in range(npop):
+            I_sph = spherical_normal_saxs_batch(q,
+                r0_sph[:,isph],sigma_sph[:,isph],chunk_size=chunk_size)
+            I += I0_sph[:,isph:isph+1]*I_sph
+    if bool(populations['diffraction_peaks']):
+        npop = populations['diffraction_peaks']
+        I_pk = _batch_param(params['I_pkcenter'],npop)
+        q_pk = _batch_param(params['q_pkcenter'],npop)
+        pk_hwhm = _batch_param(params['pk_hwhm'],npop)
+        for ipk in range(npop):
+            hwhm = pk_hwhm[:,ipk:ipk+1]
+            I_voigt = peak_math.voigt(q-q_pk[:,ipk:ipk+1],hwhm,hwhm)
+            I += I_pk[:,ipk:ipk+1]*I_voigt
+    return I
+
+def _batch_param(vals,npop):
+    """Cast a batch of parameter values to an (N, npop) float array."""
+    vals = np.asarray(vals,dtype=float)
+    if vals.ndim == 1:
+        vals = vals.reshape(-1,1)
+    if not vals.ndim == 2 or not vals.shape[1] == npop:
+        msg = 'Expected parameter values of shape (N, {}), '.format(npop)\
+            + 'but found shape {}'.format(vals.shape)
+        raise RuntimeError(msg)
+    return vals
+
 def _check_params(populations,params):
     """Ensure params are consistent with populations, else raise Exception."""
     for pop_key, npop in populations.items():
@@ -165,7 +326,8 @@ def g_of_r(q_I):
     r_max = r_pos[idx]
     return np.vstack([r_pos,fftampI_rpos]).T,r_max
 
-def spherical_normal_saxs(q,r0,sigma,sampling_width=3.5,sampling_step=0.1):
+def spherical_normal_saxs(q,r0,sigma,sampling_width=3.5,sampling_step=0.1,chunk_size=4096,
+    ff_cache=None,integration='rectangle',tolerance=1.E-4):
     """Compute SAXS intensity of a normally-distributed sphere population.
 
     The returned intensity is normalized 
@@ -175,6 +337,17 @@ def spherical_normal_saxs(q,r0,sigma,sampling_width=3.5,sampling_step=0.1):
     in steps of sampling_step*sigma*r0
     Additional info about sampling_width and sampling_step:
     https://github.com/scattering-central/saxskit/blob/adding_examples/examples/spherical_normal_saxs_benchmark.ipynb
+    Alternatively, with integration='gauss_hermite',
+    the distribution is integrated by Gauss-Hermite quadrature,
+    with the number of nodes chosen to meet `tolerance`
+    (see gauss_hermite_order()). If no supported number of nodes
+    meets `tolerance`, the sampling falls back to the rectangle rule.
+
+    The sampled radii and q values are broadcast 
+    into a (radius x q) array, so that the form factor
+    of the whole distribution is evaluated in one pass.
+    For long q arrays, the q values are processed
+    in blocks of `chunk_size` points to bound memory use.
 
     Originally contributed by Amanda Fournier.
 
@@ -190,6 +363,20 @@ def spherical_normal_saxs(q,r0,sigma,sampling_width=3.5,sampling_step=0.1):
         number of standard deviations of radius for sampling
     sampling_step : float
         fraction of standard deviation to use as sampling step size    
+    chunk_size : int
+        maximum number of q values to evaluate in one (radius x q) block
+    ff_cache : SphereFormFactorCache
+        optional cache of form factor kernels for the array `q`-
+        if provided, the form factors of polydisperse populations 
+        are taken from the cache instead of being computed directly
+    integration : str
+        scheme for integrating over the size distribution:
+        'rectangle' (default) samples the distribution 
+        according to `sampling_width` and `sampling_step`,
+        'gauss_hermite' uses Gauss-Hermite quadrature
+    tolerance : float
+        estimated relative quadrature error 
+        for integration='gauss_hermite'
 
     Returns
     -------
@@ -200,28 +387,556 @@ def spherical_normal_saxs(q,r0,sigma,sampling_width=3.5,sampling_step=0.1):
     q_nz = np.invert(q_zero) 
     I = np.zeros(q.shape)
     if sigma < 1E-9:
-        x = q*r0
+        # a single radius: the form factor is computed directly,
+        # because interpolated kernels would not resolve its zeros
         V_r0 = float(4)/3*np.pi*r0**3
-        I[q_nz] = V_r0**2 * (3.*(np.sin(x[q_nz])-x[q_nz]*np.cos(x[q_nz]))*x[q_nz]**-3)**2
+        I[q_nz] = V_r0**2 * sphere_form_factor(q[q_nz]*r0)
         I_zero = V_r0**2 
     else:
-        sigma_r = sigma*r0
-        dr = sigma_r*sampling_step
-        rmin = np.max([r0-sampling_width*sigma_r,dr])
-        rmax = r0+sampling_width*sigma_r
-        I_zero = 0
-        for ri in np.arange(rmin,rmax,dr):
-            xi = q*ri
-            V_ri = float(4)/3*np.pi*ri**3
-            # The normal-distributed density of particles with radius r_i:
-            rhoi = 1./(np.sqrt(2*np.pi)*sigma_r)*np.exp(-1*(r0-ri)**2/(2*sigma_r**2))
-            I_zero += V_ri**2 * rhoi*dr
-            I[q_nz] += V_ri**2 * rhoi*dr*(3.*(np.sin(xi[q_nz])-xi[q_nz]*np.cos(xi[q_nz]))*xi[q_nz]**-3)**2
+        if integration == 'rectangle':
+            r, w = normal_radius_samples(r0,sigma,sampling_width,sampling_step)
+        elif integration == 'gauss_hermite':
+            n_gh = gauss_hermite_order(2*np.sqrt(2)*np.max(q)*sigma*r0,tolerance)
+            if n_gh is None:
+                # the distribution is too broad for the available orders
+                r, w = normal_radius_samples(r0,sigma,sampling_width,sampling_step)
+            else:
+                r, w = gauss_hermite_radius_samples(r0,sigma,n_gh)
+        else:
+            msg = 'Unsupported integration scheme: {}'.format(integration)
+            raise RuntimeError(msg)
+        I_zero = np.sum(w)
+        if ff_cache is not None:
+            I[q_nz] = ff_cache.weighted_form_factor(q,r,w)[q_nz]
+        else:
+            I[q_nz] = weighted_sphere_form_factor(q[q_nz],r,w,chunk_size)
     if any(q_zero):
         I[q_zero] = I_zero
     I = I/I_zero 
     return I
 
+def spherical_normal_saxs_derivatives(q,r0,sigma,sampling_width=3.5,sampling_step=0.1):
+    """Compute spherical_normal_saxs() and its derivatives wrt r0 and sigma.
+
+    For sigma > 0, the intensity is a ratio of sums 
+    over the sampled radii: I(q) = N(q)/N(0).
+    The sampled radii r_k and their weights w_k 
+    are smooth functions of r0 and sigma
+    (for a fixed number of samples),
+    so N is differentiated term by term,
+    giving the exact derivatives of spherical_normal_saxs().
+    For a monodisperse population (sigma < 1E-9),
+    the derivative wrt r0 is taken directly from the form factor,
+    and the derivative wrt sigma is zero.
+
+    Parameters
+    ----------
+    q : array
+        array of scattering vector magnitudes
+    r0 : float
+        mean radius of the sphere population
+    sigma : float
+        fractional standard deviation of the sphere population radii
+    sampling_width : float
+        number of standard deviations of radius for sampling
+    sampling_step : float
+        fraction of standard deviation to use as sampling step size    
+
+    Returns
+    -------
+    I : array
+        Array of scattering intensities for each of the input q values
+    dI_dr0 : array
+        derivative of `I` with respect to `r0`
+    dI_dsigma : array
+        derivative of `I` with respect to `sigma`
+    """
+    q_zero = (q == 0)
+    q_nz = np.invert(q_zero) 
+    I = np.ones(q.shape)
+    dI_dr0 = np.zeros(q.shape)
+    dI_dsigma = np.zeros(q.shape)
+    if sigma < 1E-9:
+        I[q_nz], dF_dx = sphere_form_factor_derivative(q[q_nz]*r0)
+        dI_dr0[q_nz] = q[q_nz]*dF_dx
+    else:
+        r, w = normal_radius_samples(r0,sigma,sampling_width,sampling_step)
+        # r_k = rmin + k*dr, where dr = sampling_step*sigma*r0, and 
+        # rmin = r0*(1-sampling_width*sigma), or dr if that is smaller.
+        # w_k is proportional to r_k**6 * exp(-t_k**2/2),
+        # where t_k = (r_k-r0)/(sigma*r0).
+        clipped = r0-sampling_width*sigma*r0 < sampling_step*sigma*r0
+        t = (r-r0)/(sigma*r0)
+        dr_dr0 = r/r0
+        if clipped:
+            dr_dsigma = r/sigma
+        else:
+            dr_dsigma = (r-r0)/sigma
+        dt_dsigma = dr_dsigma/(sigma*r0) - t/sigma
+        dlogw_dr0 = 6.*dr_dr0/r
+        dlogw_dsigma = 6.*dr_dsigma/r - t*dt_dsigma
+        x = np.outer(r,q[q_nz])
+        F, dF_dx = sphere_form_factor_derivative(x)
+        dF_dr = dF_dx*q[q_nz]
+        N_zero = np.sum(w)
+        I[q_nz] = np.dot(w,F)/N_zero
+        dN_dr0 = np.dot(w*dlogw_dr0,F) + np.dot(w*dr_dr0,dF_dr)
+        dN_dsigma = np.dot(w*dlogw_dsigma,F) + np.dot(w*dr_dsigma,dF_dr)
+        dI_dr0[q_nz] = (dN_dr0 - I[q_nz]*np.sum(w*dlogw_dr0))/N_zero
+        dI_dsigma[q_nz] = (dN_dsigma - I[q_nz]*np.sum(w*dlogw_dsigma))/N_zero
+    return I, dI_dr0, dI_dsigma
+
+def normal_radius_samples(r0,sigma,sampling_width=3.5,sampling_step=0.1):
+    """Sample radii and weights for a normally-distributed sphere population.
+
+    The radii are sampled by a rectangle rule
+    from r0*(1-sampling_width*sigma) to r0*(1+sampling_width*sigma)
+    in steps of sampling_step*sigma*r0.
+    The weight of each radius is the normal density 
+    times the sampling step times the squared sphere volume, 
+    such that the weights sum to the unnormalized I(q=0).
+
+    Parameters
+    ----------
+    r0 : float
+        mean radius of the sphere population
+    sigma : float
+        fractional standard deviation of the sphere population radii
+    sampling_width : float
+        number of standard deviations of radius for sampling
+    sampling_step : float
+        fraction of standard deviation to use as sampling step size    
+
+    Returns
+    -------
+    r : array
+        array of sampled radii
+    w : array
+        array of weights for each of the sampled radii
+    """
+    sigma_r = sigma*r0
+    dr = sigma_r*sampling_step
+    rmin = np.max([r0-sampling_width*sigma_r,dr])
+    rmax = r0+sampling_width*sigma_r
+    r = np.arange(rmin,rmax,dr)
+    V_r = float(4)/3*np.pi*r**3
+    # The normal-distributed density of particles with radius r:
+    rho = 1./(np.sqrt(2*np.pi)*sigma_r)*np.exp(-1*(r0-r)**2/(2*sigma_r**2))
+    return r, V_r**2*rho*dr
+
+_hermgauss_nodes = {}
+_gauss_hermite_order_cache = {}
+gauss_hermite_orders = [4,6,8,10,12,16,20,24,32,40,48,64,80,96,128]
+
+def gauss_hermite_radius_samples(r0,sigma,n):
+    """Gauss-Hermite nodes and weights for a normally-distributed sphere population.
+
+    The radius is substituted as r = r0*(1+sqrt(2)*sigma*t),
+    so that the size distribution integral becomes 
+    a Gauss-Hermite integral over t.
+    Nodes at non-positive radii are discarded.
+    As in normal_radius_samples(), the weights include 
+    the squared sphere volume, such that they sum 
+    to the unnormalized I(q=0).
+
+    Parameters
+    ----------
+    r0 : float
+        mean radius of the sphere population
+    sigma : float
+        fractional standard deviation of the sphere population radii
+    n : int
+        number of quadrature nodes
+
+    Returns
+    -------
+    r : array
+        array of radii at the quadrature nodes
+    w : array
+        array of weights for each of the radii 
+    """
+    t, wt = _hermgauss(n)
+    r = r0+np.sqrt(2)*sigma*r0*t
+    V_r = float(4)/3*np.pi*r**3
+    idx_pos = (r > 0)
+    return r[idx_pos], (wt/np.sqrt(np.pi)*V_r**2)[idx_pos]
+
+def gauss_hermite_order(omega,tolerance=1.E-4):
+    """Choose a Gauss-Hermite quadrature order for an oscillating integrand.
+
+    The error is estimated by integrating exp(-t**2)*cos(w*t)
+    for several frequencies w up to `omega`.
+    The exact integral is sqrt(pi)*exp(-w**2/4),
+    and the error is taken relative to the integral of exp(-t**2).
+    For the sphere form factor, `omega` is 2*sqrt(2)*q_max*sigma*r0. 
+    The largest order is checked first, 
+    so that the fallback case is detected with a single estimate,
+    and the order chosen for each (omega, tolerance) is cached.
+
+    Parameters
+    ----------
+    omega : float
+        frequency of the fastest oscillation of the integrand in t
+    tolerance : float
+        estimated relative quadrature error 
+
+    Returns
+    -------
+    n : int
+        the smallest entry of `gauss_hermite_orders` 
+        that meets `tolerance`, or None if the largest one does not
+    """
+    key = (float(omega),float(tolerance))
+    if not key in _gauss_hermite_order_cache:
+        if len(_gauss_hermite_order_cache) >= 10000:
+            _gauss_hermite_order_cache.clear()
+        _gauss_hermite_order_cache[key] = _gauss_hermite_order(omega,tolerance)
+    return _gauss_hermite_order_cache[key]
+
+def _gauss_hermite_order(omega,tolerance):
+    w = np.linspace(0.,omega,17)[1:]
+    exact = np.exp(-w**2/4)
+    def meets_tolerance(n):
+        t, wt = _hermgauss(n)
+        err = np.abs(np.dot(np.cos(np.outer(w,t)),wt)/np.sqrt(np.pi)-exact)
+        return np.max(err) < tolerance
+    if not meets_tolerance(gauss_hermite_orders[-1]):
+        return None
+    for n in gauss_hermite_orders[:-1]:
+        if meets_tolerance(n):
+            return n
+    return gauss_hermite_orders[-1]
+
+def _hermgauss(n):
+    if not n in _hermgauss_nodes:
+        _hermgauss_nodes[n] = np.polynomial.hermite.hermgauss(n)
+    return _hermgauss_nodes[n]
+
+def weighted_sphere_form_factor(q,r,w,chunk_size=4096):
+    """Sum the sphere form factors of several radii, with weights.
+
+    Parameters
+    ----------
+    q : array
+        array of nonzero scattering vector magnitudes
+    r : array
+        array of sphere radii
+    w : array
+        array of weights, one for each entry of `r`
+    chunk_size : int
+        maximum number of q values to evaluate in one (radius x q) block
+
+    Returns
+    -------
+    I : array
+        Array of weighted form factor sums for each of the input q values
+    """
+    I = np.empty(q.shape)
+    chunk_size = max(int(chunk_size),1)
+    for i0 in range(0,len(q),chunk_size):
+        x = np.outer(r,q[i0:i0+chunk_size])
+        I[i0:i0+chunk_size] = np.dot(w,sphere_form_factor(x))
+    return I
+
+def sphere_form_factor(x):
+    """Compute the normalized sphere form factor (3(sin(x)-x*cos(x))/x**3)**2.
+
+    Parameters
+    ----------
+    x : array
+        array of nonzero values of q*r
+
+    Returns
+    -------
+    F : array
+        form factor values, same shape as `x`
+    """
+    F = 3.*(np.sin(x)-x*np.cos(x))/(x*x*x)
+    return F*F
+
+def sphere_form_factor_derivative(x):
+    """Compute the normalized sphere form factor and its derivative wrt x.
+
+    Parameters
+    ----------
+    x : array
+        array of nonzero values of q*r
+
+    Returns
+    -------
+    F : array
+        form factor values, same shape as `x`
+    dF_dx : array
+        derivative of the form factor with respect to `x`
+    """
+    sinx = np.sin(x)
+    g = 3.*(sinx-x*np.cos(x))/(x*x*x)
+    dg_dx = 3.*sinx/(x*x) - 3.*g/x
+    return g*g, 2.*g*dg_dx
+
+class SphereFormFactorCache(object):
+    """Cache of sphere form factor kernels for a fixed q-grid.
+
+    During a fit, the q-grid does not change,
+    and only the radii of the sphere populations move.
+    This cache stores form factor kernels F(q*r) 
+    on a logarithmic grid of radii,
+    with a relative spacing of `radius_resolution`.
+    The form factor at any radius is obtained 
+    by linear interpolation between the two nearest kernels.
+    Kernels are evicted in least-recently-used order
+    when more than `max_kernels` are stored, 
+    so that memory use is bounded by max_kernels*len(q) floats.
+    """
+
+    def __init__(self,q,radius_resolution=1.E-4,max_kernels=8192):
+        """Initialize a SphereFormFactorCache.
+
+        Parameters
+        ----------
+        q : array
+            array of scattering vector magnitudes 
+            for which the kernels are computed 
+        radius_resolution : float
+            relative spacing of the cached radii 
+        max_kernels : int
+            maximum number of kernels to keep in the cache
+        """
+        self.q = np.array(q,dtype=float)
+        self.radius_resolution = float(radius_resolution)
+        self.max_kernels = int(max_kernels)
+        self.hits = 0
+        self.misses = 0
+        self._dlogr = np.log1p(self.radius_resolution)
+        self._q_nz = (self.q != 0)
+        self.clear()
+
+    def matches(self,q):
+        """Check whether `q` is the q-grid of this cache."""
+        return q.shape == self.q.shape and np.array_equal(q,self.q)
+
+    def clear(self):
+        """Remove all kernels from the cache."""
+        # sorted radius keys of cached kernels, and their rows in self._K
+        self._keys = np.zeros(0,dtype=int)
+        self._slots = np.zeros(0,dtype=int)
+        self._K = np.zeros((0,len(self.q)))
+        self._last_used = np.zeros(0,dtype=int)
+        self._tick = 0
+
+    def weighted_form_factor(self,q,r,w):
+        """Sum the sphere form factors of several radii, with weights.
+
+        Parameters
+        ----------
+        q : array
+            array of scattering vector magnitudes- 
+            must be the same as the q-grid of the cache
+        r : array
+            array of sphere radii
+        w : array
+            array of weights, one for each entry of `r`
+
+        Returns
+        -------
+        I : array
+            Array of weighted form factor sums for each of the input q values
+            (with F(q=0) taken to be 1)
+        """
+        if not self.matches(q):
+            raise RuntimeError('The q values do not match '
+                'the q-grid of this SphereFormFactorCache')
+        r = np.asarray(r,dtype=float)
+        w = np.asarray(w,dtype=float)
+        # split each weight between the two nearest cached radii
+        u = np.log(r)/self._dlogr
+        k_lo = np.floor(u)
+        frac = u-k_lo
+        keys = np.hstack([k_lo,k_lo+1]).astype(int)
+        key_w = np.hstack([w*(1.-frac),w*frac])
+        ukeys, inv = np.unique(keys,return_inverse=True)
+        ukey_w = np.bincount(inv.ravel(),weights=key_w,minlength=len(ukeys))
+        return np.dot(ukey_w,self.get_kernels(ukeys))
+
+    def get_kernels(self,keys):
+        """Get the form factor kernels for an array of sorted, unique radius keys.
+
+        Key k corresponds to the radius exp(k*log(1+radius_resolution)).
+
+        Parameters
+        ----------
+        keys : array
+            sorted array of unique integer radius keys
+
+        Returns
+        -------
+        K : array
+            len(keys)-by-len(q) array of form factor kernels
+        """
+        self._tick += 1
+        slots = np.zeros(len(keys),dtype=int)
+        found = np.zeros(len(keys),dtype=bool)
+        if len(self._keys) > 0:
+            pos = np.minimum(np.searchsorted(self._keys,keys),len(self._keys)-1)
+            found = (self._keys[pos] == keys)
+            slots[found] = self._slots[pos[found]]
+            self._last_used[slots[found]] = self._tick
+        missing = np.invert(found)
+        n_miss = int(np.sum(missing))
+        self.hits += len(keys)-n_miss
+        self.misses += n_miss
+        if n_miss == 0:
+            return self._K[slots]
+        K_miss = self._compute_kernels(keys[missing])
+        if len(keys) > self.max_kernels:
+            # the requested kernels do not all fit in the cache: 
+            # serve the new ones directly, 
+            # rather than evicting kernels requested by this call
+            K = np.empty((len(keys),len(self.q)))
+            K[found] = self._K[slots[found]]
+            K[missing] = K_miss
+            return K
+        slots[missing] = self._free_slots(n_miss)
+        self._K[slots[missing]] = K_miss
+        self._last_used[slots[missing]] = self._tick
+        all_keys = np.hstack([self._keys,keys[missing]])
+        all_slots = np.hstack([self._slots,slots[missing]])
+        order = np.argsort(all_keys)
+        self._keys = all_keys[order]
+        self._slots = all_slots[order]
+        return self._K[slots]
+
+    def _compute_kernels(self,keys):
+        r = np.exp(keys*self._dlogr)
+        K = np.ones((len(keys),len(self.q)))
+        K[:,self._q_nz] = sphere_form_factor(np.outer(r,self.q[self._q_nz]))
+        return K
+
+    def _free_slots(self,n):
+        # evict least recently used kernels to make room for n new ones.
+        # Kernels hit by the current call were marked with the current tick,
+        # and get_kernels() requests at most max_kernels keys,
+        # so they are never among the evicted ones.
+        n_evict = len(self._keys)+n-self.max_kernels
+        if n_evict > 0:
+            idx_evict = np.argsort(self._last_used[self._slots],kind='stable')[:n_evict]
+            keep = np.ones(len(self._keys),dtype=bool)
+            keep[idx_evict] = False
+            self._keys = self._keys[keep]
+            self._slots = self._slots[keep]
+        # grow the kernel array if needed
+        n_slots = self._K.shape[0]
+        if len(self._keys)+n > n_slots:
+            n_slots_new = min(self.max_kernels,max(2*n_slots,len(self._keys)+n))
+            K = np.zeros((n_slots_new,len(self.q)))
+            K[:n_slots] = self._K
+            last_used = np.zeros(n_slots_new,dtype=int)
+            last_used[:n_slots] = self._last_used
+            self._K = K
+            self._last_used = last_used
+        in_use = np.zeros(self._K.shape[0],dtype=bool)
+        in_use[self._slots] = True
+        return np.where(np.invert(in_use))[0][:n]
+
+def spherical_normal_saxs_batch(q,r0,sigma,sampling_width=3.5,sampling_step=0.1,chunk_size=8):
+    """Compute SAXS intensities for many normally-distributed sphere populations.
+
+    This is the batched equivalent of spherical_normal_saxs():
+    each row of the result is normalized such that I(q=0) is equal to 1,
+    and each distribution is sampled with the same rectangle rule.
+    The radius samples of all rows are padded to a common length
+    (with zero weights), so that the whole batch is evaluated 
+    in (spectrum x radius x q) blocks of at most `chunk_size` spectra.
+
+    Parameters
+    ----------
+    q : array
+        array of scattering vector magnitudes
+    r0 : array
+        array of mean radii, one for each sphere population
+    sigma : array
+        array of fractional standard deviations of the population radii
+    sampling_width : float
+        number of standard deviations of radius for sampling
+    sampling_step : float
+        fraction of standard deviation to use as sampling step size    
+    chunk_size : int
+        maximum number of populations to evaluate in one block
+
+    Returns
+    -------
+    I : array
+        len(r0)-by-len(q) array of scattering intensities
+    """
+    q = np.asarray(q,dtype=float)
+    r0 = np.asarray(r0,dtype=float).ravel()
+    sigma = np.asarray(sigma,dtype=float).ravel()
+    r, w = normal_radius_samples_batch(r0,sigma,sampling_width,sampling_step)
+    q_zero = (q == 0)
+    q_nz = np.invert(q_zero)
+    q_nz_vals = q[q_nz]
+    I = np.zeros((len(r0),len(q)))
+    I_zero = np.sum(w,axis=1)
+    chunk_size = max(int(chunk_size),1)
+    for i0 in range(0,len(r0),chunk_size):
+        x = r[i0:i0+chunk_size,:,np.newaxis]*q_nz_vals
+        F = sphere_form_factor(x)
+        w_chunk = w[i0:i0+chunk_size,np.newaxis,:]
+        I[i0:i0+chunk_size,q_nz] = np.matmul(w_chunk,F)[:,0,:]
+    I[:,q_zero] = I_zero[:,np.newaxis]
+    return I/I_zero[:,np.newaxis]
+
+def normal_radius_samples_batch(r0,sigma,sampling_width=3.5,sampling_step=0.1):
+    """Sample radii and weights for many normally-distributed sphere populations.
+
+    Each row is sampled exactly as in normal_radius_samples().
+    Populations with sigma < 1E-9 are treated as monodisperse,
+    with a single sample at r0. 
+    Rows with fewer samples are padded by repeating r0 with zero weight.
+
+    Parameters
+    ----------
+    r0 : array
+        array of mean radii, one for each sphere population
+    sigma : array
+        array of fractional standard deviations of the population radii
+    sampling_width : float
+        number of standard deviations of radius for sampling
+    sampling_step : float
+        fraction of standard deviation to use as sampling step size    
+
+    Returns
+    -------
+    r : array
+        len(r0)-by-nr array of sampled radii
+    w : array
+        len(r0)-by-nr array of weights for each of the sampled radii
+    """
+    r0 = np.asarray(r0,dtype=float).ravel()
+    sigma = np.asarray(sigma,dtype=float).ravel()
+    mono = (sigma < 1E-9)
+    poly = np.invert(mono)
+    sigma_r = sigma[poly]*r0[poly]
+    dr = sigma_r*sampling_step
+    rmin = np.maximum(r0[poly]-sampling_width*sigma_r,dr)
+    rmax = r0[poly]+sampling_width*sigma_r
+    # number of samples, following the convention of np.arange 
+    nr = np.ceil((rmax-rmin)/dr).astype(int)
+    nr_max = max(np.max(nr) if len(nr) > 0 else 1,1)
+    r = np.zeros((len(r0),nr_max))
+    w = np.zeros((len(r0),nr_max))
+    r[mono] = r0[mono,np.newaxis]
+    w[mono,0] = 1.
+    k = np.arange(nr_max)
+    r_poly = rmin[:,np.newaxis]+k*dr[:,np.newaxis]
+    in_range = (k < nr[:,np.newaxis])
+    V_r = float(4)/3*np.pi*r_poly**3
+    rho = 1./(np.sqrt(2*np.pi)*sigma_r[:,np.newaxis])\
+        *np.exp(-1*(r0[poly,np.newaxis]-r_poly)**2/(2*sigma_r[:,np.newaxis]**2))
+    r[poly] = np.where(in_range,r_poly,r0[poly,np.newaxis])
+    w[poly] = np.where(in_range,V_r**2*rho*dr[:,np.newaxis],0.)
+    return r, w
+
 def guinier_porod(q,r_g,porod_exponent,guinier_factor):
     """Compute the Guinier-Porod small-angle scattering intensity.
     
@@ -262,6 +977,90 @@ def guinier_porod(q,r_g,porod_exponent,guinier_factor):
         I[idx_porod] = porod_factor * 1./(q[idx_porod]**porod_exponent)
     return I
 
+def guinier_porod_derivatives(q,r_g,porod_exponent,guinier_factor):
+    """Compute guinier_porod() and its derivatives wrt all three parameters.
+
+    The Guinier and Porod expressions are differentiated 
+    separately on either side of the splice point,
+    where the intensity is continuous.
+
+    Parameters
+    ----------
+    q : array
+        array of q values
+    r_g : float
+        radius of gyration
+    porod_exponent : float
+        high-q Porod's law exponent
+    guinier_factor : float
+        low-q Guinier prefactor (equal to intensity at q=0)
+
+    Returns
+    -------
+    I : array
+        Array of scattering intensities for each of the input q values
+    dI_drg : array
+        derivative of `I` with respect to `r_g`
+    dI_dD : array
+        derivative of `I` with respect to `porod_exponent`
+    dI_dG : array
+        derivative of `I` with respect to `guinier_factor`
+    """
+    D = porod_exponent
+    q_splice = 1./r_g * np.sqrt(3./2*D)
+    idx_guinier = (q <= q_splice)
+    idx_porod = (q > q_splice)
+    dI_drg = np.zeros(q.shape)
+    dI_dD = np.zeros(q.shape)
+    dI_dG = np.zeros(q.shape)
+    # Guinier equation:
+    q_g = q[idx_guinier]
+    dI_dG[idx_guinier] = np.exp(-1./3*q_g**2*r_g**2)
+    dI_drg[idx_guinier] = guinier_factor*dI_dG[idx_guinier]*(-2./3*q_g**2*r_g)
+    # Porod equation:
+    q_p = q[idx_porod]
+    dI_dG[idx_porod] = np.exp(-1./2*D) * (3./2*D)**(1./2*D) \
+                    * 1./(r_g**D) * 1./(q_p**D)
+    I_p = guinier_factor*dI_dG[idx_porod]
+    dI_drg[idx_porod] = -1.*D/r_g*I_p
+    dI_dD[idx_porod] = (0.5*np.log(3./2*D) - np.log(r_g*q_p))*I_p
+    I = guinier_factor*dI_dG
+    return I, dI_drg, dI_dD, dI_dG
+
+def guinier_porod_batch(q,r_g,porod_exponent,guinier_factor):
+    """Compute Guinier-Porod intensities for many parameter sets.
+
+    This is the batched equivalent of guinier_porod().
+
+    Parameters
+    ----------
+    q : array
+        array of q values
+    r_g : array
+        array of radii of gyration
+    porod_exponent : array
+        array of high-q Porod's law exponents
+    guinier_factor : array
+        array of low-q Guinier prefactors
+
+    Returns
+    -------
+    I : array
+        len(r_g)-by-len(q) array of scattering intensities
+    """
+    q = np.asarray(q,dtype=float)
+    r_g = np.asarray(r_g,dtype=float).reshape(-1,1)
+    D = np.asarray(porod_exponent,dtype=float).reshape(-1,1)
+    G = np.asarray(guinier_factor,dtype=float).reshape(-1,1)
+    q_splice = 1./r_g * np.sqrt(3./2*D)
+    idx_porod = (q > q_splice)
+    porod_factor = G*np.exp(-1./2*D) * (3./2*D)**(1./2*D) * 1./(r_g**D)
+    I = G * np.exp(-1./3*q**2*r_g**2)
+    # q values outside the porod region are replaced to avoid 0**-D
+    q_porod = np.where(idx_porod,q,1.)
+    I = np.where(idx_porod,porod_factor*1./(q_porod**D),I)
+    return I
+
 def fit_I0(q,I,order=4):
     """Find an estimate for I(q=0) by polynomial fitting.
     
@@ -287,6 +1086,36 @@ def fit_I0(q,I,order=4):
     I_at_0 = np.polyval(p_I0,-1*q_mean/q_std)*I_std+I_mean
     return I_at_0,p_I0
 
+def fit_I0_batch(q,I,order=4):
+    """Find estimates for I(q=0) for many spectra on a shared q-grid.
+
+    Performs the same fit as fit_I0() for each row of `I`
+    (see fit_with_slope_constraint_batch()).
+
+    Parameters
+    ----------
+    q : array
+        array of scattering vector magnitudes in 1/Angstrom,
+        shared by all spectra
+    I : array
+        N-by-len(q) array of intensities, one row for each spectrum
+
+    Returns
+    -------
+    I_at_0 : array
+        estimates of the intensity at q=0, one for each spectrum
+    p_I0 : array
+        N-by-`order` array of polynomial coefficients (numpy format)
+    """
+    I = np.atleast_2d(np.asarray(I,dtype=float))
+    q_s,q_mean,q_std = standardize_array(q)
+    I_mean = np.mean(I,axis=1)
+    I_std = np.std(I,axis=1)
+    I_s = (I-I_mean[:,np.newaxis])/I_std[:,np.newaxis]
+    p_I0 = fit_with_slope_constraint_batch(q_s,I_s,-1*q_mean/q_std,0,order)
+    I_at_0 = np.dot(p_I0,_vandermonde([-1*q_mean/q_std],order)[0,::-1])*I_std+I_mean
+    return I_at_0,p_I0
+
 def fit_with_slope_constraint(q,I,q_cons,dIdq_cons,order,weights=None):
     """Fit scattering data to a polynomial with one slope constraint.
 
@@ -322,22 +1151,86 @@ def fit_with_slope_constraint(q,I,q_cons,dIdq_cons,order,weights=None):
     p_fit : array
         polynomial coefficients for the fit of I(q) (numpy format)
     """
-    Ap = np.zeros( (order+1,order+1),dtype=float )
+    Ap = _slope_constraint_system(q,q_cons,order)
     b = np.zeros(order+1,dtype=float)
-    # TODO: vectorize the construction of Ap
-    for i in range(0,order):
-        for j in range(0,order):
-            Ap[i,j] = np.sum( q**j * q**i )
-        Ap[i,order] = -1*i*q_cons**(i-1)
-    for j in range(0,order):
-        Ap[order,j] = j*q_cons**(j-1)
-        b[j] = np.sum(I*q**j)
+    b[:order] = np.dot(I,_vandermonde(q,order))
     b[order] = dIdq_cons
     p_fit = np.linalg.solve(Ap,b) 
     p_fit = p_fit[:-1]  # throw away Lagrange multiplier term 
     p_fit = p_fit[::-1] # reverse coefs to get np.polyfit format
     return p_fit
 
+def fit_with_slope_constraint_batch(q,I,q_cons,dIdq_cons,order):
+    """Fit many spectra to polynomials with one slope constraint.
+
+    Solves the same problem as fit_with_slope_constraint()
+    for each row of `I`, with a single solve 
+    for all of the spectra. 
+    The factorization of the Lagrangian matrix,
+    which depends only on `q`, `q_cons`, and `order`,
+    is cached for re-use on the same q-grid.
+
+    Parameters
+    ----------
+    q : array
+        array of scattering vector magnitudes in 1/Angstrom,
+        shared by all spectra
+    I : array
+        N-by-len(q) array of intensities, one row for each spectrum
+    q_cons : float
+        q-value at which a slope constraint will be enforced
+        (see fit_with_slope_constraint())
+    dIdq_cons : float or array
+        slope (dI/dq) that will be enforced at `q_cons`,
+        either shared by all spectra or one for each spectrum
+    order : int
+        order of the polynomial to fit
+
+    Returns
+    -------
+    p_fit : array
+        N-by-`order` array of polynomial coefficients (numpy format),
+        one row for each spectrum
+    """
+    I = np.atleast_2d(np.asarray(I,dtype=float))
+    lu_piv = _slope_constraint_factors(q,q_cons,order)
+    b = np.zeros((order+1,I.shape[0]),dtype=float)
+    b[:order] = np.dot(_vandermonde(q,order).T,I.T)
+    b[order] = dIdq_cons
+    p_fit = linalg.lu_solve(lu_piv,b)
+    p_fit = p_fit[:-1]  # throw away Lagrange multiplier terms
+    return p_fit[::-1].T    # reverse coefs to get np.polyfit format
+
+def _vandermonde(q,order):
+    # columns q**0, q**1, ..., q**(order-1)
+    return np.vander(np.asarray(q,dtype=float),order,increasing=True)
+
+def _slope_constraint_system(q,q_cons,order):
+    # Lagrangian matrix for fit_with_slope_constraint():
+    # normal matrix of the polynomial fit,
+    # bordered by the derivative of the polynomial at q_cons
+    V = _vandermonde(q,order)
+    Ap = np.zeros( (order+1,order+1),dtype=float )
+    Ap[:order,:order] = np.dot(V.T,V)
+    pows = np.arange(order)
+    dcons = pows*np.float64(q_cons)**(pows-1)
+    Ap[:order,order] = -1*dcons
+    Ap[order,:order] = dcons
+    return Ap
+
+_slope_constraint_lu = OrderedDict()
+_slope_constraint_lu_size = 32
+
+def _slope_constraint_factors(q,q_cons,order):
+    q = np.ascontiguousarray(q,dtype=float)
+    key = (hashlib.sha1(q.tobytes()).hexdigest(),float(q_cons),int(order))
+    if not key in _slope_constraint_lu:
+        if len(_slope_constraint_lu) >= _slope_constraint_lu_size:
+            _slope_constraint_lu.popitem(last=False)
+        Ap = _slope_constraint_system(q,q_cons,order)
+        _slope_constraint_lu[key] = linalg.lu_factor(Ap)
+    return _slope_constraint_lu[key]
+
 def compute_Rsquared(y1,y2):
     """Compute the coefficient of determination.
 
@@ -550,6 +1443,126 @@ def profile_spectrum(q_I):
     features['pearson_invexpq'] = pearson_invexpq
     return features 
 
+def profile_spectrum_batch(q,I):
+    """Numerical profiling of many SAXS spectra on a shared q-grid.
+
+    Computes the same features as profile_spectrum(),
+    for each row of `I`, with array operations over the whole stack.
+
+    Parameters
+    ----------
+    q : array
+        array of scattering vector magnitudes, shared by all spectra
+    I : array
+        N-by-len(q) array of scattered intensities,
+        one row for each spectrum
+
+    Returns
+    -------
+    features : array
+        N-by-13 array of features, one row for each spectrum,
+        with columns in the order of profile_keys['unidentified']
+        (see profile_spectrum())
+    """
+    q = np.asarray(q,dtype=float)
+    I = np.atleast_2d(np.asarray(I,dtype=float))
+    nspec = I.shape[0]
+    rows = np.arange(nspec)
+    # I metrics
+    idxmax = np.argmax(I,axis=1)
+    I_min = np.min(I,axis=1)
+    I_max = I[rows,idxmax]
+    q_Imax = q[idxmax]
+    I_range = I_max - I_min
+    I_mean = np.mean(I,axis=1)
+    Imax_over_Imean = I_max/I_mean
+    # log(I) metrics, on the points where I>0
+    nz = I>0
+    logI = np.full(I.shape,np.nan)
+    logI[nz] = np.log(I[nz])
+    logI_max = np.nanmax(logI,axis=1)
+    logI_min = np.nanmin(logI,axis=1)
+    logI_range = logI_max - logI_min
+    logI_std = np.nanstd(logI,axis=1)
+    logI_max_over_std = logI_max / logI_std
+    # I_max peak shape analysis
+    idx_around_max = ((q > 0.9*q_Imax[:,np.newaxis]) & (q < 1.1*q_Imax[:,np.newaxis]))
+    Imean_around_max = np.sum(I*idx_around_max,axis=1)/np.sum(idx_around_max,axis=1)
+    Imax_sharpness = I_max / Imean_around_max
+
+    ### integration and intensity centroid
+    dq = q[1:] - q[:-1]
+    qcenter = 0.5 * (q[1:] + q[:-1])
+    Itrap = 0.5 * (I[:,1:] + I[:,:-1])
+    I_qint = np.dot(Itrap,dq)
+    qI_qint = np.dot(Itrap,qcenter*dq)
+    q_Icentroid = qI_qint / I_qint
+    # same thing for log(I): each point where I>0 
+    # closes a trapezoid that starts at the previous point where I>0
+    iq = np.arange(len(q))
+    idx_prev = np.maximum.accumulate(np.where(nz,iq,-1),axis=1)
+    idx_prev = np.hstack((np.full((nspec,1),-1),idx_prev[:,:-1]))
+    seg = nz & (idx_prev >= 0)
+    idx_prev[np.invert(seg)] = 0
+    dq_nz = np.where(seg,q-q[idx_prev],0.)
+    qcenter_nz = 0.5 * (q + q[idx_prev])
+    logItrap_nz = np.where(seg,0.5 * (logI + logI[rows[:,np.newaxis],idx_prev]),0.)
+    logI_qint_nz = np.sum(dq_nz*logItrap_nz,axis=1)
+    qlogI_qint_nz = np.sum(qcenter_nz*dq_nz*logItrap_nz,axis=1)
+    q_logIcentroid = qlogI_qint_nz / logI_qint_nz
+
+    ### fluctuation analysis
+    nn_diff = I[:,1:]-I[:,:-1]
+    I_fluctuation = np.dot(np.abs(nn_diff),dq)/I_range
+    # keep indices where the sign of this difference changes.
+    # also keep first index
+    nn_diff_prod = nn_diff[:,1:]*nn_diff[:,:-1]
+    idx_keep = np.hstack((np.ones((nspec,1),dtype=bool),nn_diff_prod<0))
+    fluc = np.sum(np.abs(nn_diff)*idx_keep,axis=1)
+    logI_fluctuation = fluc/logI_range
+
+    ### correlation analysis
+    I_c = I - I_mean[:,np.newaxis]
+    I_norm = np.sqrt(np.sum(I_c**2,axis=1))
+    def batch_pearson(x):
+        x_c = x - np.mean(x)
+        return np.dot(I_c,x_c)/(np.sqrt(np.sum(x_c**2))*I_norm)
+    pearson_q = batch_pearson(q)
+    pearson_q2 = batch_pearson(q**2)
+    pearson_expq = batch_pearson(np.exp(q))
+    pearson_invexpq = batch_pearson(np.exp(-1*q))
+
+    ### fourier analysis
+    fftampI = np.abs(np.fft.fft(I,axis=1))
+    r = np.fft.fftfreq(q.shape[-1])
+    idx_rpos = (r>0)
+    r_pos = r[idx_rpos]
+    fftampI_rpos = fftampI[:,idx_rpos]
+
+    dr_pos = r_pos[1:] - r_pos[:-1]
+    rcenter = 0.5 * (r_pos[1:] + r_pos[:-1])
+    fftItrap = 0.5 * (fftampI_rpos[:,1:] + fftampI_rpos[:,:-1])
+    fftI_rint = np.dot(fftItrap,dr_pos)
+    rfftI_rint = np.dot(fftItrap,rcenter*dr_pos)
+    r_fftIcentroid = rfftI_rint / fftI_rint 
+    r_fftImax = r_pos[np.argmax(fftampI_rpos,axis=1)]
+
+    features = OrderedDict.fromkeys(profile_keys['unidentified'])
+    features['Imax_over_Imean'] = Imax_over_Imean
+    features['Imax_sharpness'] = Imax_sharpness
+    features['I_fluctuation'] = I_fluctuation
+    features['logI_fluctuation'] = logI_fluctuation
+    features['logI_max_over_std'] = logI_max_over_std
+    features['r_fftIcentroid'] = r_fftIcentroid
+    features['r_fftImax'] = r_fftImax
+    features['q_Icentroid'] = q_Icentroid
+    features['q_logIcentroid'] = q_logIcentroid
+    features['pearson_q'] = pearson_q 
+    features['pearson_q2'] = pearson_q2
+    features['pearson_expq'] = pearson_expq
+    features['pearson_invexpq'] = pearson_invexpq
+    return np.array(list(features.values())).T
+
 def guinier_porod_profile(q_I):
     """Numerical profiling of guinier_porod scattering intensities.
 
@@ -629,14 +1642,7 @@ def spherical_normal_profile(q_I):
     Iqqqq = I*q**4
     # Window width for determining local extrema: 
     w = 10
-    idxmax1, idxmin1 = 0,0
-    stop_idx = len(q)-w-1
-    test_range = np.arange(w,stop_idx)
-    for idx in test_range:
-        if np.argmax(Iqqqq[idx-w:idx+w+1]) == w and idxmax1 == 0:
-            idxmax1 = idx
-        if np.argmin(Iqqqq[idx-w:idx+w+1]) == w and idxmin1 == 0 and not idxmax1 == 0:
-            idxmin1 = idx
+    idxmax1, idxmin1 = peak_finder.first_window_max_min(Iqqqq,w)
     if idxmin1 == 0 or idxmax1 == 0:
         return features 
     #######
@@ -669,6 +1675,24 @@ def spherical_normal_profile(q_I):
     features['pI_qwidth'] = pI_fwidth*q_min1_std
     return features 
 
+def spectrum_hash(q_I):
+    """Get a hash of the content of a spectrum.
+
+    Parameters
+    ----------
+    q_I : array
+        n-by-2 array of scattering vector (1/Angstrom) and intensities.
+
+    Returns
+    -------
+    h : str
+        sha1 hex digest of the shape and the float64 values of `q_I`.
+    """
+    q_I = np.ascontiguousarray(q_I,dtype=np.float64)
+    h = hashlib.sha1(str(q_I.shape).encode('utf-8'))
+    h.update(q_I.tobytes())
+    return h.hexdigest()
+
 def standardize_array(x):
     xmean = np.mean(x)
     xstd = np.std(x)
@@ -1,19 +1,30 @@
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import functools
 import os
+import sys
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-import pandas as pd
 import numpy as np
-import sklearn
 import yaml
-from citrination_client import PifSystemReturningQuery, DatasetQuery, DataQuery, Filter
-from sklearn import model_selection, preprocessing, linear_model
-from sklearn.metrics import mean_absolute_error
 
-from . import saxs_math
 from . import saxs_piftools
+from .feature_store import compute_features
+from . import lazy_import
 from . import population_keys, parameter_keys, profile_keys
 from . import all_profile_keys, all_parameter_keys
 
+pd = lazy_import('pandas')
+sklearn = lazy_import('sklearn')
+model_selection = lazy_import('sklearn.model_selection')
+preprocessing = lazy_import('sklearn.preprocessing')
+linear_model = lazy_import('sklearn.linear_model')
+metrics = lazy_import('sklearn.metrics')
+
 def train_classifiers(all_data, hyper_parameters_search=False, model= 'all'):
     """Train SAXS classification models, optionally searching for optimal hyperparameters.
 
@@ -631,28 +642,148 @@ def testing_by_experiments(df, label, features, alpha, l1_ratio, penalty):
     return acc
 
 
-def get_pifs_from_Citrination(client, dataset_id_list):
-    all_hits = []
-    for dataset in dataset_id_list:
-        query = PifSystemReturningQuery(
-            from_index=0,
-            size=100,
-            query=DataQuery(
-                dataset=DatasetQuery(
-                    id=Filter(
-                    equal=dataset))))
-
-        current_result = client.search(query)
-        while current_result.hits is not None:
-            all_hits.extend(current_result.hits)
-            n_current_hits = len(current_result.hits)
-            #n_hits += n_current_hits
-            query.from_index += n_current_hits 
-            current_result = client.search(query)
-
-    pifs = [x.system for x in all_hits]
+def get_pifs_from_Citrination(client, dataset_id_list, n_threads=4, page_size=100,
+    max_retries=3, backoff=1.):
+    """Get all PIF records of a list of Citrination datasets.
+
+    The pages of search results are fetched concurrently
+    (see iter_pifs_from_Citrination()).
+
+    Parameters
+    ----------
+    client : citrination_client.CitrinationClient
+        A python Citrination client for fetching data
+    dataset_id_list : list of int
+        List of dataset ids (integers) for fetching SAXS records
+    n_threads : int
+        Maximum number of search requests in flight at once.
+    page_size : int
+        Number of records requested by each search.
+    max_retries : int
+        Number of times a failed search is retried.
+    backoff : float
+        Time in seconds to wait before the first retry
+        of a failed search. The wait is doubled for each retry.
+
+    Returns
+    -------
+    pifs : list
+        List of pypif.obj.System objects,
+        in the order of `dataset_id_list`,
+        and in the order of the search results within each dataset.
+    """
+    pages = list(iter_pif_pages(client,dataset_id_list,
+        n_threads,page_size,max_retries,backoff))
+    pages.sort(key=lambda pg: (pg[0],pg[2]))
+    pifs = [x for pg in pages for x in pg[3]]
     return pifs
 
+def iter_pifs_from_Citrination(client, dataset_id_list, n_threads=4, page_size=100,
+    max_retries=3, backoff=1.):
+    """Lazily get the PIF records of a list of Citrination datasets.
+
+    The records are yielded as the pages of search results arrive,
+    so the order of the records is not deterministic.
+    See get_pifs_from_Citrination() for the parameters.
+
+    Returns
+    -------
+    pifs : generator
+        Generator of pypif.obj.System objects.
+    """
+    for idataset,dataset,from_index,pifs in iter_pif_pages(client,
+        dataset_id_list,n_threads,page_size,max_retries,backoff):
+        for pp in pifs:
+            yield pp
+
+def iter_pif_pages(client, dataset_id_list, n_threads=4, page_size=100,
+    max_retries=3, backoff=1.):
+    """Lazily get the pages of search results for a list of Citrination datasets.
+
+    Up to `n_threads` page searches are in flight at once,
+    spread over the datasets.
+    Since the number of records in a dataset is not known in advance,
+    pages are requested at increasing offsets
+    until a page with less than `page_size` records is returned.
+    Searches that fail with network or Citrination client errors
+    are retried with exponential backoff,
+    and other errors are raised without retrying.
+    See get_pifs_from_Citrination() for the parameters.
+
+    Returns
+    -------
+    pages : generator
+        Generator of (dataset_index, dataset_id, from_index, pifs) tuples,
+        in order of arrival, where `dataset_index` is the index 
+        of the dataset in `dataset_id_list`,
+        and `pifs` is a list of pypif.obj.System objects.
+    """
+    arrived = queue.Queue()
+    next_index = [0]*len(dataset_id_list)
+    end_index = [None]*len(dataset_id_list)
+    pool = ThreadPool(n_threads)
+    n_in_flight = 0
+    n_submitted = 0
+    try:
+        while True:
+            # keep the pool busy with the next pages of the unfinished datasets
+            unfinished = [i for i,end in enumerate(end_index) if end is None]
+            while unfinished and n_in_flight < n_threads:
+                idataset = unfinished[n_submitted % len(unfinished)]
+                kwargs = {'callback':arrived.put}
+                if _has_error_callback:
+                    kwargs['error_callback'] = functools.partial(
+                        _put_page_error,arrived,idataset,next_index[idataset])
+                pool.apply_async(_fetch_pif_page,(client,idataset,
+                    dataset_id_list[idataset],next_index[idataset],
+                    page_size,max_retries,backoff),**kwargs)
+                next_index[idataset] += page_size
+                n_in_flight += 1
+                n_submitted += 1
+            if n_in_flight == 0:
+                return
+            page_idataset, from_index, hits, ex = arrived.get()
+            n_in_flight -= 1
+            if ex is not None:
+                raise ex
+            if len(hits) < page_size:
+                end = from_index+len(hits)
+                if end_index[page_idataset] is None or end < end_index[page_idataset]:
+                    end_index[page_idataset] = end
+            if hits:
+                yield (page_idataset,dataset_id_list[page_idataset],
+                    from_index,[x.system for x in hits])
+    finally:
+        pool.terminate()
+
+def _fetch_pif_page(client,idataset,dataset,from_index,page_size,max_retries,backoff):
+    import citrination_client
+    from citrination_client import PifSystemReturningQuery, DatasetQuery, DataQuery, Filter
+    # network errors and errors reported by the client are retried,
+    # other errors are reported at once (see iter_pif_pages())
+    retry_errors = (IOError,getattr(citrination_client,'CitrinationClientError',IOError))
+    query = PifSystemReturningQuery(
+        from_index=from_index,
+        size=page_size,
+        query=DataQuery(
+            dataset=DatasetQuery(
+                id=Filter(
+                equal=dataset))))
+    for attempt in range(max_retries+1):
+        try:
+            result = client.search(query)
+            return idataset, from_index, result.hits or [], None
+        except retry_errors as ex:
+            if attempt == max_retries:
+                return idataset, from_index, None, ex
+            time.sleep(backoff*2**attempt)
+
+# python 2 pools do not take an error_callback
+_has_error_callback = sys.version_info[0] > 2
+
+def _put_page_error(arrived,idataset,from_index,ex):
+    arrived.put((idataset,from_index,None,ex))
+
 def testing_by_experiments_regression(df, label, features, alpha, l1_ratio,
                                       penalty, loss, epsilon, label_std):
     """Fit a model, then test it by leaveTwoGroupsOut cross-validation
@@ -692,13 +823,14 @@ def testing_by_experiments_regression(df, label, features, alpha, l1_ratio,
                                         epsilon = epsilon, max_iter=1000)
             reg.fit(tr[features], tr[label])
             pr = reg.predict(test[features])
-            test_score = mean_absolute_error(pr, test[label])
+            test_score = metrics.mean_absolute_error(pr, test[label])
             test_scores_by_ex.append(test_score/label_std)
             count +=1
     normalized_error =  sum(test_scores_by_ex)/count
     return normalized_error
 
-def get_data_from_Citrination(client, dataset_id_list):
+def get_data_from_Citrination(client, dataset_id_list, mirror=None, sync=True,
+    feature_store=None):
     """Get data from Citrination and create a dataframe.
 
     Parameters
@@ -707,6 +839,18 @@ def get_data_from_Citrination(client, dataset_id_list):
         A python Citrination client for fetching data
     dataset_id_list : list of int
         List of dataset ids (integers) for fetching SAXS records
+    mirror : pif_mirror.PifMirror, optional
+        Local mirror of the datasets.
+        If provided, the records are loaded from the mirror.
+    sync : bool
+        If True and `mirror` is provided, 
+        the mirror is first updated from Citrination 
+        (see pif_mirror.PifMirror.sync()).
+        If False, `client` is not used.
+    feature_store : feature_store.FeatureStore, optional
+        Store of spectrum features.
+        If provided, only the spectra whose features 
+        are not in the store are profiled.
 
     Returns
     -------
@@ -715,42 +859,77 @@ def get_data_from_Citrination(client, dataset_id_list):
         obtained through `client` from the Citrination datasets
         listed in `dataset_id_list`
     """
-    data = []
-
-    pifs = get_pifs_from_Citrination(client,dataset_id_list)
-
-    for pp in pifs:
-        feats = OrderedDict.fromkeys(all_profile_keys)
-        pops = OrderedDict.fromkeys(population_keys)
-        par = OrderedDict.fromkeys(all_parameter_keys)
-        expt_id,t_utc,q_I,temp,pif_feats,pif_pops,pif_par,rpt = saxs_piftools.unpack_pif(pp)
-        feats.update(saxs_math.profile_spectrum(q_I))
-        feats.update(saxs_math.detailed_profile(q_I,pif_pops))
-        pops.update(pif_pops)
-        par.update(pif_par)
-        param_list = []
-        for k in par.keys():
-            if par[k] is not None:
-                val = par[k][0]
-            else:
-                val = None
-            param_list.append(val)
-
-        data_row = [expt_id]+list(feats.values())+list(pops.values())+param_list
-        data.append(data_row)
+    if mirror is not None:
+        if sync:
+            mirror.sync(client,dataset_id_list)
+        pifs = mirror.get_pifs(dataset_id_list)
+    else:
+        pifs = get_pifs_from_Citrination(client,dataset_id_list)
 
-    colnames = ['experiment_id']
-    colnames.extend(all_profile_keys)
-    colnames.extend(population_keys)
-    colnames.extend(all_parameter_keys)
+    records = [saxs_piftools.unpack_pif(pp) for pp in pifs]
+    if feature_store is not None:
+        all_feats = feature_store.features_batch(
+            [rec[2] for rec in records],[rec[5] for rec in records])
+    else:
+        all_feats = [compute_features(rec[2],rec[5]) for rec in records]
 
-    d = pd.DataFrame(data=data, columns=colnames)
-    d = d.where((pd.notnull(d)), None) # replace all NaN by None
+    d = training_dataframe(records,all_feats)
     shuffled_rows = np.random.permutation(d.index)
     df_work = d.loc[shuffled_rows]
 
     return df_work
 
+def training_dataframe(records, features_list):
+    """Assemble a dataframe of features and labels, column by column.
+
+    Numerical columns are typed: the features and parameters are float64,
+    and the populations are int64
+    (or float64, if any population is missing).
+    Missing values are NaN.
+
+    Parameters
+    ----------
+    records : list
+        list of unpacked PIF records (see saxs_piftools.unpack_pif())
+    features_list : list
+        list of features dicts, one for each record,
+        with (at least) all of `all_profile_keys`
+        (see feature_store.compute_features())
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        dataframe with columns 'experiment_id',
+        `all_profile_keys`, `population_keys`, and `all_parameter_keys`,
+        and one row for each record
+    """
+    nrec = len(records)
+    # None is converted to NaN by the float64 arrays
+    feats = np.array([[f[k] for k in all_profile_keys] for f in features_list],
+        dtype=np.float64).reshape(nrec,len(all_profile_keys))
+    pops = np.array([[rec[5].get(k) for k in population_keys] for rec in records],
+        dtype=np.float64).reshape(nrec,len(population_keys))
+    # parameters are sparse: only fill in the ones that are present
+    params = np.full((nrec,len(all_parameter_keys)),np.nan)
+    param_idx = dict([(k,ik) for ik,k in enumerate(all_parameter_keys)])
+    for irec,rec in enumerate(records):
+        for k,v in rec[6].items():
+            if v and k in param_idx:
+                params[irec,param_idx[k]] = v[0]
+
+    columns = OrderedDict()
+    columns['experiment_id'] = [rec[0] for rec in records]
+    for ik,k in enumerate(all_profile_keys):
+        columns[k] = feats[:,ik]
+    for ik,k in enumerate(population_keys):
+        if np.any(np.isnan(pops[:,ik])):
+            columns[k] = pops[:,ik]
+        else:
+            columns[k] = pops[:,ik].astype(np.int64)
+    for ik,k in enumerate(all_parameter_keys):
+        columns[k] = params[:,ik]
+    return pd.DataFrame(columns)
+
 def train_classifiers_partial(new_data, file_path=None, all_training_data=None, model='all'):
     """Read SAXS classification models from a YAML file, then update them with new data.
 
@@ -1,10 +1,12 @@
 from collections import OrderedDict
 
 import numpy as np
-import pypif.obj as pifobj
 
 from . import saxs_math, saxs_fit, saxs_classify
 from . import all_parameter_keys
+from . import lazy_import
+
+pifobj = lazy_import('pypif.obj')
 
 parameter_description = OrderedDict.fromkeys(all_parameter_keys)
 parameter_description['I0_floor'] = 'flat background intensity'
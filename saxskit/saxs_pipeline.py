@@ -0,0 +1,466 @@
+"""Modules for processing streams of SAXS spectra."""
+from __future__ import print_function
+from collections import OrderedDict, deque
+import os
+import glob
+import multiprocessing
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+from . import saxs_math, saxs_fit
+from . import profile_keys
+from .saxs_classify import SaxsClassifier
+from .saxs_regression import SaxsRegressor
+
+# stages of SaxsPipeline, in order of execution
+pipeline_stages = ['load','profile','classify','regress','fit']
+
+_end_of_stream = object()
+
+# models of a SaxsPipeline worker process
+_worker_models = None
+
+def iter_spectrum_paths(paths):
+    """Lazily iterate over spectrum file paths.
+
+    Parameters
+    ----------
+    paths : str or iterable
+        A directory (all *.csv files in it are used),
+        a glob pattern, or an iterable of file paths.
+
+    Returns
+    -------
+    path_iter : iterator
+        Iterator over file paths.
+    """
+    if isinstance(paths,str):
+        if os.path.isdir(paths):
+            paths = os.path.join(paths,'*.csv')
+        return glob.iglob(paths)
+    return iter(paths)
+
+def load_spectra(paths,delimiter=',',read_ahead=0):
+    """Lazily load spectra from files.
+
+    Parameters
+    ----------
+    paths : str or iterable
+        Spectrum files, as accepted by iter_spectrum_paths().
+        Each file holds an n-by-2 array of q and I.
+    delimiter : str
+        Column delimiter of the spectrum files.
+    read_ahead : int
+        If nonzero, the files are loaded in a background thread,
+        which reads ahead by at most `read_ahead` spectra.
+
+    Returns
+    -------
+    spectra : generator
+        Generator of (path, q_I) tuples.
+    """
+    paths = iter_spectrum_paths(paths)
+    if not read_ahead:
+        return ((path,np.loadtxt(path,dtype=float,delimiter=delimiter))
+            for path in paths)
+    return _read_ahead(paths,delimiter,read_ahead)
+
+def _read_ahead(paths,delimiter,read_ahead):
+    loaded = queue.Queue(maxsize=read_ahead)
+    stop = threading.Event()
+
+    def load():
+        try:
+            for path in paths:
+                if stop.is_set():
+                    return
+                loaded.put((path,np.loadtxt(path,dtype=float,delimiter=delimiter),None))
+        except Exception as ex:
+            loaded.put((None,None,ex))
+        loaded.put(_end_of_stream)
+
+    loader = threading.Thread(target=load)
+    loader.daemon = True
+    loader.start()
+    try:
+        while True:
+            item = loaded.get()
+            if item is _end_of_stream:
+                break
+            path, q_I, ex = item
+            if ex is not None:
+                raise ex
+            yield path, q_I
+    finally:
+        stop.set()
+        # unblock the loader if it is waiting on a full queue
+        while loader.is_alive():
+            try:
+                loaded.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+def profile_spectra(paths,populations=None,chunk_size=None,read_ahead=8,delimiter=','):
+    """Lazily profile spectra from files.
+
+    The spectra are loaded (see load_spectra()),
+    profiled by saxs_math.profile_spectrum(),
+    and, if `populations` is provided,
+    by saxs_math.detailed_profile(),
+    one at a time as the results are consumed,
+    so that memory use does not grow with the number of files.
+
+    Parameters
+    ----------
+    paths : str or iterable
+        Spectrum files, as accepted by iter_spectrum_paths().
+    populations : dict, optional
+        Populations dict (see saxs_math module documentation).
+        If provided, the features of saxs_math.detailed_profile()
+        are also computed.
+    chunk_size : int, optional
+        If provided, lists of `chunk_size` results are yielded.
+        The spectra of a chunk that share the same q values
+        are profiled together by saxs_math.profile_spectrum_batch().
+    read_ahead : int
+        Maximum number of spectra loaded ahead of the profiling
+        (see load_spectra()).
+    delimiter : str
+        Column delimiter of the spectrum files.
+
+    Returns
+    -------
+    results : generator
+        Generator of (path, features) tuples,
+        where `features` is a dict of profile features,
+        or, if `chunk_size` is provided,
+        a generator of lists of such tuples.
+    """
+    spectra = load_spectra(paths,delimiter,read_ahead)
+    if chunk_size:
+        return (_profile_chunk(chunk,populations)
+            for chunk in _chunks(spectra,chunk_size))
+    return (_profile_one(path,q_I,populations) for path,q_I in spectra)
+
+def _profile_one(path,q_I,populations=None):
+    features = saxs_math.profile_spectrum(q_I)
+    if populations is not None:
+        features.update(saxs_math.detailed_profile(q_I,populations))
+    return path, features
+
+def _profile_chunk(chunk,populations=None):
+    q = chunk[0][1][:,0]
+    if not all([q_I.shape == chunk[0][1].shape
+        and np.array_equal(q_I[:,0],q) for path,q_I in chunk]):
+        return [_profile_one(path,q_I,populations) for path,q_I in chunk]
+    feats = saxs_math.profile_spectrum_batch(q,
+        np.array([q_I[:,1] for path,q_I in chunk]))
+    results = []
+    for (path,q_I),f in zip(chunk,feats):
+        features = OrderedDict(zip(profile_keys['unidentified'],f))
+        if populations is not None:
+            features.update(saxs_math.detailed_profile(q_I,populations))
+        results.append((path,features))
+    return results
+
+def _chunks(items,chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class SaxsPipeline(object):
+    """Pipeline for analyzing streams of SAXS spectra.
+
+    Each spectrum is profiled (saxs_math.profile_spectrum()),
+    classified (SaxsClassifier), its scattering parameters
+    are predicted (SaxsRegressor), and its intensity parameters
+    are fit (SaxsFitter.fit_intensity_params()).
+    The spectra are processed in chunks: 
+    the profiling, classification, and regression stages 
+    are evaluated for a whole chunk at a time,
+    and the chunks are distributed over a pool of worker processes,
+    each of which loads the models once.
+    The time spent in each stage is accumulated in self.stats.
+    """
+
+    def __init__(self,classifier_file=None,regressor_file=None,engine='numpy',
+        fit_intensity=True,n_processes=None,chunk_size=16,max_pending=None):
+        """Initialize a SaxsPipeline.
+
+        Parameters
+        ----------
+        classifier_file : str, optional
+            YAML file of classification models (see SaxsClassifier).
+        regressor_file : str, optional
+            YAML file of regression models (see SaxsRegressor).
+        engine : str
+            Engine for evaluating the models (see SaxsClassifier).
+        fit_intensity : bool
+            If False, the fit stage is skipped,
+            and the predicted parameters are reported as they are.
+        n_processes : int, optional
+            Number of worker processes.
+            Default is the number of CPUs.
+            If 1, the spectra are processed in the calling process.
+        chunk_size : int
+            Number of spectra processed together.
+        max_pending : int, optional
+            Maximum number of chunks submitted to the workers
+            ahead of the results that have been consumed.
+            Default is twice the number of workers.
+        """
+        self.classifier_file = classifier_file
+        self.regressor_file = regressor_file
+        self.engine = engine
+        self.fit_intensity = fit_intensity
+        self.n_processes = n_processes
+        self.chunk_size = chunk_size
+        if max_pending is None:
+            max_pending = 2*(n_processes or multiprocessing.cpu_count())
+        self.max_pending = max_pending
+        self._pool = None
+        self._models = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset the timing statistics in self.stats.
+
+        self.stats contains 'n_spectra' (number of spectra processed),
+        'wall_time' (seconds spent in self.run()),
+        'model_load_time' (seconds spent loading models,
+        summed over all workers), and 'stage_times',
+        a dict of seconds spent in each of `pipeline_stages`,
+        summed over all workers.
+        """
+        self.stats = OrderedDict()
+        self.stats['n_spectra'] = 0
+        self.stats['wall_time'] = 0.
+        self.stats['model_load_time'] = 0.
+        self.stats['stage_times'] = OrderedDict.fromkeys(pipeline_stages,0.)
+
+    def throughput(self):
+        """Get the throughput of the pipeline and of its stages.
+
+        Returns
+        -------
+        throughput : dict
+            Dict of spectra processed per second:
+            'total' is based on the wall time of the pipeline,
+            and the other entries are based on the time spent 
+            in each of `pipeline_stages`.
+        """
+        n = self.stats['n_spectra']
+        tput = OrderedDict()
+        tput['total'] = _rate(n,self.stats['wall_time'])
+        for stg,t in self.stats['stage_times'].items():
+            tput[stg] = _rate(n,t)
+        return tput
+
+    def run(self,spectra):
+        """Lazily analyze a stream of spectra.
+
+        Parameters
+        ----------
+        spectra : iterable
+            Iterable of (path, q_I) tuples,
+            e.g. the output of load_spectra(),
+            where `path` identifies the spectrum,
+            and `q_I` is an n-by-2 array of q and I.
+
+        Returns
+        -------
+        results : generator
+            Generator of (path, result) tuples,
+            in the same order as `spectra`,
+            where `result` is a dict with entries 
+            'features', 'populations', 'certainties', 
+            'params', and 'report'
+            (see saxs_math.profile_spectrum(), 
+            SaxsClassifier.classify(), 
+            and SaxsFitter.fit_intensity_params()).
+        """
+        t0 = time.time()
+        wall0 = self.stats['wall_time']
+        chunks = self._timed_chunks(spectra)
+        if self.n_processes == 1:
+            if self._models is None:
+                self._models = _load_models(self.classifier_file,
+                    self.regressor_file,self.engine)
+            for chunk in chunks:
+                results, times = _process_chunk(self._models,chunk,self.fit_intensity)
+                # the model loading time is reported with the first chunk only
+                self._models = self._models[:2]+(0.,)
+                for res in self._collect(results,times,t0,wall0):
+                    yield res
+            return
+        pool = self._get_pool()
+        pending = deque()
+        try:
+            for chunk in chunks:
+                pending.append(pool.apply_async(_worker_chunk,((chunk,self.fit_intensity),)))
+                if len(pending) >= self.max_pending:
+                    results, times = pending.popleft().get()
+                    for res in self._collect(results,times,t0,wall0):
+                        yield res
+            while pending:
+                results, times = pending.popleft().get()
+                for res in self._collect(results,times,t0,wall0):
+                    yield res
+        finally:
+            # wait for abandoned chunks, so that the pool stays usable
+            for r in pending:
+                r.wait()
+
+    def run_files(self,paths,read_ahead=8,delimiter=','):
+        """Lazily analyze spectra from files.
+
+        Parameters
+        ----------
+        paths : str or iterable
+            Spectrum files, as accepted by iter_spectrum_paths().
+        read_ahead : int
+            Maximum number of spectra loaded ahead of the analysis
+            (see load_spectra()).
+        delimiter : str
+            Column delimiter of the spectrum files.
+
+        Returns
+        -------
+        results : generator
+            Generator of (path, result) tuples (see self.run()).
+        """
+        return self.run(load_spectra(paths,delimiter,read_ahead))
+
+    def close(self):
+        """Close the worker processes, if any."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.n_processes,_init_worker,
+                (self.classifier_file,self.regressor_file,self.engine))
+        return self._pool
+
+    def _timed_chunks(self,spectra):
+        # chunks of spectra, timing the loading stage
+        spectra = iter(spectra)
+        while True:
+            t0 = time.time()
+            chunk = []
+            for path_q_I in spectra:
+                chunk.append(path_q_I)
+                if len(chunk) == self.chunk_size:
+                    break
+            self.stats['stage_times']['load'] += time.time()-t0
+            if not chunk:
+                return
+            yield chunk
+            if len(chunk) < self.chunk_size:
+                return
+
+    def _collect(self,results,times,t0,wall0):
+        self.stats['model_load_time'] += times.pop('models',0.)
+        for stg,t in times.items():
+            self.stats['stage_times'][stg] += t
+        self.stats['n_spectra'] += len(results)
+        self.stats['wall_time'] = wall0+time.time()-t0
+        return results
+
+def _rate(n,t):
+    if t > 0:
+        return n/t
+    return float('nan')
+
+def _load_models(classifier_file,regressor_file,engine):
+    t0 = time.time()
+    classifier = SaxsClassifier(classifier_file,engine)
+    regressor = SaxsRegressor(regressor_file,engine)
+    return classifier, regressor, time.time()-t0
+
+def _init_worker(classifier_file,regressor_file,engine):
+    global _worker_models
+    _worker_models = _load_models(classifier_file,regressor_file,engine)
+
+def _worker_chunk(args):
+    global _worker_models
+    chunk, fit_intensity = args
+    results, times = _process_chunk(_worker_models,chunk,fit_intensity)
+    # the model loading time is reported with the first chunk only
+    _worker_models = _worker_models[:2]+(0.,)
+    return results, times
+
+def _process_chunk(models,chunk,fit_intensity=True):
+    classifier, regressor, t_load = models
+    times = OrderedDict()
+    if t_load:
+        times['models'] = t_load
+
+    t0 = time.time()
+    profiled = _profile_chunk(chunk)
+    feature_array = np.array([list(f.values()) for path,f in profiled])
+    t1 = time.time()
+    times['profile'] = t1-t0
+
+    pops, certs = classifier.classify_batch(feature_array)
+    populations = []
+    certainties = []
+    for pop_row,cert_row in zip(pops,certs):
+        # only 'unidentified' is reported for unidentified spectra,
+        # as in SaxsClassifier.classify()
+        nkeys = 1 if pop_row[0] else len(saxs_fit.population_keys)
+        populations.append(OrderedDict([(k,int(p)) for k,p 
+            in zip(saxs_fit.population_keys[:nkeys],pop_row[:nkeys])]))
+        certainties.append(OrderedDict([(k,float(c)) for k,c 
+            in zip(saxs_fit.population_keys[:nkeys],cert_row[:nkeys])]))
+    t2 = time.time()
+    times['classify'] = t2-t1
+
+    params = regressor.predict_params_batch(pops,feature_array,
+        [q_I for path,q_I in chunk])
+    t3 = time.time()
+    times['regress'] = t3-t2
+
+    reports = []
+    for i,((path,q_I),pop) in enumerate(zip(chunk,populations)):
+        rpt = OrderedDict()
+        if fit_intensity and not pop['unidentified']:
+            try:
+                sxf = saxs_fit.SaxsFitter(q_I,pop)
+                params[i], rpt = sxf.fit_intensity_params(params[i])
+            except Exception as ex:
+                rpt['success'] = False
+                rpt['error'] = '{}: {}'.format(type(ex).__name__,ex)
+        reports.append(rpt)
+    times['fit'] = time.time()-t3
+
+    results = []
+    for (path,features),pop,cert,p,rpt in zip(profiled,populations,
+        certainties,params,reports):
+        res = OrderedDict()
+        res['features'] = features
+        res['populations'] = pop
+        res['certainties'] = cert
+        res['params'] = p
+        res['report'] = rpt
+        results.append((path,res))
+    return results, times
@@ -2,25 +2,40 @@ import os
 import copy
 from collections import OrderedDict
 
-import yaml
 import numpy as np
-from sklearn import preprocessing,linear_model
 
-from . import saxs_math, saxs_fit
-from . import parameter_keys, all_parameter_keys 
+from . import saxs_math, saxs_fit, model_bundle, linear_models
+from . import parameter_keys, all_parameter_keys, profile_keys
 from . import peak_math, peak_finder
+from . import lazy_import
+
+preprocessing = lazy_import('sklearn.preprocessing')
+linear_model = lazy_import('sklearn.linear_model')
 
 class SaxsRegressor(object):
     """A set of regression models to be used on SAXS spectra"""
 
-    def __init__(self,yml_file=None):
+    def __init__(self,yml_file=None,engine='numpy'):
+        """Load the scalers and regression models.
+
+        Parameters
+        ----------
+        yml_file : str
+            Path to a YAML file of scalers and models
+            (see saxs_models.save_models()).
+            Default is the scalers_and_models_regression.yml file 
+            in the modeling_data directory.
+        engine : str
+            'numpy' (default) evaluates the models 
+            with the classes of the linear_models module,
+            and 'sklearn' evaluates them with scikit-learn estimators.
+        """
         if yml_file is None:
             p = os.path.abspath(__file__)
             d = os.path.dirname(p)
             yml_file = os.path.join(d,'modeling_data','scalers_and_models_regression.yml')
 
-        s_and_m_file = open(yml_file,'rb')
-        s_and_m = yaml.load(s_and_m_file)
+        s_and_m = model_bundle.load_models(yml_file)
 
         reg_models_dict = s_and_m['models']
         scalers_dict = s_and_m['scalers']
@@ -36,9 +51,15 @@ class SaxsRegressor(object):
             scaler_params = scalers_dict[model_name]
             acc = acc_dict[model_name]
             if scaler_params is not None:
-                s = preprocessing.StandardScaler()
+                if engine == 'sklearn':
+                    s = preprocessing.StandardScaler()
+                    m = linear_model.SGDRegressor()
+                elif engine == 'numpy':
+                    s = linear_models.LinearScaler()
+                    m = linear_models.LinearRegressor()
+                else:
+                    raise RuntimeError('Unsupported engine: {}'.format(engine))
                 self.set_param(s,scaler_params)
-                m = linear_model.SGDRegressor()
                 self.set_param(m,model_params)
             self.models[model_name] = m
             self.scalers[model_name] = s
@@ -102,6 +123,104 @@ class SaxsRegressor(object):
 
         return params
 
+    def predict_params_batch(self,populations,features,q_I_list):
+        """Evaluate the scattering parameters of many samples.
+
+        Each sample is evaluated as in self.predict_params(),
+        but each regression model is evaluated once for the whole batch,
+        and the additional features 
+        (saxs_math.spherical_normal_profile() 
+        and saxs_math.guinier_porod_profile())
+        are only computed for the samples that need them.
+        If the additional features of a sample cannot be computed,
+        the corresponding parameter is set to its default
+        (see saxs_fit.param_defaults).
+
+        Parameters
+        ----------
+        populations : array or list
+            N-by-4 array counting scatterer populations,
+            with columns in the order of saxs_fit.population_keys,
+            similar to the output of SaxsClassifier.classify_batch(),
+            or a list of N populations dicts.
+        features : array or pandas.DataFrame
+            N-by-13 array of sample numerical features,
+            with columns in the order of profile_keys['unidentified'],
+            or a DataFrame with (at least) these columns
+        q_I_list : list
+            list of N n-by-2 arrays of scattering vector (1/Angstrom) 
+            and intensities
+
+        Returns
+        -------
+        params : list
+            list of N dictionaries of predicted parameters
+        """
+        if hasattr(features,'columns'):
+            features = features[profile_keys['unidentified']].values
+        feature_array = np.atleast_2d(np.asarray(features,dtype=float))
+        if isinstance(populations,(list,tuple)) \
+        and all([isinstance(pops,dict) for pops in populations]):
+            populations = [[pops[k] for k in saxs_fit.population_keys]
+                for pops in populations]
+        pop_array = np.atleast_2d(np.asarray(populations,dtype=int))
+        identified = pop_array[:,saxs_fit.population_keys.index('unidentified')] == 0
+        sph_rows = np.nonzero(identified & (pop_array[:,
+            saxs_fit.population_keys.index('spherical_normal')] > 0))[0]
+        gp_rows = np.nonzero(identified & (pop_array[:,
+            saxs_fit.population_keys.index('guinier_porod')] > 0))[0]
+
+        params = [OrderedDict() for i in range(feature_array.shape[0])]
+
+        if len(sph_rows) > 0:
+            r0sph = self._predict_batch('r0_sphere',feature_array[sph_rows])
+            ss_rows, ss_features = self._additional_features(
+                saxs_math.spherical_normal_profile,sph_rows,feature_array,q_I_list)
+            sigsph = OrderedDict()
+            if len(ss_rows) > 0:
+                sigsph = OrderedDict(zip(ss_rows,
+                    self._predict_batch('sigma_sphere',ss_features)))
+            for i,r0 in zip(sph_rows,r0sph):
+                params[i]['r0_sphere'] = [float(r0)]
+                params[i]['sigma_sphere'] = [float(sigsph.get(i,
+                    saxs_fit.param_defaults['sigma_sphere']))]
+
+        if len(gp_rows) > 0:
+            rg_rows, rg_features = self._additional_features(
+                saxs_math.guinier_porod_profile,gp_rows,feature_array,q_I_list)
+            rg = OrderedDict()
+            if len(rg_rows) > 0:
+                rg = OrderedDict(zip(rg_rows,
+                    self._predict_batch('rg_gp',rg_features)))
+            for i in gp_rows:
+                params[i]['rg_gp'] = [float(rg.get(i,saxs_fit.param_defaults['rg_gp']))]
+                # TODO: add a model for the porod exponent.
+                params[i]['D_gp'] = [float(saxs_fit.param_defaults['D_gp'])]
+
+        return params
+
+    def _predict_batch(self,model_name,feature_array):
+        x = self.scalers[model_name].transform(feature_array)
+        return self.models[model_name].predict(x)
+
+    def _additional_features(self,profiler,rows,feature_array,q_I_list):
+        # compute extra features for the given rows,
+        # skipping the rows for which they are not available
+        # or can not be computed numerically
+        ok_rows = []
+        extra_features = []
+        for i in rows:
+            try:
+                prof = profiler(q_I_list[i])
+            except (ValueError,RuntimeError,FloatingPointError):
+                continue
+            if None in prof.values():
+                continue
+            ok_rows.append(i)
+            extra_features.append(np.append(feature_array[i],
+                np.array(list(prof.values()))))
+        return ok_rows, np.array(extra_features)
+
     def get_accuracy(self):
         """Get accuracy for a all regression models.
 
@@ -0,0 +1,70 @@
+"""Modules for sqlite-backed stores.
+
+SqliteStore holds the database connection of
+prediction_cache.PredictionCache, pif_mirror.PifMirror,
+and feature_store.FeatureStore.
+Each process opens its own connection,
+so that a store can be shared by concurrent processes.
+"""
+import os
+import sqlite3
+import threading
+
+class SqliteStore(object):
+    """Base class for stores kept in an sqlite database.
+
+    Subclasses create their tables in _create_tables(),
+    and access the database through _connect(),
+    while holding self._lock.
+    """
+
+    def __init__(self,db_file,timeout=30.):
+        """Initialize a SqliteStore.
+
+        Parameters
+        ----------
+        db_file : str
+            Path to the sqlite database file.
+            It is created if it does not exist.
+        timeout : float
+            Time in seconds to wait for a lock held by
+            another process before raising an error.
+        """
+        self.db_file = db_file
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def __getstate__(self):
+        # connections and locks are not shared between processes
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_conn'] = None
+        state['_pid'] = None
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # one connection per process:
+        # a connection inherited by a forked process is not reused
+        if self._conn is None or not self._pid == os.getpid():
+            self._conn = sqlite3.connect(self.db_file,timeout=self.timeout,
+                check_same_thread=False)
+            self._pid = os.getpid()
+            with self._conn:
+                self._create_tables(self._conn)
+        return self._conn
+
+    def _create_tables(self,conn):
+        raise NotImplementedError
@@ -7,6 +7,7 @@ setup(name='saxskit',
     author='SSRL',
     author_email='paws-developers@slac.stanford.edu',
     packages=find_packages(),
+    package_data={'saxskit.modeling_data':['*.yml','*.npz','*.txt']},
     install_requires=[
         'numpy','scipy','scikit-learn'
     ],
@@ -1,22 +1,40 @@
 from __future__ import print_function
 import os
 import glob
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 from collections import OrderedDict
 
 import numpy as np
 
 from saxskit import saxs_math, saxs_fit, saxs_classify, saxs_regression
-from saxskit import peak_math
+from saxskit import peak_math, peak_finder, saxs_pipeline, model_bundle
+from saxskit import profile_keys, local_citrination, prediction_cache, pif_mirror
+from saxskit import feature_store
 
-from citrination_client import CitrinationClient
 from saxskit.saxs_models import get_data_from_Citrination
 from saxskit.saxs_models import train_classifiers, train_regressors
 from saxskit.saxs_models import train_classifiers_partial, train_regressors_partial
 from saxskit.saxs_models import save_models
+from saxskit.saxs_models import get_pifs_from_Citrination, iter_pifs_from_Citrination
+from saxskit.saxs_models import training_dataframe
 
 from saxskit.saxs_math import profile_spectrum
 from saxskit.saxs_citrination import CitrinationSaxsModels
 
+def test_import_saxs_math():
+    # importing saxs_math should not pull in the heavy optional dependencies
+    heavy = ['pandas','sklearn','lmfit','citrination_client','pypif',
+        'scipy.special','scipy.optimize','scipy.ndimage','scipy.linalg']
+    code = 'import sys, saxskit.saxs_math; '\
+        'print(",".join([m for m in {} if m in sys.modules]))'.format(heavy)
+    out = subprocess.check_output([sys.executable,'-c',code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert out.decode().strip() == ''
+
 def test_guinier_porod():
     qvals = np.arange(0.01,1.,0.01)
     Ivals = saxs_math.guinier_porod(qvals,20,4,120)
@@ -26,10 +44,186 @@ def test_spherical_normal_saxs():
     Ivals = saxs_math.spherical_normal_saxs(qvals,20,0.2)
     Ivals = saxs_math.spherical_normal_saxs(qvals,20,0.)
 
+def _spherical_normal_saxs_loop(q,r0,sigma,sampling_width=3.5,sampling_step=0.1):
+    # reference implementation: one pass over q for each sampled radius
+    q_nz = (q != 0)
+    I = np.zeros(q.shape)
+    sigma_r = sigma*r0
+    dr = sigma_r*sampling_step
+    rmin = np.max([r0-sampling_width*sigma_r,dr])
+    rmax = r0+sampling_width*sigma_r
+    I_zero = 0
+    for ri in np.arange(rmin,rmax,dr):
+        xi = q*ri
+        V_ri = float(4)/3*np.pi*ri**3
+        rhoi = 1./(np.sqrt(2*np.pi)*sigma_r)*np.exp(-1*(r0-ri)**2/(2*sigma_r**2))
+        I_zero += V_ri**2 * rhoi*dr
+        I[q_nz] += V_ri**2 * rhoi*dr*(3.*(np.sin(xi[q_nz])-xi[q_nz]*np.cos(xi[q_nz]))*xi[q_nz]**-3)**2
+    I[np.invert(q_nz)] = I_zero
+    return I/I_zero
+
+def test_spherical_normal_saxs_vectorized():
+    qvals = np.arange(0.,1.,0.001)
+    for r0,sigma in [(5.,0.05),(20.,0.2),(100.,0.5)]:
+        I_loop = _spherical_normal_saxs_loop(qvals,r0,sigma)
+        I_vec = saxs_math.spherical_normal_saxs(qvals,r0,sigma)
+        I_chunked = saxs_math.spherical_normal_saxs(qvals,r0,sigma,chunk_size=7)
+        assert np.allclose(I_vec,I_loop,rtol=1.E-10,atol=0.)
+        assert np.allclose(I_chunked,I_loop,rtol=1.E-10,atol=0.)
+
+def test_compute_saxs_batch():
+    qvals = np.arange(0.,0.6,0.002)
+    pops = OrderedDict.fromkeys(saxs_fit.population_keys)
+    pops.update(unidentified=0,guinier_porod=1,spherical_normal=2,diffraction_peaks=1)
+    rng = np.random.RandomState(0)
+    nbatch = 5
+    params = OrderedDict(
+        I0_floor = rng.uniform(0.,1.,nbatch),
+        G_gp = rng.uniform(1.,10.,nbatch),
+        rg_gp = rng.uniform(5.,30.,nbatch),
+        D_gp = rng.uniform(2.,4.,nbatch),
+        I0_sphere = rng.uniform(1.,100.,(nbatch,2)),
+        r0_sphere = rng.uniform(10.,50.,(nbatch,2)),
+        sigma_sphere = np.array([[0.,0.05],[0.1,0.2],[0.3,0.],[0.5,0.4],[0.02,0.01]]),
+        I_pkcenter = rng.uniform(0.1,1.,nbatch),
+        q_pkcenter = rng.uniform(0.2,0.4,nbatch),
+        pk_hwhm = rng.uniform(0.001,0.01,nbatch))
+    I_batch = saxs_math.compute_saxs_batch(qvals,pops,params,chunk_size=2)
+    assert I_batch.shape == (nbatch,len(qvals))
+    for i in range(nbatch):
+        p = OrderedDict([(k,list(np.atleast_1d(v[i]).astype(float))) for k,v in params.items()])
+        I_i = saxs_math.compute_saxs(qvals,pops,p)
+        assert np.allclose(I_batch[i],I_i,rtol=1.E-10,atol=0.)
+
+def test_sphere_form_factor_cache():
+    qvals = np.arange(0.,1.,0.001)
+    ff_cache = saxs_math.SphereFormFactorCache(qvals,max_kernels=1000)
+    for r0,sigma in [(5.,0.05),(20.,0.2),(50.,0.1),(20.,0.)]:
+        I = saxs_math.spherical_normal_saxs(qvals,r0,sigma)
+        I_cached = saxs_math.spherical_normal_saxs(qvals,r0,sigma,ff_cache=ff_cache)
+        assert np.allclose(I_cached,I,rtol=1.E-3,atol=0.)
+    assert len(ff_cache._keys) <= 1000
+    I_cached = saxs_math.spherical_normal_saxs(qvals,50.,0.1,ff_cache=ff_cache)
+    assert ff_cache.hits > 0
+    # a full cache must not evict the kernels requested by the same call
+    ff_cache = saxs_math.SphereFormFactorCache(qvals,max_kernels=100)
+    keys = np.arange(30000,30200,2)
+    ff_cache.get_kernels(keys)
+    for keys in [np.arange(30100,30320,2),np.arange(30000,30400,5),np.arange(30000,30050)]:
+        assert np.array_equal(ff_cache.get_kernels(keys),ff_cache._compute_kernels(keys))
+        assert len(ff_cache._keys) <= 100
+    for r0,sigma in [(20.,0.2),(21.,0.2)]:
+        I = saxs_math.spherical_normal_saxs(qvals,r0,sigma)
+        I_cached = saxs_math.spherical_normal_saxs(qvals,r0,sigma,ff_cache=ff_cache)
+        assert np.allclose(I_cached,I,rtol=1.E-3,atol=0.)
+
+def test_spherical_normal_gauss_hermite():
+    qvals = np.arange(0.,0.5,0.001)
+    for r0,sigma in [(5.,0.1),(20.,0.2),(50.,0.05)]:
+        I_dense = saxs_math.spherical_normal_saxs(qvals,r0,sigma,5,0.02)
+        I_gh = saxs_math.spherical_normal_saxs(qvals,r0,sigma,integration='gauss_hermite')
+        assert np.max(np.abs(np.log10(I_gh)-np.log10(I_dense))) < 1.E-3
+    # too broad for Gauss-Hermite: falls back to the rectangle rule
+    I_rect = saxs_math.spherical_normal_saxs(qvals,1000.,0.3)
+    I_gh = saxs_math.spherical_normal_saxs(qvals,1000.,0.3,integration='gauss_hermite')
+    assert np.allclose(I_gh,I_rect)
+    omega = 2*np.sqrt(2)*np.max(qvals)*0.3*1000.
+    assert saxs_math.gauss_hermite_order(omega) is None
+    assert saxs_math._gauss_hermite_order_cache[(omega,1.E-4)] is None
+
+def test_compute_saxs_jacobian():
+    qvals = np.arange(0.,0.6,0.002)
+    pops = OrderedDict.fromkeys(saxs_fit.population_keys)
+    pops.update(unidentified=0,guinier_porod=1,spherical_normal=2,diffraction_peaks=1)
+    params = OrderedDict(
+        I0_floor=[0.1],G_gp=[3.],rg_gp=[12.],D_gp=[3.2],
+        I0_sphere=[10.,5.],r0_sphere=[20.,40.],sigma_sphere=[0.1,0.3],
+        I_pkcenter=[1.],q_pkcenter=[0.3],pk_hwhm=[0.005])
+    I, dI = saxs_math.compute_saxs_jacobian(qvals,pops,params)
+    assert np.allclose(I,saxs_math.compute_saxs(qvals,pops,params))
+    for pkey,pvals in params.items():
+        for i,val in enumerate(pvals):
+            h = val*1.E-6
+            p_plus = OrderedDict([(k,list(v)) for k,v in params.items()])
+            p_minus = OrderedDict([(k,list(v)) for k,v in params.items()])
+            p_plus[pkey][i] = val+h
+            p_minus[pkey][i] = val-h
+            dI_fd = (saxs_math.compute_saxs(qvals,pops,p_plus)
+                - saxs_math.compute_saxs(qvals,pops,p_minus))/(2*h)
+            assert np.allclose(dI[pkey][i],dI_fd,rtol=1.E-4,atol=1.E-6*np.max(np.abs(dI_fd)))
+
 def test_diffraction_peaks():
     qvals = np.arange(0.01,1.,0.01)
     Ivals = peak_math.voigt(qvals-0.5,0.05,0.05)
 
+def _peaks_by_window_loop(x,y,w=10,thr=0.):
+    # the original window-scanning loop
+    pk_idx = []
+    pk_confidence = []
+    for idx in range(w,len(y)-w-1):
+        ywin = y[idx-w:idx+w+1]
+        if np.argmax(ywin) == w:
+            conf = ywin[w]/np.mean(ywin)-1.
+            if conf > thr:
+                pk_idx.append(idx)
+                pk_confidence.append(conf)
+    return pk_idx,pk_confidence
+
+def test_peaks_by_window():
+    I_list = []
+    for pop_type in ['precursors','spheres','peaks']:
+        for data_path in glob.glob(os.path.join(os.path.dirname(__file__),
+            'test_data','solution_saxs',pop_type,'*.csv')):
+            q_I = np.loadtxt(data_path,dtype=float,delimiter=',')
+            I_list.append(q_I[:,1])
+    q = q_I[:,0]
+    # plateaus, to check that ties are resolved like np.argmax
+    I_list.append(np.round(I_list[-1],1))
+    for w in [1,10,20]:
+        pk_idx, pk_conf = peak_finder.peaks_by_window_batch(q,np.array(I_list),w,0.)
+        for I,idx_b,conf_b in zip(I_list,pk_idx,pk_conf):
+            idx_ref,conf_ref = _peaks_by_window_loop(q,I,w,0.)
+            idx,conf = peak_finder.peaks_by_window(q,I,w,0.)
+            assert idx == idx_ref and idx_b == idx_ref
+            assert conf == conf_ref and conf_b == conf_ref
+
+def test_first_window_max_min():
+    Iq4_list = []
+    for pop_type in ['precursors','spheres','peaks']:
+        for data_path in glob.glob(os.path.join(os.path.dirname(__file__),
+            'test_data','solution_saxs',pop_type,'*.csv')):
+            q_I = np.loadtxt(data_path,dtype=float,delimiter=',')
+            Iq4_list.append(q_I[:,1]*q_I[:,0]**4)
+    w = 10
+    idxmax, idxmin = peak_finder.first_window_max_min(np.array(Iq4_list),w)
+    for Iq4,imax_b,imin_b in zip(Iq4_list,idxmax,idxmin):
+        # the original scan from spherical_normal_profile()
+        imax_ref, imin_ref = 0,0
+        for idx in range(w,len(Iq4)-w-1):
+            if np.argmax(Iq4[idx-w:idx+w+1]) == w and imax_ref == 0:
+                imax_ref = idx
+            if np.argmin(Iq4[idx-w:idx+w+1]) == w and imin_ref == 0 and not imax_ref == 0:
+                imin_ref = idx
+        assert peak_finder.first_window_max_min(Iq4,w) == (imax_ref,imin_ref)
+        assert (imax_b,imin_b) == (imax_ref,imin_ref)
+
+def test_fit_I0_batch():
+    I_list = []
+    for pop_type in ['precursors','spheres','peaks']:
+        for data_path in glob.glob(os.path.join(os.path.dirname(__file__),
+            'test_data','solution_saxs',pop_type,'*.csv')):
+            q_I = np.loadtxt(data_path,dtype=float,delimiter=',')
+            I_list.append(q_I[:,1])
+    q = q_I[:,0]
+    I_at_0, p_I0 = saxs_math.fit_I0_batch(q,np.array(I_list),4)
+    for I,I0_b,p_b in zip(I_list,I_at_0,p_I0):
+        I0_ref,p_ref = saxs_math.fit_I0(q,I,4)
+        assert np.isclose(I0_b,I0_ref)
+        assert np.allclose(p_b,p_ref)
+        # the slope constraint is satisfied at q=0
+        q_s,q_mean,q_std = saxs_math.standardize_array(q)
+        assert np.isclose(np.polyval(np.polyder(p_b),-1*q_mean/q_std),0.)
+
 def test_profile_spectrum():
     datapath = os.path.join(os.path.dirname(__file__),
         'test_data','solution_saxs','precursors','precursors_0.csv')
@@ -81,6 +275,175 @@ def test_classifier():
             for popk in pops.keys():
                 print('\t{} populations: {} ({} certainty)'.format(popk,pops[popk],certs[popk]))
 
+def _write_test_models(yml_file,n_features,classifier=True):
+    # random scalers and linear models, written as a compiled bundle,
+    # for the model names (keys) and numbers of features (values)
+    # given in n_features
+    import sklearn
+    rng = np.random.RandomState(0)
+    s_and_m = OrderedDict()
+    s_and_m['version'] = [int(v) for v in sklearn.__version__.split('.')[:2]]
+    for k in ['scalers','models','accuracy']:
+        s_and_m[k] = OrderedDict()
+    for model_name,nf in n_features.items():
+        s_and_m['scalers'][model_name] = OrderedDict(
+            mean_=rng.randn(nf),scale_=rng.rand(nf)+0.5,
+            with_mean=True,with_std=True,n_features_in_=nf)
+        m = OrderedDict(intercept_=rng.randn(1),n_features_in_=nf)
+        if classifier:
+            m['coef_'] = rng.randn(1,nf)
+            m['classes_'] = np.array([0,1])
+            m['loss'] = 'log' if s_and_m['version'] < [1,1] else 'log_loss'
+        else:
+            m['coef_'] = rng.randn(nf)
+        s_and_m['models'][model_name] = m
+        s_and_m['accuracy'][model_name] = 0.5
+    with open(yml_file,'w') as f:
+        f.write('# test models\n')
+    model_bundle.write_model_bundle(s_and_m,
+        model_bundle.default_bundle_file(yml_file),model_bundle.file_hash(yml_file))
+
+def test_classify_batch():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        yml_file = os.path.join(tmp_dir,'models.yml')
+        _write_test_models(yml_file,OrderedDict.fromkeys(saxs_fit.population_keys,13))
+        sxc = saxs_classify.SaxsClassifier(yml_file)
+    finally:
+        shutil.rmtree(tmp_dir)
+    feats = []
+    for data_path in glob.glob(os.path.join(os.path.dirname(__file__),
+        'test_data','solution_saxs','*','*.csv')):
+        feats.append(saxs_math.profile_spectrum(np.loadtxt(data_path,delimiter=',')))
+    # random features, to cover both sides of the unidentified gate
+    rng = np.random.RandomState(1)
+    for i in range(40):
+        feats.append(OrderedDict(zip(profile_keys['unidentified'],rng.randn(13))))
+    X = np.array([list(f.values()) for f in feats])
+    pops, certs = sxc.classify_batch(X)
+    assert 0 < np.sum(pops[:,0]) < len(feats)
+    import pandas as pd
+    df = pd.DataFrame(X[:,::-1],columns=profile_keys['unidentified'][::-1])
+    pops_df, certs_df = sxc.classify_batch(df)
+    assert np.array_equal(pops_df,pops)
+    for f,pop_row,cert_row in zip(feats,pops,certs):
+        p_ref, c_ref = sxc.classify(f)
+        for ik,k in enumerate(saxs_fit.population_keys):
+            if k in p_ref:
+                assert pop_row[ik] == p_ref[k]
+                assert np.isclose(cert_row[ik],c_ref[k])
+            else:
+                assert pop_row[ik] == 0 and np.isnan(cert_row[ik])
+
+def test_linear_models():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cls_file = os.path.join(tmp_dir,'classifiers.yml')
+        _write_test_models(cls_file,OrderedDict.fromkeys(saxs_fit.population_keys,13))
+        reg_file = os.path.join(tmp_dir,'regressors.yml')
+        _write_test_models(reg_file,OrderedDict(r0_sphere=13,sigma_sphere=17,rg_gp=16),False)
+        sxc_np = saxs_classify.SaxsClassifier(cls_file,engine='numpy')
+        sxc_sk = saxs_classify.SaxsClassifier(cls_file,engine='sklearn')
+        sxr_np = saxs_regression.SaxsRegressor(reg_file,engine='numpy')
+        sxr_sk = saxs_regression.SaxsRegressor(reg_file,engine='sklearn')
+    finally:
+        shutil.rmtree(tmp_dir)
+    rng = np.random.RandomState(2)
+    for k in saxs_fit.population_keys:
+        X = 3*rng.randn(50,13)
+        x_np = sxc_np.scalers[k].transform(X)
+        x_sk = sxc_sk.scalers[k].transform(X)
+        assert np.allclose(x_np,x_sk)
+        assert np.array_equal(sxc_np.models[k].predict(x_np),sxc_sk.models[k].predict(x_sk))
+        assert np.allclose(sxc_np.models[k].predict_proba(x_np),sxc_sk.models[k].predict_proba(x_sk))
+        # single samples
+        assert np.allclose(sxc_np.models[k].predict_proba(x_np[:1]),sxc_sk.models[k].predict_proba(x_sk[:1]))
+    for k,nf in [('r0_sphere',13),('sigma_sphere',17),('rg_gp',16)]:
+        X = 3*rng.randn(50,nf)
+        y_np = sxr_np.models[k].predict(sxr_np.scalers[k].transform(X))
+        y_sk = sxr_sk.models[k].predict(sxr_sk.scalers[k].transform(X))
+        assert y_np.shape == y_sk.shape
+        assert np.allclose(y_np,y_sk)
+
+def test_predict_params_batch():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        yml_file = os.path.join(tmp_dir,'regressors.yml')
+        _write_test_models(yml_file,OrderedDict(r0_sphere=13,sigma_sphere=17,rg_gp=16),False)
+        sxr = saxs_regression.SaxsRegressor(yml_file)
+    finally:
+        shutil.rmtree(tmp_dir)
+    q_I_list = []
+    pops_list = []
+    for pop_dir,pop_keys in [('spheres',['spherical_normal']),
+        ('precursors',['guinier_porod','spherical_normal']),
+        ('peaks',['unidentified'])]:
+        for data_path in glob.glob(os.path.join(os.path.dirname(__file__),
+            'test_data','solution_saxs',pop_dir,'*.csv')):
+            q_I_list.append(np.loadtxt(data_path,delimiter=','))
+            pops = OrderedDict.fromkeys(saxs_fit.population_keys,0)
+            for k in pop_keys:
+                pops[k] = 1
+            pops_list.append(pops)
+    feats = [saxs_math.profile_spectrum(q_I) for q_I in q_I_list]
+    X = np.array([list(f.values()) for f in feats])
+    params = sxr.predict_params_batch(pops_list,X,q_I_list)
+    pop_array = np.array([list(pops.values()) for pops in pops_list])
+    assert params == sxr.predict_params_batch(pop_array,X,q_I_list)
+    for pops,f,q_I,p in zip(pops_list,feats,q_I_list,params):
+        p_ref = sxr.predict_params(pops,f,q_I)
+        assert list(p.keys()) == list(p_ref.keys())
+        for k in p_ref:
+            assert np.allclose(p[k],p_ref[k])
+
+def test_model_bundle():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        yml_file = os.path.join(tmp_dir,'models.yml')
+        with open(yml_file,'w') as f:
+            f.write('models: {}\n')
+        s_and_m = OrderedDict()
+        s_and_m['version'] = [0,19,1]
+        s_and_m['scalers'] = OrderedDict(r0_sphere=OrderedDict(
+            mean_=np.arange(13.),scale_=np.ones(13),with_mean=True,n_samples_seen_=np.int64(10)))
+        s_and_m['models'] = OrderedDict(r0_sphere=OrderedDict(
+            coef_=np.linspace(0,1,13),intercept_=np.array([0.5]),loss='squared_loss',
+            loss_function_=object()))
+        s_and_m['accuracy'] = OrderedDict(r0_sphere=0.25,rg_gp=None)
+        bundle_file = model_bundle.default_bundle_file(yml_file)
+        model_bundle.write_model_bundle(s_and_m,bundle_file,model_bundle.file_hash(yml_file))
+        # the current bundle is used without parsing the YAML
+        s_and_m_2 = model_bundle.load_models(yml_file)
+        assert list(s_and_m_2.keys()) == list(s_and_m.keys())
+        assert s_and_m_2['version'] == [0,19,1]
+        assert np.array_equal(s_and_m_2['scalers']['r0_sphere']['mean_'],np.arange(13.))
+        assert s_and_m_2['scalers']['r0_sphere']['n_samples_seen_'] == 10
+        assert np.array_equal(s_and_m_2['models']['r0_sphere']['coef_'],np.linspace(0,1,13))
+        assert s_and_m_2['models']['r0_sphere']['loss'] == 'squared_loss'
+        assert not 'loss_function_' in s_and_m_2['models']['r0_sphere']
+        assert s_and_m_2['accuracy'] == s_and_m['accuracy']
+        # editing the YAML invalidates the bundle
+        with open(yml_file,'a') as f:
+            f.write('accuracy: {}\n')
+        s_and_m_3, yml_hash = model_bundle.read_model_bundle(bundle_file)
+        assert not yml_hash == model_bundle.file_hash(yml_file)
+    finally:
+        shutil.rmtree(tmp_dir)
+    # sklearn objects in the YAML are not imported
+    s_and_m = model_bundle.load_yaml('coef_: [1.0, 2.0]\n'
+        'loss_function_: !!python/object/apply:sklearn.no_such_module.Log []\n')
+    assert s_and_m['coef_'] == [1.,2.]
+    assert s_and_m['loss_function_'] is None
+
+def test_shipped_model_bundles():
+    # the shipped bundles are current, so the YAML files are not parsed
+    for yml_name in ['scalers_and_models.yml','scalers_and_models_regression.yml']:
+        yml_file = os.path.join(os.path.dirname(saxs_classify.__file__),'modeling_data',yml_name)
+        bundle_file = model_bundle.default_bundle_file(yml_file)
+        s_and_m, yml_hash = model_bundle.read_model_bundle(bundle_file)
+        assert yml_hash == model_bundle.file_hash(yml_file)
+        assert list(s_and_m.keys()) == ['version','scalers','models','accuracy']
+
 def test_regressions():
     model_file_path = os.path.join(os.getcwd(),'saxskit',
         'modeling_data','scalers_and_models.yml')
@@ -126,6 +489,246 @@ def test_fitter():
     for k, v in params.items():
         print('\t{}: {} --> {}'.format(k,v,p_opt[k]))
 
+def test_profile_spectrum_batch():
+    q_I_list = []
+    for pop_type in ['precursors','spheres','peaks']:
+        for data_path in glob.glob(os.path.join(os.path.dirname(__file__),
+            'test_data','solution_saxs',pop_type,'*.csv')):
+            q_I_list.append(np.loadtxt(data_path,dtype=float,delimiter=','))
+    q = q_I_list[0][:,0]
+    I = np.array([q_I[:,1] for q_I in q_I_list])
+    # zero out some interior points to exercise the log(I) masking
+    I_holes = I.copy()
+    I_holes[0,10:20] = 0.
+    I_holes[1,[5,50,51,300]] = 0.
+    I = np.vstack((I,I_holes))
+    feats = saxs_math.profile_spectrum_batch(q,I)
+    assert feats.shape == (I.shape[0],len(profile_keys['unidentified']))
+    for I_row,f_row in zip(I,feats):
+        f_ref = saxs_math.profile_spectrum(np.array([q,I_row]).T)
+        assert np.allclose(f_row,list(f_ref.values()))
+
+def _assert_features_equal(f1,f2):
+    assert list(f1.keys()) == list(f2.keys())
+    for k in f1.keys():
+        assert (f1[k] is None) == (f2[k] is None or np.isnan(f2[k]))
+        if f1[k] is not None:
+            assert np.isclose(f1[k],f2[k])
+
+def test_feature_store():
+    data_dir = os.path.join(os.path.dirname(__file__),'test_data','solution_saxs')
+    q_I_list = [np.loadtxt(p,dtype=float,delimiter=',') 
+        for p in sorted(glob.glob(os.path.join(data_dir,'*','*.csv')))]
+    pops = OrderedDict.fromkeys(saxs_fit.population_keys,0)
+    pops['spherical_normal'] = 1
+    pops_list = [pops]*len(q_I_list)
+    pops_list[0] = OrderedDict(pops,unidentified=1)
+    ref = [feature_store.compute_features(q_I,p) for q_I,p in zip(q_I_list,pops_list)]
+    tmp_dir = tempfile.mkdtemp()
+    version = saxs_math.feature_version
+    try:
+        db_file = os.path.join(tmp_dir,'features.db')
+        store = feature_store.FeatureStore(db_file)
+        feats = store.features_batch(q_I_list[:3],pops_list[:3])
+        assert store.stats()['misses'] == 3
+        # spectra that are already stored are not profiled again
+        store = feature_store.FeatureStore(db_file)
+        feats += store.features_batch(q_I_list[3:]+[q_I_list[1]],pops_list[3:]+[pops_list[1]])
+        assert list(store.stats().values()) == [1,len(q_I_list)-3,len(q_I_list)]
+        for f,f_ref in zip(feats,ref+[ref[1]]):
+            _assert_features_equal(f,f_ref)
+        assert store.features(q_I_list[0],pops)['q_at_half_I0'] is not None
+        assert store.features(q_I_list[0],pops_list[0])['q_at_half_I0'] is None
+        # a new feature version invalidates the stored features
+        saxs_math.feature_version = version+1
+        store = feature_store.FeatureStore(db_file)
+        assert store.stats()['entries'] == 0
+        store.features_batch(q_I_list,pops_list)
+        assert store.stats()['misses'] == len(q_I_list)
+        store.close()
+    finally:
+        saxs_math.feature_version = version
+        shutil.rmtree(tmp_dir)
+
+def test_training_dataframe():
+    from saxskit import all_profile_keys, population_keys, all_parameter_keys
+    data_dir = os.path.join(os.path.dirname(__file__),'test_data','solution_saxs')
+    q_I_list = [np.loadtxt(p,dtype=float,delimiter=',') 
+        for p in sorted(glob.glob(os.path.join(data_dir,'*','*.csv')))[:3]]
+    pops = [OrderedDict([('unidentified',1),('guinier_porod',0),
+        ('spherical_normal',0),('diffraction_peaks',0)]) for q_I in q_I_list]
+    pops[1]['unidentified'] = 0
+    pops[1]['spherical_normal'] = 1
+    params = [OrderedDict(),OrderedDict(r0_sphere=[25.],sigma_sphere=[0.1]),OrderedDict()]
+    records = [('ex{}'.format(i),None,q_I,None,None,p,par,None) 
+        for i,(q_I,p,par) in enumerate(zip(q_I_list,pops,params))]
+    feats = [feature_store.compute_features(q_I,p) for q_I,p in zip(q_I_list,pops)]
+    df = training_dataframe(records,feats)
+    assert list(df.columns) == ['experiment_id']+all_profile_keys+population_keys+all_parameter_keys
+    for k in all_profile_keys+all_parameter_keys:
+        assert df[k].dtype == np.float64
+    for k in population_keys:
+        assert df[k].dtype == np.int64
+    assert df['r0_sphere'].tolist()[1] == 25.
+    assert np.isnan(df['r0_sphere'][0]) and np.isnan(df['q_at_half_I0'][0])
+    assert np.isclose(df['Imax_over_Imean'][2],feats[2]['Imax_over_Imean'])
+    # missing populations are NaN
+    del records[2][5]['diffraction_peaks']
+    df = training_dataframe(records,feats)
+    assert df['diffraction_peaks'].dtype == np.float64
+    assert np.isnan(df['diffraction_peaks'][2])
+
+def test_profile_spectra():
+    data_dir = os.path.join(os.path.dirname(__file__),'test_data','solution_saxs')
+    paths = sorted(glob.glob(os.path.join(data_dir,'*','*.csv')))
+    pops = OrderedDict.fromkeys(saxs_fit.population_keys)
+    pops.update(unidentified=0,guinier_porod=0,spherical_normal=1,diffraction_peaks=0)
+    ref = [profile_spectrum(np.loadtxt(p,dtype=float,delimiter=',')) for p in paths]
+    res = list(saxs_pipeline.profile_spectra(paths,read_ahead=2))
+    assert [r[0] for r in res] == paths
+    for (path,feats),f_ref in zip(res,ref):
+        assert list(feats.keys()) == list(f_ref.keys())
+        assert np.allclose(list(feats.values()),list(f_ref.values()))
+    chunks = list(saxs_pipeline.profile_spectra(paths,pops,chunk_size=3,read_ahead=0))
+    assert [len(ch) for ch in chunks] == [3,3,1]
+    res = [r for ch in chunks for r in ch]
+    for (path,feats),f_ref in zip(res,ref):
+        assert np.allclose([feats[k] for k in f_ref.keys()],list(f_ref.values()))
+        assert 'q_at_Iq4_min1' in feats
+    # abandoning the stream early should not hang the loader
+    stream = saxs_pipeline.profile_spectra(paths,read_ahead=1)
+    next(stream)
+    stream.close()
+
+def test_saxs_pipeline():
+    data_dir = os.path.join(os.path.dirname(__file__),'test_data','solution_saxs')
+    paths = sorted(glob.glob(os.path.join(data_dir,'*','*.csv')))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cls_file = os.path.join(tmp_dir,'classifiers.yml')
+        _write_test_models(cls_file,OrderedDict.fromkeys(saxs_fit.population_keys,13))
+        reg_file = os.path.join(tmp_dir,'regressors.yml')
+        _write_test_models(reg_file,OrderedDict(r0_sphere=13,sigma_sphere=17,rg_gp=16),False)
+        sxc = saxs_classify.SaxsClassifier(cls_file)
+        sxr = saxs_regression.SaxsRegressor(reg_file)
+        with saxs_pipeline.SaxsPipeline(cls_file,reg_file,
+            n_processes=2,chunk_size=2,max_pending=2) as pipe:
+            res = list(pipe.run_files(paths))
+            assert pipe.stats['n_spectra'] == len(paths)
+            assert all([t > 0 for t in pipe.throughput().values()])
+        pipe = saxs_pipeline.SaxsPipeline(cls_file,reg_file,n_processes=1,chunk_size=3)
+        res_serial = list(pipe.run_files(paths,read_ahead=0))
+        # the models are loaded once: the load time is counted once
+        t_load = pipe.stats['model_load_time']
+        list(pipe.run_files(paths,read_ahead=0))
+        assert pipe.stats['model_load_time'] == t_load
+    finally:
+        shutil.rmtree(tmp_dir)
+    assert [r[0] for r in res] == paths
+    assert [r[0] for r in res_serial] == paths
+    for (path,result),(path_s,result_s) in zip(res,res_serial):
+        q_I = np.loadtxt(path,dtype=float,delimiter=',')
+        feats = profile_spectrum(q_I)
+        pops, certs = sxc.classify(feats)
+        assert result['populations'] == pops
+        assert result_s['populations'] == pops
+        assert np.allclose(list(result['certainties'].values()),list(certs.values()))
+        params = sxr.predict_params(pops,feats,q_I)
+        if not pops['unidentified']:
+            params, rpt = saxs_fit.SaxsFitter(q_I,pops).fit_intensity_params(params)
+        for r in [result,result_s]:
+            assert list(r['params'].keys()) == list(params.keys())
+            for k in params:
+                assert np.allclose(r['params'][k],params[k])
+
+def test_fitter_least_squares():
+    datapath = os.path.join(os.path.dirname(__file__),
+        'test_data','solution_saxs','spheres','spheres_0.csv')
+    q_I = np.loadtxt(datapath,dtype=float,delimiter=',')
+    pops = OrderedDict.fromkeys(saxs_fit.population_keys)
+    pops.update(unidentified=0,guinier_porod=0,spherical_normal=1,diffraction_peaks=0)
+    params = OrderedDict(I0_floor=[0.1],I0_sphere=[1000.],r0_sphere=[25.],sigma_sphere=[0.1])
+    sxf = saxs_fit.SaxsFitter(q_I,pops)
+    assert np.isclose(np.sum(sxf.residuals(params)**2),sxf.evaluate(params))
+    p_nm,rpt_nm = sxf.fit(params)
+    p_ls,rpt_ls = sxf.fit(params,method='least_squares')
+    print('objective: {} (nelder-mead), {} (least_squares)'.format(
+        rpt_nm['final_objective'],rpt_ls['final_objective']))
+    assert rpt_ls['final_objective'] < 1.01*rpt_nm['final_objective']
+
+def test_fitter_param_vector():
+    datapath = os.path.join(os.path.dirname(__file__),
+        'test_data','solution_saxs','spheres','spheres_1.csv')
+    q_I = np.loadtxt(datapath,dtype=float,delimiter=',')
+    pops = OrderedDict.fromkeys(saxs_fit.population_keys)
+    pops.update(unidentified=0,guinier_porod=1,spherical_normal=2,diffraction_peaks=1)
+    params = OrderedDict(I0_floor=[0.1],G_gp=[1.],rg_gp=[5.],D_gp=[4.],
+        I0_sphere=[1000.,10.],r0_sphere=[25.,40.],sigma_sphere=[0.1,0.],
+        I_pkcenter=[0.5],q_pkcenter=[0.2],pk_hwhm=[0.01])
+    sxf = saxs_fit.SaxsFitter(q_I,pops)
+    x = sxf.params_to_vector(params)
+    assert sxf.param_names == list(sxf.lmfit_params(params).keys())
+    assert np.allclose(sxf.compute_intensity(x),
+        saxs_math.compute_saxs(sxf.q,pops,params))
+    I, jac = sxf.compute_intensity_jacobian(x)
+    I_ref, dI_ref = saxs_math.compute_saxs_jacobian(sxf.q,pops,params)
+    assert np.allclose(I,I_ref)
+    for j,(pkey,i) in enumerate(sxf.param_slots):
+        assert np.allclose(jac[:,j],dI_ref[pkey][i])
+    p = sxf.vector_to_params(x)
+    for pkey,pvals in params.items():
+        assert p[pkey] == pvals
+
+def test_fit_intensity_params():
+    datapath = os.path.join(os.path.dirname(__file__),
+        'test_data','solution_saxs','spheres','spheres_1.csv')
+    q_I = np.loadtxt(datapath,dtype=float,delimiter=',')
+    pops = OrderedDict.fromkeys(saxs_fit.population_keys)
+    pops.update(unidentified=0,guinier_porod=1,spherical_normal=1,diffraction_peaks=0)
+    params = OrderedDict(I0_floor=[0.1],G_gp=[1.],rg_gp=[5.],D_gp=[4.],
+        I0_sphere=[1000.],r0_sphere=[25.],sigma_sphere=[0.1])
+    sxf = saxs_fit.SaxsFitter(q_I,pops)
+    # simplex fit with only the intensity parameters free
+    fp = sxf.default_params()
+    for k,v in fp.items():
+        for idx in range(len(v)):
+            v[idx] = not k in saxs_fit.intensity_param_keys
+    p_nm,rpt_nm = sxf.fit(params,fp)
+    p_lin,rpt_lin = sxf.fit_intensity_params(params)
+    assert rpt_lin['final_objective'] < 1.001*rpt_nm['final_objective']
+    for k in ['rg_gp','D_gp','r0_sphere','sigma_sphere']:
+        assert p_lin[k] == params[k]
+    p_sep,rpt_sep = sxf.fit(params,separable=True)
+    assert rpt_sep['final_objective'] < rpt_lin['final_objective']
+    # separable fit with all nonlinear parameters fixed:
+    # only the intensity parameters are solved
+    for method in ['nelder-mead','least_squares']:
+        p_fix,rpt_fix = sxf.fit(params,fp,separable=True,method=method)
+        assert rpt_fix['final_objective'] < 1.001*rpt_lin['final_objective']
+        for k in ['rg_gp','D_gp','r0_sphere','sigma_sphere']:
+            assert p_fix[k] == params[k]
+
+def test_fit_batch():
+    datapath = os.path.join(os.path.dirname(__file__),
+        'test_data','solution_saxs','spheres')
+    q_I_list = [np.loadtxt(os.path.join(datapath,'spheres_{}.csv'.format(i)),
+        dtype=float,delimiter=',') for i in range(3)]
+    # a malformed spectrum should not stop the batch
+    q_I_list.insert(1,np.zeros(10))
+    pops = OrderedDict.fromkeys(saxs_fit.population_keys)
+    pops.update(unidentified=0,guinier_porod=0,spherical_normal=1,diffraction_peaks=0)
+    params = OrderedDict(I0_floor=[0.1],I0_sphere=[1000.],r0_sphere=[25.],sigma_sphere=[0.1])
+    progress = []
+    res = saxs_fit.fit_batch(q_I_list,pops,params,method='least_squares',
+        n_processes=2,chunk_size=1,callback=lambda n,ntot,t: progress.append(n))
+    assert len(res) == 4
+    assert progress == [1,2,3,4]
+    assert not res[1][1]['success']
+    assert 'error' in res[1][1]
+    for q_I,(p_opt,rpt) in zip(q_I_list[:1]+q_I_list[2:],res[:1]+res[2:]):
+        p_ref,rpt_ref = saxs_fit.SaxsFitter(q_I,pops).fit(params,method='least_squares')
+        assert np.isclose(rpt['final_objective'],rpt_ref['final_objective'])
+
 def test_model_training():
     path = os.getcwd()
     head, tail = os.path.split(path)
@@ -134,6 +737,7 @@ def test_model_training():
         return
     with open(api_key_file, "r") as g:
         a_key = g.readline().strip()
+    from citrination_client import CitrinationClient
     cl = CitrinationClient(site='https://slac.citrination.com',api_key=a_key)
 
     data = get_data_from_Citrination(client=cl, dataset_id_list=[16])
@@ -187,6 +791,145 @@ def test_citrination_models():
         print('\t{} populations: {} ({} certainty)'.format(popk,params[popk],uncertainties[popk]))
 
 
+def _local_citrination_models():
+    # input-dependent stand-in models, to check the pairing of candidates and predictions
+    models = OrderedDict()
+    def classify(cand):
+        sph = int(cand['Property q_Icentroid'] > 0.1)
+        gp = int(cand['Property Imax_over_Imean'] > 10.)
+        return {'Property unidentified':[0,0.1],'Property guinier_porod':[gp,0.2],
+            'Property spherical_normal':[sph,0.3],'Property diffraction_peaks':[0,0.4]}
+    models['33'] = classify
+    models['34'] = lambda cand: {'Property r0_sphere':[cand['Property q_Icentroid'],1.]}
+    models['31'] = lambda cand: {'Property sigma_sphere':[cand['Property pI_qwidth'],0.01]}
+    models['35'] = lambda cand: {'Property rg_gp':[cand['Property q_at_half_I0'],2.]}
+    return models
+
+def test_citrination_batch():
+    data_dir = os.path.join(os.path.dirname(__file__),'test_data','solution_saxs')
+    q_I_list = [np.loadtxt(p,dtype=float,delimiter=',') 
+        for p in sorted(glob.glob(os.path.join(data_dir,'*','*.csv')))]
+    features = [profile_spectrum(q_I) for q_I in q_I_list]
+    with local_citrination.LocalCitrinationServer(_local_citrination_models()) as server:
+        client = local_citrination.LocalCitrinationClient(server.address)
+        sxm = CitrinationSaxsModels(client=client)
+        ref = [sxm.classify(f) for f in features]
+        ref_params = [sxm.predict_params(pops,f,q_I) 
+            for (pops,uncs),f,q_I in zip(ref,features,q_I_list)]
+        for n_threads in [1,3]:
+            sxm_batch = CitrinationSaxsModels(client=client,batch_size=3,n_threads=n_threads)
+            n_req = server.n_requests
+            pops, uncs = sxm_batch.classify_batch(features)
+            assert server.n_requests-n_req == 3
+            assert list(zip(pops,uncs)) == ref
+            params, p_uncs = sxm_batch.predict_params_batch(pops,features,q_I_list)
+            assert list(zip(params,p_uncs)) == ref_params
+            sxm_batch.close()
+    assert any([p for p,u in ref_params])
+
+def _put_predictions(args):
+    cache, i0 = args
+    cands = [{'Property x':float(i)} for i in range(i0,i0+50)]
+    cache.put_many('1',cands,[{'Property y':[2.*c['Property x'],0.]} for c in cands])
+
+def test_prediction_cache():
+    data_dir = os.path.join(os.path.dirname(__file__),'test_data','solution_saxs')
+    q_I_list = [np.loadtxt(p,dtype=float,delimiter=',') 
+        for p in sorted(glob.glob(os.path.join(data_dir,'*','*.csv')))]
+    features = [profile_spectrum(q_I) for q_I in q_I_list]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join(tmp_dir,'cache.db')
+        with local_citrination.LocalCitrinationServer(_local_citrination_models()) as server:
+            client = local_citrination.LocalCitrinationClient(server.address)
+            ref = CitrinationSaxsModels(client=client).classify_batch(features)
+            for i in range(2):
+                cache = prediction_cache.PredictionCache(db_file)
+                sxm = CitrinationSaxsModels(client=client,cache=cache)
+                n_req = server.n_requests
+                assert sxm.classify_batch(features) == ref
+                # the first run fills the cache, the second is served from it
+                assert server.n_requests-n_req == 1-i
+                assert cache.stats()['hits'] == i*len(features)
+                assert cache.stats()['misses'] == (1-i)*len(features)
+            # expired entries are not used
+            sxm = CitrinationSaxsModels(client=client,
+                cache=prediction_cache.PredictionCache(db_file,ttl=0.))
+            n_req = server.n_requests
+            assert sxm.classify_batch(features) == ref
+            assert server.n_requests-n_req == 1
+        # least recently used entries are evicted
+        cache = prediction_cache.PredictionCache(os.path.join(tmp_dir,'lru.db'),max_entries=2)
+        cands = [{'Property x':float(i)} for i in range(3)]
+        cache.put_many('1',cands[:2],[[0],[1]])
+        time.sleep(0.01)
+        assert cache.get_many('1',cands[:1]) == [[0]]
+        cache.put_many('1',cands[2:],[[2]])
+        assert cache.get_many('1',cands) == [[0],None,[2]]
+        assert cache.stats()['evictions'] == 1
+        # the cache can be shared by concurrent processes
+        cache = prediction_cache.PredictionCache(os.path.join(tmp_dir,'mp.db'))
+        cache.stats()
+        import multiprocessing
+        pool = multiprocessing.Pool(2)
+        pool.map(_put_predictions,[(cache,i0) for i0 in range(0,400,50)])
+        pool.close()
+        pool.join()
+        assert cache.stats()['entries'] == 400
+        cands = [{'Property x':np.float64(i)} for i in range(400)]
+        assert cache.get_many('1',cands) == [{'Property y':[2.*i,0.]} for i in range(400)]
+        cache.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_get_pifs_from_Citrination():
+    datasets = OrderedDict()
+    datasets['16'] = [{'category':'system','uid':'a{}'.format(i)} for i in range(250)]
+    datasets['21'] = [{'category':'system','uid':'b{}'.format(i)} for i in range(30)]
+    datasets['22'] = [{'category':'system','uid':'c{}'.format(i)} for i in range(100)]
+    uids = [rec['uid'] for recs in datasets.values() for rec in recs]
+    with local_citrination.LocalCitrinationServer(datasets=datasets,latency=0.01) as server:
+        client = local_citrination.LocalCitrinationClient(server.address)
+        server.n_failures = 2
+        pifs = get_pifs_from_Citrination(client,[16,21,22],
+            n_threads=3,page_size=40,backoff=0.01)
+        assert [pp.uid for pp in pifs] == uids
+        pifs = list(iter_pifs_from_Citrination(client,[22,16],n_threads=1,page_size=100))
+        assert sorted([pp.uid for pp in pifs]) == sorted(uids[:250]+uids[280:])
+        # a search that fails more than max_retries times is raised
+        server.n_failures = 3
+        error = None
+        try:
+            get_pifs_from_Citrination(client,[21],n_threads=1,max_retries=2,backoff=0.01)
+        except Exception as ex:
+            error = ex
+        assert '503' in str(error)
+
+def test_pif_mirror():
+    datasets = OrderedDict()
+    datasets['1'] = [{'category':'system','uid':'a{:03d}'.format(i),
+        'names':['a']} for i in range(120)]
+    datasets['15'] = [{'category':'system','uid':'b{:03d}'.format(i)} for i in range(30)]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        mirror = pif_mirror.PifMirror(os.path.join(tmp_dir,'mirror.db'))
+        with local_citrination.LocalCitrinationServer(datasets=datasets) as server:
+            client = local_citrination.LocalCitrinationClient(server.address)
+            counts = mirror.sync(client,[1,15],page_size=50)
+            assert list(counts.values()) == [150,0,0,0]
+            assert list(mirror.sync(client,[1,15,15]).values()) == [0,0,0,150]
+            datasets['1'][3]['names'] = ['changed']
+            datasets['1'].pop(5)
+            datasets['15'].append({'category':'system','uid':'b100'})
+            assert list(mirror.sync(client,[1,15]).values()) == [1,1,1,148]
+        pifs = pif_mirror.PifMirror(os.path.join(tmp_dir,'mirror.db')).get_pifs([15,1,15])
+        assert [pp.uid for pp in pifs] == [rec['uid'] for rec in datasets['15']+datasets['1']]
+        assert pifs[len(datasets['15'])+3].names == ['changed']
+        assert mirror.datasets() == OrderedDict([('1',119),('15',31)])
+        mirror.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
 #def test_citrination_classifier(address,api_key_file):
 #    model_file_path = os.path.join(os.getcwd(),'saxskit','modeling_data','scalers_and_models.yml')
 #    sxc = saxs_classify.SaxsClassifier(model_file_path)